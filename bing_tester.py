@@ -8,7 +8,7 @@ print(search.run('How many episodes in picard season 3'))
 """
 
 import asyncio
-from utils import tokenize_text
+from tokenizer import tokenize_text
 from web_extractor import WebExtractor
 
 def tokenizer(text):
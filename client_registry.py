@@ -0,0 +1,83 @@
+import os
+from typing import Callable, Dict, Optional, Tuple
+
+import aiohttp
+import openai
+from langchain.chains import LLMChain
+from langchain.chat_models import ChatOpenAI
+from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.prompts.base import BasePromptTemplate
+
+ChatModelKey = Tuple[str, float, Optional[int]]
+
+
+class ClientRegistry:
+    # One chat model per (model, temperature, max_tokens), one embeddings client per model and one chain per prompt,
+    # all sending their async requests through a single keep-alive aiohttp session instead of a new one per request
+    CONNECTION_LIMIT = int(os.environ.get("OPENAI_CONNECTION_LIMIT", 64))
+    KEEPALIVE_TIMEOUT_SECONDS = 60
+
+    def __init__(self) -> None:
+        self.chat_models: Dict[ChatModelKey, ChatOpenAI] = {}
+        self.embedding_models: Dict[str, OpenAIEmbeddings] = {}
+        self.chains: Dict[Tuple[str, ChatModelKey], LLMChain] = {}
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.clients_created = 0
+        self.clients_reused = 0
+
+    def chat_model(self, model: str = "gpt-4o-mini", temperature: float = 0.7, max_tokens: Optional[int] = None) -> ChatOpenAI:
+        key = (model, temperature, max_tokens)
+        chat_model = self.chat_models.get(key)
+        if chat_model is None:
+            self.clients_created += 1
+            # A single attempt, retries and deadlines belong to the call site's RequestPolicy
+            chat_model = ChatOpenAI(temperature=temperature, max_tokens=max_tokens, model=model, max_retries=1) # type: ignore
+            self.chat_models[key] = chat_model
+        else:
+            self.clients_reused += 1
+        return chat_model
+
+    def embedding_model(self, model: str = "text-embedding-ada-002") -> OpenAIEmbeddings:
+        embedding_model = self.embedding_models.get(model)
+        if embedding_model is None:
+            self.clients_created += 1
+            embedding_model = OpenAIEmbeddings(model=model)
+            self.embedding_models[model] = embedding_model
+        else:
+            self.clients_reused += 1
+        return embedding_model
+
+    def chain(self, name: str, prompt_factory: Callable[[], BasePromptTemplate], model: str = "gpt-4o-mini", temperature: float = 0.7, max_tokens: Optional[int] = None) -> LLMChain:
+        # Chains hold no per call state, so one per named prompt and chat model is shared by every caller
+        key = (name, (model, temperature, max_tokens))
+        chain = self.chains.get(key)
+        if chain is None:
+            chain = LLMChain(llm=self.chat_model(model, temperature, max_tokens), prompt=prompt_factory())
+            self.chains[key] = chain
+        return chain
+
+    async def open_session(self) -> aiohttp.ClientSession:
+        # openai reads the session from a context variable, tasks created after this call (from this task) use it
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.CONNECTION_LIMIT, keepalive_timeout=self.KEEPALIVE_TIMEOUT_SECONDS)
+            self.session = aiohttp.ClientSession(connector=connector)
+        openai.aiosession.set(self.session)
+        return self.session
+
+    async def close_session(self) -> None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        openai.aiosession.set(None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "chat_models": len(self.chat_models),
+            "embedding_models": len(self.embedding_models),
+            "chains": len(self.chains),
+            "clients_created": self.clients_created,
+            "clients_reused": self.clients_reused,
+        }
+
+
+client_registry = ClientRegistry()
@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import os
+import subprocess
+import tempfile
+import time
+from typing import Tuple
+
+import numpy as np
+
+# Latency of chat completion and embedding calls against a local stub of the OpenAI API, with openai opening a
+# session (and TLS connection) per request as it does by default, and with the client registry's keep-alive session.
+
+
+def create_self_signed_certificate(directory: str) -> Tuple[str, str]:
+    # Clients trust it through SSL_CERT_FILE, which aiohttp reads when it is imported, so create it before that
+    certificate_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key_path, "-out", certificate_path,
+                    "-days", "1", "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1"], check=True, capture_output=True)
+    return certificate_path, key_path
+
+
+def percentiles(latencies) -> str:
+    return f"p50 {np.percentile(latencies, 50) * 1000:7.2f} ms, p99 {np.percentile(latencies, 99) * 1000:7.2f} ms"
+
+
+async def run_calls(calls: int, concurrency: int, shared_session: bool):
+    import openai
+    from client_registry import client_registry
+
+    if shared_session:
+        await client_registry.open_session()
+    chat_model = client_registry.chat_model(temperature=0.0)
+    embedding_model = client_registry.embedding_model()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def call(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            if i % 2:
+                await chat_model.apredict("benchmark")
+            else:
+                # The request OpenAIEmbeddings.aembed_query makes, without its tiktoken length check (which
+                # downloads the vocabulary, this benchmark runs offline)
+                await openai.Embedding.acreate(model=embedding_model.model, input=["benchmark " + str(i)])
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[call(i) for i in range(calls)])
+    elapsed = time.perf_counter() - start
+    if shared_session:
+        await client_registry.close_session()
+    return elapsed, latencies
+
+
+async def benchmark(args) -> None:
+    import openai
+    from openai_stub_server import OpenAIStubServer
+
+    stub = OpenAIStubServer(args.latency_ms / 1000)
+    await stub.start(args.certificate)
+    openai.api_base = stub.api_base
+    os.environ["OPENAI_API_BASE"] = stub.api_base
+
+    print(f"{args.calls} calls at concurrency {args.concurrency} against {stub.api_base}, {args.latency_ms:.0f} ms server latency")
+    for name, shared_session in [("session per request", False), ("shared keep-alive", True)]:
+        stub.peers.clear()
+        elapsed, latencies = await run_calls(args.calls, args.concurrency, shared_session)
+        print(f"{name:20} {args.calls / elapsed:8.1f} calls/s, {percentiles(latencies)}, {stub.connections} connections")
+    await stub.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the shared OpenAI client session against a local stub server")
+    parser.add_argument("--calls", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--no-tls", action="store_true")
+    args = parser.parse_args()
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    with tempfile.TemporaryDirectory() as work_dir:
+        args.certificate = None
+        if not args.no_tls:
+            args.certificate = create_self_signed_certificate(work_dir)
+            os.environ["SSL_CERT_FILE"] = args.certificate[0]
+        asyncio.run(benchmark(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import sqlite3
+import threading
+from typing import Callable, Dict
+
+
+class ConnectionManager:
+    JOURNAL_MODE = "WAL"
+    # NORMAL is durable across application crashes in WAL mode, only a power loss can roll back the last commits
+    SYNCHRONOUS = "NORMAL"
+    CACHED_STATEMENTS = 256
+
+    def __init__(self) -> None:
+        self.connections: Dict[str, sqlite3.Connection] = {}
+        self.lock = threading.Lock()
+
+    def get(self, db_path: str, initializer: Callable[[sqlite3.Connection], None]) -> sqlite3.Connection:
+        # Schema creation (initializer) only runs the first time a database is opened by this process
+        connection = self.connections.get(db_path)
+        if connection is not None:
+            return connection
+        with self.lock:
+            connection = self.connections.get(db_path)
+            if connection is None:
+                connection = self.open(db_path)
+                with connection:
+                    initializer(connection)
+                self.connections[db_path] = connection
+        return connection
+
+    def close(self, db_path: str) -> None:
+        with self.lock:
+            connection = self.connections.pop(db_path, None)
+        if connection is not None:
+            connection.close()
+
+    def close_all(self) -> None:
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        for connection in connections:
+            connection.close()
+
+    def open(self, db_path: str) -> sqlite3.Connection:
+        # Opens an unshared connection, used by threads that need their own (e.g. the write-behind writer)
+        connection = sqlite3.connect(db_path, check_same_thread=False, cached_statements=self.CACHED_STATEMENTS)
+        connection.execute(f"PRAGMA journal_mode={self.JOURNAL_MODE}")
+        connection.execute(f"PRAGMA synchronous={self.SYNCHRONOUS}")
+        return connection
+
+
+connection_manager = ConnectionManager()
@@ -1,17 +1,23 @@
 from builtins import len, str
 import asyncio
+import bisect
 import discord
+import functools
+import itertools
 import time
 
-from langchain.chains import LLMChain
-from langchain.chat_models import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain.prompts.chat import (HumanMessagePromptTemplate,
                                     SystemMessagePromptTemplate)
+from client_registry import client_registry
+from llm_scheduler import LONG_TERM_COMMIT, SUMMARIZATION
+from request_policy import request_policy
+from token_ledger import token_ledger
+from tracing import tracer
 from message import Message
 
-from utils import truncate_text, tokenize_text
-from typing import List
+from tokenizer import count_tokens, count_tokens_batch
+from typing import List, Optional, Tuple
 from document_index import DocumentIndex
 
 
@@ -95,26 +101,63 @@ Investigation results:"""
     def __init__(self, conversation_id, conversation_history, active_memory, long_term_memory) -> None:
         self.conversation_id = conversation_id
         self.conversation_history = conversation_history
+        # token_prefix_sums[i] is the token count of conversation_history[:i], kept in step with the history
+        self.token_prefix_sums = [0] + list(itertools.accumulate(message.get_number_of_tokens() for message in conversation_history))
+        # One rendered transcript line per message, the joined transcripts are cached until the history changes
+        self.transcript_lines = [Conversation.render_transcript_line(message) for message in conversation_history]
+        self.escaped_transcript_lines = [Conversation.render_transcript_line(message, True) for message in conversation_history]
         self.lock = asyncio.Lock()
-        self.queue: asyncio.Queue[discord.Message]= asyncio.Queue()
+        # (time.perf_counter() when enqueued, message)
+        self.queue: asyncio.Queue[Tuple[float, discord.Message]] = asyncio.Queue()
         self.active_memory = active_memory
-        self.active_memory_tokens = len(tokenize_text(self.active_memory))
+        self.active_memory_tokens = count_tokens(self.active_memory)
         self.memory_index = DocumentIndex(self.conversation_id)
         self.long_term_memory = long_term_memory
         self.memorizer_running = False
 
     def enqueue_discord_message(self, message: discord.Message):
-        self.queue.put_nowait(message)
+        self.queue.put_nowait((time.perf_counter(), message))
 
     def add_message(self, message: Message):
         self.conversation_history.append(message)
-
-    def requests_gpt_4(self):
-        # Check if last message requested gpt-4 = 4
-        if len(self.conversation_history) == 0:
-            return False
-        last_message = self.conversation_history[-1]
-        return last_message.gpt_version_requested == 4
+        self.token_prefix_sums.append(self.token_prefix_sums[-1] + message.get_number_of_tokens())
+        self.transcript_lines.append(Conversation.render_transcript_line(message))
+        self.escaped_transcript_lines.append(Conversation.render_transcript_line(message, True))
+        self.invalidate_formatted_conversation()
+
+    def trim_history(self, trigger_token_limit: int, conversation_window_tokens: int, trimmable_count: Optional[int] = None):
+        # Keeps the newest messages that fit in trigger_token_limit, stopping at the first one that takes them past
+        # conversation_window_tokens, found by binary search over the prefix sums. Only the first trimmable_count
+        # messages can be dropped.
+        total_tokens = self.token_prefix_sums[-1]
+        trigger_start = bisect.bisect_left(self.token_prefix_sums, total_tokens - trigger_token_limit)
+        window_start = bisect.bisect_left(self.token_prefix_sums, total_tokens - conversation_window_tokens) - 1
+        start = max(trigger_start, window_start, 0)
+        if trimmable_count is not None:
+            start = min(start, trimmable_count)
+        if start == 0:
+            return
+        base_tokens = self.token_prefix_sums[start]
+        self.conversation_history = self.conversation_history[start:]
+        self.token_prefix_sums = [tokens - base_tokens for tokens in self.token_prefix_sums[start:]]
+        self.transcript_lines = self.transcript_lines[start:]
+        self.escaped_transcript_lines = self.escaped_transcript_lines[start:]
+        self.invalidate_formatted_conversation()
+
+    def requests_gpt_4(self, answered: Optional[List[Message]] = None):
+        # Check if a message being answered (the last one unless given) requested gpt-4 = 4
+        if answered is None:
+            answered = self.conversation_history[-1:]
+        return any(message.gpt_version_requested == 4 for message in answered)
+
+    def history_length_through(self, message: Optional[Message]) -> int:
+        # How many messages, oldest first, lead up to and include message. A reply to coalesced mentions answers the
+        # last of them, messages after it in the same batch weren't addressed to us.
+        if message is not None:
+            for index in range(len(self.conversation_history) - 1, -1, -1):
+                if self.conversation_history[index] is message:
+                    return index + 1
+        return len(self.conversation_history)
 
     def get_conversation_prompts(self):
         conversation = [Conversation.get_system_prompt_template()]
@@ -129,14 +172,14 @@ Investigation results:"""
         return conversation
 
     def get_conversation_token_count(self):
-        return sum([message.get_number_of_tokens() for message in self.conversation_history])
+        return self.token_prefix_sums[-1]
 
     def get_active_memory(self):
         return "\nRECENT MEMORIES:\n" + self.active_memory + "\n"
 
-    def get_long_term_memories(self, message):
+    @staticmethod
+    def format_long_term_memories(similar_memories):
         memories = "\nLONG TERM MEMORIES [time_in_past: memories_about_that_time]:\n"
-        similar_memories = self.memory_index.search_index(message)
         if len(similar_memories) == 0:
             memories += "No long term memories found\n"
         for memory in similar_memories:
@@ -150,17 +193,20 @@ Investigation results:"""
             prompt_template = self.LONG_TERM_MEMORY_PROMPT_TEMPLATE
             new_short_term_memories = self.active_memory
 
-            summarizer_prompt = PromptTemplate(template=prompt_template, input_variables=["new_short_term_memories"])
-            chain = LLMChain(llm=ChatOpenAI(temperature=0.7, max_tokens=1000, model="gpt-4o-mini"), prompt=summarizer_prompt)
+            chain = client_registry.chain("long_term_memory", lambda: PromptTemplate(template=prompt_template, input_variables=["new_short_term_memories"]), temperature=0.7, max_tokens=1000)
 
-            new_long_term_memory = (await chain.apredict(current_summary=self.long_term_memory, new_short_term_memories=new_short_term_memories)).strip()
-            self.long_term_memory = new_long_term_memory
-            self.memory_index.add_message(new_long_term_memory, int(time.time()))
+            inputs = dict(current_summary=self.long_term_memory, new_short_term_memories=new_short_term_memories)
+            with tracer.span("long_term_commit", chain.llm.model_name, str(self.conversation_id)):
+                new_long_term_memory = (await request_policy("long_term_memory").run(lambda: chain.apredict(**inputs), LONG_TERM_COMMIT, self.active_memory_tokens + 1000,
+                                                                                      lambda: token_ledger.record_chain("commit_to_long_term_memory", chain, inputs, '', self.conversation_id))).strip()
+                token_ledger.record_chain("commit_to_long_term_memory", chain, inputs, new_long_term_memory, self.conversation_id)
+                self.long_term_memory = new_long_term_memory
+                await self.memory_index.aadd_message(new_long_term_memory, int(time.time()))
             split_memory = self.active_memory.split(',')
+            split_memory_tokens = count_tokens_batch(split_memory)
             keep = []
             total_tokens = 0
-            for memory in reversed(split_memory):
-                current_memory_tokens = len(tokenize_text(memory))
+            for memory, current_memory_tokens in zip(reversed(split_memory), reversed(split_memory_tokens)):
                 if total_tokens + current_memory_tokens > self.ACTIVE_MEMORY_LOW_WATERMARK:
                     break
                 keep.insert(0, memory)
@@ -173,25 +219,47 @@ Investigation results:"""
         prompt_template = self.SUMMARIZER_PROMPT_TEMPLATE
         new_lines = self.get_formatted_conversation()
 
-        summarizer_prompt = PromptTemplate(template=prompt_template, input_variables=["new_lines"])
-        chain = LLMChain(llm=ChatOpenAI(temperature=0.7, max_tokens=1000, model="gpt-4o-mini"), prompt=summarizer_prompt)
+        chain = client_registry.chain("summarizer", lambda: PromptTemplate(template=prompt_template, input_variables=["new_lines"]), temperature=0.7, max_tokens=1000)
 
-        new_summary = (await chain.apredict(current_summary=self.active_memory, new_lines=new_lines)).strip()
-        new_summary_tokens = len(tokenize_text(new_summary))
+        inputs = dict(current_summary=self.active_memory, new_lines=new_lines)
+        with tracer.span("summarization", chain.llm.model_name, str(self.conversation_id)):
+            new_summary = (await request_policy("summarizer").run(lambda: chain.apredict(**inputs), SUMMARIZATION, self.get_conversation_token_count() + 1000,
+                                                                  lambda: token_ledger.record_chain("run_summarizer", chain, inputs, '', self.conversation_id))).strip()
+        token_ledger.record_chain("run_summarizer", chain, inputs, new_summary, self.conversation_id)
+        new_summary_tokens = count_tokens(new_summary)
         self.active_memory_tokens += new_summary_tokens
         self.active_memory += ',' + new_summary
         if self.active_memory_tokens > self.TOKEN_WINDOW_SIZE and not self.memorizer_running:
             self.memorizer_running = True
             asyncio.create_task(self.commit_to_long_term_memory())
 
-    def get_formatted_conversation(self, escape_newlines=False):
-        formatted_conversation = ''
-        for message in self.conversation_history:
-            content = message.content
-            if escape_newlines:
-                content = content.replace('\n', '\\n')
-            formatted_conversation += message.sender + ': ' + content + '\n'
-        return formatted_conversation
+    def get_formatted_conversation(self, escape_newlines=False, through: Optional[Message] = None):
+        # through ends the transcript at that message, see history_length_through
+        length = self.history_length_through(through)
+        if length < len(self.conversation_history):
+            return ''.join((self.escaped_transcript_lines if escape_newlines else self.transcript_lines)[:length])
+        if escape_newlines:
+            return self.escaped_formatted_conversation
+        return self.formatted_conversation
+
+    @functools.cached_property
+    def formatted_conversation(self):
+        return ''.join(self.transcript_lines)
+
+    @functools.cached_property
+    def escaped_formatted_conversation(self):
+        return ''.join(self.escaped_transcript_lines)
+
+    def invalidate_formatted_conversation(self):
+        self.__dict__.pop('formatted_conversation', None)
+        self.__dict__.pop('escaped_formatted_conversation', None)
+
+    @staticmethod
+    def render_transcript_line(message: Message, escape_newlines=False):
+        content = message.content
+        if escape_newlines:
+            content = content.replace('\n', '\\n')
+        return message.sender + ': ' + content + '\n'
 
     @staticmethod
     def get_system_prompt_template(gpt_version=3):
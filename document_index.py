@@ -1,66 +1,280 @@
+import asyncio
 import sqlite3
+import threading
 import faiss
 import numpy as np
-from langchain.embeddings.openai import OpenAIEmbeddings
+from client_registry import client_registry
+from embedding_cache import embedding_cache
+import index_backend
+from llm_scheduler import LONG_TERM_COMMIT, RETRIEVAL, llm_scheduler
+from request_policy import request_policy
+from token_ledger import token_ledger
+from tracing import tracer
+from tokenizer import count_tokens
 from repository import Repository
-import typing
+from typing import List, Optional, Tuple
 
 class DocumentIndex:
     INDEX_WINDOW = 10
     TEXT_EMBEDDING_ADA_002_DIMENSION = 1536
+    # A new snapshot is written once the memories added since the last one pass this size, or this fraction of
+    # the snapshot, so snapshot I/O stays amortized O(1) per memory
+    SNAPSHOT_MIN_LOG_SIZE = 256
+    SNAPSHOT_LOG_RATIO = 0.25
+    # An HNSW insert takes milliseconds, memories added while a graph was built are caught up on a worker thread
+    # until at most this many are left to add on the loop
+    REBUILD_CATCH_UP_ON_LOOP = 16
     def __init__(self, channel_id):
-        self.embeddings = OpenAIEmbeddings(model="text-embedding-ada-002")
-        self.index: Optional[faiss.IndexFlatL2] = None
+        self.embeddings = client_registry.embedding_model("text-embedding-ada-002")
+        # FAISS ids are long_term_memory_text ids, so results stay valid across deletes and rebuilds
+        self.index: Optional[faiss.Index] = None
+        self.index_kind = index_backend.FLAT
+        # Memory-mapped tiers are read-only, memories added after their snapshot go to this in RAM flat index
+        self.delta_index: Optional[faiss.Index] = None
         self.channel_id = channel_id
         self.repository = Repository(channel_id)
+        self.last_memory_id = 0
+        self.unsnapshotted_memories = 0
+        self.fold_in_flight = False
+        self.folded_memory_id: Optional[int] = None
+        # Bumped by install_index so a fold of a replaced index is never swapped in
+        self.index_generation = 0
+        # Guards fold_in_flight and folded_memory_id, which the writer thread hands a finished fold over through
+        self.lock = threading.Lock()
+        # A rebuild runs on a worker thread while the current index keeps serving, memories added meanwhile are
+        # replayed into the new one
+        self.rebuild_task: Optional[asyncio.Future] = None
+        self.added_during_rebuild: List[Tuple[int, np.ndarray]] = []
+        self.load_lock = asyncio.Lock()
 
-    def add_message(self, message, unix_timestamp: int):
+    async def aadd_message(self, message, unix_timestamp: int):
+        async def fetch():
+            async with llm_scheduler.slot(LONG_TERM_COMMIT, count_tokens(message)):
+                document_embedding = (await self.embeddings.aembed_documents([message]))[0]
+            self.record_embedding("DocumentIndex.add_message", message)
+            return document_embedding
+        await self.aadd_embedded_message(message, unix_timestamp, await embedding_cache.aembed(self.embeddings.model, message, fetch))
+
+    def record_embedding(self, call_site: str, text: str):
+        token_ledger.record(call_site, self.embeddings.model, count_tokens(text), 0, self.channel_id)
+
+    async def aadd_embedded_message(self, message, unix_timestamp: int, document_embedding):
         if self.index is None:
-            self.load_or_create_index()
+            await self.aload_or_create_index()
+        serialized_embedding = np.asarray(document_embedding, dtype=self.repository.EMBEDDING_DTYPE).tobytes()
+        # Awaits the commit of the memory row for its id instead of blocking the loop on the writer thread
+        self.index_memory(await self.repository.asave_long_term_memory(message, unix_timestamp, serialized_embedding), document_embedding)
+
+    def index_memory(self, memory_id: int, document_embedding):
         # This fills mypy with joy
         assert self.index is not None
+        self.swap_folded_index()
+        self.writable_index().add_with_ids(np.array([document_embedding]).astype('float32'), np.array([memory_id], dtype='int64'))
+        if self.rebuild_task is not None:
+            self.added_during_rebuild.append((memory_id, document_embedding))
+        self.last_memory_id = memory_id
+        self.unsnapshotted_memories += 1
+        if not self.maybe_promote_index():
+            self.maybe_snapshot_index()
 
-        document_embedding = self.embeddings.embed_documents([message])[0]
-        serialized_embedding = ",".join(map(str, document_embedding))
+    async def aload_or_create_index(self):
+        # Concurrent callers wait for the first one to open it
+        async with self.load_lock:
+            if self.index is not None:
+                return
+            possible_index, snapshot_memory_id = await self.repository.aload_long_term_memory_index()
+            if possible_index is not None and index_backend.kind_of(possible_index) is None:
+                # Snapshots from before id mapping assumed row position == memory id - 1, rebuild them from the embeddings
+                self.install_index(*await asyncio.to_thread(self.build_index, None))
+                return
+            memory_ids, embeddings = await self.repository.aload_embeddings(self.TEXT_EMBEDDING_ADA_002_DIMENSION, snapshot_memory_id)
+            self.open_index(possible_index, snapshot_memory_id, memory_ids, embeddings)
 
-        self.repository.save_long_term_memory(message, unix_timestamp, serialized_embedding)
-        self.index.add(np.array([document_embedding]).astype('float32'))
-
-        self.repository.save_long_term_memory_index(self.index)
-
-    def load_or_create_index(self):
-        possible_index = self.repository.load_long_term_memory_index()
-        if possible_index:
+    def open_index(self, possible_index: Optional[faiss.Index], snapshot_memory_id: int, memory_ids: List[int], embeddings: np.ndarray):
+        if possible_index is not None:
             self.index = possible_index
+            self.index_kind = index_backend.kind_of(possible_index)
         else:
-            self.index = faiss.IndexFlatL2(self.TEXT_EMBEDDING_ADA_002_DIMENSION)
-            self.repository.save_long_term_memory_index(self.index)
+            self.index = index_backend.create(index_backend.FLAT, self.TEXT_EMBEDDING_ADA_002_DIMENSION)
+            self.index_kind = index_backend.FLAT
+        self.delta_index = self.create_delta_index()
+        # Replay the memories saved after the snapshot
+        if len(embeddings):
+            self.writable_index().add_with_ids(embeddings, np.array(memory_ids, dtype='int64'))
+        self.last_memory_id = memory_ids[-1] if memory_ids else snapshot_memory_id
+        self.unsnapshotted_memories = len(memory_ids)
+        if not self.maybe_promote_index():
+            self.maybe_snapshot_index()
+
+    def create_delta_index(self) -> Optional[faiss.Index]:
+        if index_backend.is_memory_mapped(self.index_kind):
+            return index_backend.create(index_backend.FLAT, self.TEXT_EMBEDDING_ADA_002_DIMENSION)
+        return None
+
+    def writable_index(self) -> faiss.Index:
+        assert self.index is not None
+        return self.delta_index if self.delta_index is not None else self.index
+
+    def memory_count(self) -> int:
+        assert self.index is not None
+        return self.index.ntotal + (self.delta_index.ntotal if self.delta_index is not None else 0)
+
+    def maybe_promote_index(self) -> bool:
+        if self.rebuild_task is not None:
+            # The rebuilt index is snapshotted once it is installed
+            return True
+        target_kind = index_backend.kind_for(self.memory_count())
+        if index_backend.TIERS.index(target_kind) <= index_backend.TIERS.index(self.index_kind):
+            return False
+        print(f"Promoting long term memory index for {self.channel_id} from {self.index_kind} to {target_kind}")
+        self.schedule_rebuild(target_kind)
+        return True
 
-    def search_index(self, query, threshold=0.5, token_threshold=500):
+    def maybe_snapshot_index(self):
+        assert self.index is not None
+        snapshot_size = self.memory_count() - self.unsnapshotted_memories
+        if self.unsnapshotted_memories >= max(self.SNAPSHOT_MIN_LOG_SIZE, snapshot_size * self.SNAPSHOT_LOG_RATIO):
+            self.snapshot_index()
+
+    def snapshot_index(self):
+        with self.lock:
+            if self.fold_in_flight:
+                return
+            # Folded on the writer thread from the last snapshot file plus the log, the index being served isn't
+            # touched. A memory-mapped tier maps the folded file in swap_folded_index.
+            self.fold_in_flight = True
+        self.watch_fold(self.repository.fold_long_term_memory_index_file(self.last_memory_id, self.TEXT_EMBEDDING_ADA_002_DIMENSION))
+        if self.delta_index is None:
+            self.unsnapshotted_memories = 0
+
+    def watch_fold(self, future):
+        generation = self.index_generation
+        def on_index_folded(future):
+            # Runs on the writer thread, only hands the result over
+            with self.lock:
+                if generation != self.index_generation:
+                    return
+                if future.exception() is None:
+                    self.folded_memory_id = future.result()
+                self.fold_in_flight = False
+        future.add_done_callback(on_index_folded)
+
+    def swap_folded_index(self):
+        with self.lock:
+            folded_memory_id = self.folded_memory_id
+            self.folded_memory_id = None
+        if folded_memory_id is None or self.delta_index is None:
+            return
+        self.index = index_backend.read_memory_mapped(self.repository.index_path)
+        self.delta_index.remove_ids(faiss.IDSelectorRange(0, folded_memory_id + 1))
+        self.unsnapshotted_memories = self.delta_index.ntotal
+
+    async def asearch_index(self, query, threshold=0.5, token_threshold=500):
         if self.index is None:
-            self.load_or_create_index()
-        query_embedding = self.embeddings.embed_query(query)
-        distances, indices = self.index.search(np.array([query_embedding]).astype('float32'), self.INDEX_WINDOW)
+            await self.aload_or_create_index()
+        # Only the embedding request is awaited, so concurrent searches don't block each other on it. Repeated
+        # queries, from any channel, are answered by the embedding cache without one.
+        async def fetch():
+            query_embedding = await request_policy("embedding_query").run(lambda: self.embeddings.aembed_query(query), RETRIEVAL, count_tokens(query),
+                                                                          lambda: self.record_embedding("DocumentIndex.search_index", query))
+            self.record_embedding("DocumentIndex.search_index", query)
+            return query_embedding
+        with tracer.span("embedding", self.embeddings.model):
+            query_embedding = np.array([await embedding_cache.aembed(self.embeddings.model, query, fetch)]).astype('float32')
+        with tracer.span("faiss_search"):
+            return self.search_embedding(query_embedding, threshold, token_threshold)
+
+    def search_embedding(self, query_embedding, threshold=0.5, token_threshold=500):
+        self.swap_folded_index()
+        indexes = [self.index] if self.delta_index is None else [self.index, self.delta_index]
+        distances, memory_ids = index_backend.search(indexes, query_embedding, index_backend.candidate_count(self.index_kind, self.INDEX_WINDOW))
+        if index_backend.is_approximate(self.index_kind):
+            # Rerank the candidates by their exact distance, their embeddings are loaded with them anyway
+            candidates = self.repository.load_memories([int(memory_id) for memory_id in memory_ids[0] if memory_id != -1])
+            exact_distances = [float(np.sum((np.frombuffer(memory.serialized_embedding, dtype=self.repository.EMBEDDING_DTYPE) - query_embedding[0]) ** 2)) for memory in candidates]
+            ranked = sorted(zip(exact_distances, candidates), key=lambda hit: hit[0])[:self.INDEX_WINDOW]
+            hits = [memory for distance, memory in ranked if distance < threshold]
+        else:
+            hit_ids = [int(memory_id) for distance, memory_id in zip(distances[0], memory_ids[0]) if 0 <= distance < threshold and memory_id != -1]
+            # One query for every hit, still returned nearest first
+            hits = self.repository.load_memories(hit_ids)
+        return DocumentIndex.within_token_budget(hits, token_threshold)
+
+    @staticmethod
+    def within_token_budget(memories, token_threshold):
         results = []
         total_token_count = 0
-        for distance, index in zip(distances[0], indices[0]):
-            if 0 <= distance < threshold and index != -1:
-                memory_id = int(index) + 1
-                memory = self.repository.load_memory(memory_id)
-                if memory is not None:
-                    total_token_count += memory.text_token_count
-                    if total_token_count > token_threshold:
-                        break
-                    results.append(memory)
-
+        for memory in memories:
+            total_token_count += memory.get_token_count()
+            if total_token_count > token_threshold:
+                break
+            results.append(memory)
         return results
 
-    def rebuild_index(self):
-        embeddings = self.repository.load_embeddings()
-        if embeddings:
-            self.index = faiss.IndexFlatL2(self.TEXT_EMBEDDING_ADA_002_DIMENSION)
-            self.index.add(np.array(embeddings).astype('float32'))
-            self.repository.save_long_term_memory_index(self.index)
+    def rebuild_index(self, kind: Optional[str] = None):
+        # Blocks until the index is built, code on the event loop goes through schedule_rebuild
+        self.install_index(*self.build_index(kind))
+
+    def schedule_rebuild(self, kind: Optional[str] = None):
+        # Building an HNSW graph or training IVF-PQ takes seconds to minutes, so it runs on a worker thread and is
+        # installed back on the loop
+        if self.rebuild_task is not None:
+            return
+        self.added_during_rebuild = []
+        self.rebuild_task = asyncio.get_running_loop().create_task(self.rebuild(kind))
+        self.rebuild_task.add_done_callback(self.on_index_built)
+
+    def build_index(self, kind: Optional[str]) -> Tuple[str, faiss.Index, int, str]:
+        # Runs on a worker thread, only reads the database. The index is written to its own file here, while nothing
+        # else can modify it yet, and moved over the snapshot by install_index.
+        memory_ids, embeddings = self.repository.load_embeddings_in_thread(self.TEXT_EMBEDDING_ADA_002_DIMENSION)
+        kind = kind or index_backend.kind_for(len(memory_ids))
+        index = index_backend.build(kind, self.TEXT_EMBEDDING_ADA_002_DIMENSION, memory_ids, embeddings)
+        last_memory_id = memory_ids[-1] if memory_ids else 0
+        built_path = f"{self.repository.index_path}.{last_memory_id}.built"
+        index_backend.write(index, built_path)
+        return kind, index, last_memory_id, built_path
 
+    async def rebuild(self, kind: Optional[str]) -> Tuple[str, faiss.Index, int, str, int]:
+        kind, index, last_memory_id, built_path = await asyncio.to_thread(self.build_index, kind)
+        caught_up_memory_id = last_memory_id
+        # A memory-mapped tier puts them in its delta index instead, a flat add is cheap enough for the loop
+        while not index_backend.is_memory_mapped(kind):
+            added = [(memory_id, embedding) for memory_id, embedding in self.added_during_rebuild if memory_id > caught_up_memory_id]
+            if len(added) <= self.REBUILD_CATCH_UP_ON_LOOP:
+                break
+            await asyncio.to_thread(index.add_with_ids, np.array([embedding for _, embedding in added]).astype('float32'), np.array([memory_id for memory_id, _ in added], dtype='int64'))
+            caught_up_memory_id = added[-1][0]
+        return kind, index, last_memory_id, built_path, caught_up_memory_id
 
+    def on_index_built(self, task: asyncio.Future):
+        # Runs on the event loop, like every other change to the index
+        self.rebuild_task = None
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            print(f"Failed to rebuild the long term memory index for {self.channel_id}: {task.exception()}")
+            return
+        self.install_index(*task.result())
 
+    def install_index(self, kind: str, index: faiss.Index, last_memory_id: int, built_path: str, caught_up_memory_id: Optional[int] = None):
+        # Memories added to the old index while this one was built, they are in the log after the snapshot
+        unsnapshotted = [(memory_id, embedding) for memory_id, embedding in self.added_during_rebuild if memory_id > last_memory_id]
+        # The ones rebuild already added to the new index on a worker thread
+        added = [(memory_id, embedding) for memory_id, embedding in unsnapshotted if memory_id > (caught_up_memory_id or last_memory_id)]
+        self.added_during_rebuild = []
+        with self.lock:
+            self.index_generation += 1
+            self.folded_memory_id = None
+            self.fold_in_flight = False
+        self.index_kind = kind
+        self.index = index
+        self.last_memory_id = unsnapshotted[-1][0] if unsnapshotted else last_memory_id
+        self.unsnapshotted_memories = len(unsnapshotted)
+        self.delta_index = self.create_delta_index()
+        # A memory-mapped tier only searches the built index until swap_folded_index maps the installed file
+        with self.lock:
+            self.fold_in_flight = True
+        self.watch_fold(self.repository.install_long_term_memory_index_file(built_path, last_memory_id))
+        if added:
+            self.writable_index().add_with_ids(np.array([embedding for _, embedding in added]).astype('float32'), np.array([memory_id for memory_id, _ in added], dtype='int64'))
@@ -0,0 +1,113 @@
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+from connection_manager import connection_manager
+from write_behind import write_behind_queue
+
+# Compares rebuild_index time and database size for CSV text embeddings against float32 BLOB embeddings,
+# going through the same migration an existing channel database gets on first open.
+
+CHANNEL_ID = 1
+DIMENSION = 1536
+
+
+def create_csv_database(db_path: str, memories: int) -> None:
+    conn = sqlite3.connect(db_path)
+    conn.execute('''CREATE TABLE long_term_memory_text (
+        id INTEGER PRIMARY KEY,
+        timestamp INTEGER,
+        memory_text TEXT,
+        embedding_serialized_csv_text TEXT
+    )''')
+    conn.execute('''CREATE TABLE long_term_memory_index (
+        id INTEGER PRIMARY KEY,
+        serialized_faiss_index BLOB
+    )''')
+    rng = np.random.default_rng(0)
+    batch_size = 1000
+    for start in range(0, memories, batch_size):
+        vectors = rng.standard_normal((min(batch_size, memories - start), DIMENSION)).astype('float32')
+        conn.executemany(
+            "INSERT INTO long_term_memory_text (timestamp, memory_text, embedding_serialized_csv_text) VALUES (?, ?, ?)",
+            [(int(time.time()), "synthetic memory " + str(start + i), ",".join(map(str, vector.tolist()))) for i, vector in enumerate(vectors)]
+        )
+        conn.commit()
+    conn.close()
+
+
+def csv_rebuild_index(db_path: str) -> None:
+    # The previous rebuild_index: parse every CSV row, build the index, write the serialized index back
+    conn = sqlite3.connect(db_path)
+    embeddings = conn.execute("SELECT embedding_serialized_csv_text FROM long_term_memory_text ORDER BY id ASC").fetchall()
+    embeddings = [list(map(float, embedding[0].split(','))) for embedding in embeddings]
+    index = faiss.IndexFlatL2(DIMENSION)
+    index.add(np.array(embeddings).astype('float32'))
+    conn.execute("DELETE FROM long_term_memory_index")
+    conn.execute("INSERT INTO long_term_memory_index (serialized_faiss_index) VALUES (?)", (faiss.serialize_index(index),))
+    conn.commit()
+    conn.close()
+
+
+def vacuumed_size(db_path: str) -> int:
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("VACUUM")
+    conn.close()
+    return os.path.getsize(db_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DocumentIndex.rebuild_index embedding storage")
+    parser.add_argument("--memories", type=int, default=100000)
+    args = parser.parse_args()
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+    from document_index import DocumentIndex
+    from repository import Repository
+
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        try:
+            os.makedirs("conversations")
+            db_path = os.path.join("conversations", f"{CHANNEL_ID}.db")
+            create_csv_database(db_path, args.memories)
+
+            start = time.perf_counter()
+            csv_rebuild_index(db_path)
+            csv_seconds = time.perf_counter() - start
+            csv_size = vacuumed_size(db_path)
+
+            start = time.perf_counter()
+            Repository(CHANNEL_ID)
+            migration_seconds = time.perf_counter() - start
+            connection_manager.close_all()
+
+            blob_size = vacuumed_size(db_path)
+
+            document_index = DocumentIndex(CHANNEL_ID)
+            start = time.perf_counter()
+            document_index.rebuild_index()
+            write_behind_queue.flush()
+            blob_seconds = time.perf_counter() - start
+
+            write_behind_queue.close()
+            connection_manager.close_all()
+        finally:
+            os.chdir(original_dir)
+
+    print(f"{args.memories} memories of dimension {DIMENSION}")
+    print(f"migration:               {migration_seconds:8.2f} s")
+    print(f"rebuild_index CSV text:  {csv_seconds:8.2f} s, database {csv_size / 2**20:9.1f} MiB")
+    print(f"rebuild_index float32:   {blob_seconds:8.2f} s, database {blob_size / 2**20:9.1f} MiB")
+    print(f"speedup {csv_seconds / blob_seconds:.1f}x, size {csv_size / blob_size:.2f}x smaller")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+
+from connection_manager import connection_manager
+from repository import Repository
+from write_behind import write_behind_queue
+
+
+def normalize_text(text: str) -> str:
+    # Near-same texts that only differ in case or spacing share an embedding
+    return " ".join(text.split()).casefold()
+
+
+class EmbeddingCache:
+    # Embeddings by a hash of (model, normalized text), shared by every channel's DocumentIndex: the most recently used
+    # CACHE_SIZE in memory in front of every embedding ever fetched in a SQLite database. Queries and documents share
+    # entries, so a LongTermMemory query for a memory's exact text doesn't need an embedding request either. Concurrent
+    # misses for the same text share one request, which runs as its own task so that a caller that is cancelled or
+    # times out never cancels it for the others.
+    CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 4096))
+    # Not a .db file, on_ready loads every conversations/<channel id>.db as a channel
+    DB_PATH = os.environ.get("EMBEDDING_CACHE_PATH", os.path.join("conversations", "embedding_cache.sqlite3"))
+
+    def __init__(self) -> None:
+        self.cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self.pending: Dict[bytes, "asyncio.Task[np.ndarray]"] = {}
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def aembed(self, model: str, text: str, fetch: Callable[[], Awaitable[List[float]]]) -> np.ndarray:
+        key = self.key(model, text)
+        embedding = self.__lookup(key)
+        if embedding is not None:
+            return embedding
+        task = self.pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self.__fetch(key, model, fetch))
+            self.pending[key] = task
+            task.add_done_callback(lambda done: self.__forget(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def key(self, model: str, text: str) -> bytes:
+        return hashlib.sha256(model.encode('utf-8') + b'\0' + normalize_text(text).encode('utf-8')).digest()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "size": len(self.cache),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    async def __fetch(self, key: bytes, model: str, fetch: Callable[[], Awaitable[List[float]]]) -> np.ndarray:
+        try:
+            return self.__store(key, model, await fetch())
+        except asyncio.CancelledError as e:
+            # Waiters see a failed request rather than a cancellation of their own, which would stop e.g. a
+            # channel's queue processor
+            raise RuntimeError("Embedding request was cancelled") from e
+
+    def __forget(self, key: bytes, task: "asyncio.Task[np.ndarray]") -> None:
+        if self.pending.get(key) is task:
+            del self.pending[key]
+        # Every waiter may have given up already, nobody else has to retrieve the exception
+        if not task.cancelled():
+            task.exception()
+
+    def __lookup(self, key: bytes) -> Optional[np.ndarray]:
+        embedding = self.cache.get(key)
+        if embedding is not None:
+            self.memory_hits += 1
+            self.cache.move_to_end(key)
+            return embedding
+        # A primary key lookup, cheap enough for the event loop thread. Writes still in the write-behind queue are
+        # in memory already.
+        row = self.__connection().execute("SELECT embedding FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.disk_hits += 1
+        embedding = np.frombuffer(row[0], dtype=Repository.EMBEDDING_DTYPE)
+        self.__remember(key, embedding)
+        return embedding
+
+    def __store(self, key: bytes, model: str, embedding: List[float]) -> np.ndarray:
+        vector = np.array(embedding, dtype=Repository.EMBEDDING_DTYPE)
+        # Shared by every caller, so nobody can change it under the others
+        vector.setflags(write=False)
+        self.__remember(key, vector)
+        # The write-behind writer opens its own connection, the table has to exist by then
+        self.__connection()
+        serialized = vector.tobytes()
+        write_behind_queue.submit(self.DB_PATH, lambda conn: conn.execute("INSERT OR REPLACE INTO embeddings (key, model, embedding) VALUES (?, ?, ?)",
+                                                                          (key, model, serialized)))
+        return vector
+
+    def __remember(self, key: bytes, embedding: np.ndarray) -> None:
+        self.cache[key] = embedding
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def __connection(self) -> sqlite3.Connection:
+        return connection_manager.get(self.DB_PATH, self.__create_db_if_not_exists)
+
+    def __create_db_if_not_exists(self, conn: sqlite3.Connection) -> None:
+        conn.execute('''CREATE TABLE IF NOT EXISTS embeddings (
+            key BLOB PRIMARY KEY,
+            model TEXT NOT NULL,
+            embedding BLOB NOT NULL
+        ) WITHOUT ROWID''')
+
+
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from typing import List
+
+from connection_manager import connection_manager
+from embedding_cache import EmbeddingCache
+from write_behind import write_behind_queue
+
+# Replays LongTermMemory queries from several channels, where consecutive mentions keep coming back to the same
+# topics, against a stub embeddings endpoint: once with an embedding request per query as DocumentIndex used to make,
+# once through the EmbeddingCache, and once more through a fresh EmbeddingCache to show what a restart keeps.
+
+MODEL = "text-embedding-ada-002"
+DIMENSION = 1536
+TOPICS = [
+    "favorite programming language",
+    "the Mars rover",
+    "what we talked about yesterday",
+    "Bryan's birthday",
+    "the movie night plan",
+]
+
+
+class StubEmbeddings:
+    def __init__(self, latency_seconds: float) -> None:
+        self.latency_seconds = latency_seconds
+        self.calls = 0
+
+    async def aembed_query(self, text: str) -> List[float]:
+        self.calls += 1
+        await asyncio.sleep(self.latency_seconds)
+        rng = random.Random(text)
+        return [rng.random() for _ in range(DIMENSION)]
+
+
+def generate_queries(channels: int, queries: int, repeat_ratio: float, rng):
+    traffic = []
+    for channel in range(channels):
+        channel_queries = []
+        for i in range(queries):
+            if rng.random() < repeat_ratio:
+                # The retriever rewords a repeated topic now and then, only in case and spacing
+                topic = rng.choice(TOPICS)
+                channel_queries.append(topic.upper() if rng.random() < 0.2 else topic)
+            else:
+                channel_queries.append(f"channel {channel} question {i}")
+        traffic.append(channel_queries)
+    return traffic
+
+
+async def replay(traffic, embed, interval: float) -> List[float]:
+    latencies: List[float] = []
+
+    async def run_channel(channel_queries):
+        for query in channel_queries:
+            start = time.perf_counter()
+            await embed(query)
+            latencies.append(time.perf_counter() - start)
+            await asyncio.sleep(interval)
+    await asyncio.gather(*[run_channel(channel_queries) for channel_queries in traffic])
+    return sorted(latencies)
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+
+
+def report(name: str, latencies: List[float], calls: int) -> None:
+    print(f"{name:12} p50 {percentile(latencies, 0.5):7.1f} ms, p95 {percentile(latencies, 0.95):7.1f} ms, {calls} embedding requests")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the embedding cache against one embedding request per query")
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=150)
+    parser.add_argument("--interval-ms", type=float, default=20)
+    parser.add_argument("--repeat-ratio", type=float, default=0.5)
+    args = parser.parse_args()
+
+    traffic = generate_queries(args.channels, args.queries, args.repeat_ratio, random.Random(0))
+    interval = args.interval_ms / 1000
+    print(f"{args.channels} channels x {args.queries} LongTermMemory queries, {args.repeat_ratio:.0%} on repeated topics, "
+          f"{args.latency_ms:.0f} ms embedding round trip")
+
+    embeddings = StubEmbeddings(args.latency_ms / 1000)
+    report("uncached", asyncio.run(replay(traffic, embeddings.aembed_query, interval)), embeddings.calls)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        EmbeddingCache.DB_PATH = os.path.join(work_dir, "embedding_cache.sqlite3")
+        for name in ["cached", "restarted"]:
+            embeddings = StubEmbeddings(args.latency_ms / 1000)
+            cache = EmbeddingCache()
+            latencies = asyncio.run(replay(traffic, lambda query: cache.aembed(MODEL, query, lambda: embeddings.aembed_query(query)), interval))
+            write_behind_queue.flush()
+            report(name, latencies, embeddings.calls)
+            print(f"{'':12} {cache.stats()}")
+        write_behind_queue.close()
+        connection_manager.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
+import asyncio
 
 from document_index import DocumentIndex
 
 index = DocumentIndex(1234)
-#index.add_message('Bob says hello, AI responds hi', 1234)
-print(index.search_index('Bob says hello, AI responds hi'))
+#asyncio.run(index.aadd_message('Bob says hello, AI responds hi', 1234))
+print(asyncio.run(index.asearch_index('Bob says hello, AI responds hi')))
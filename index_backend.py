@@ -0,0 +1,125 @@
+import os
+from typing import List, Optional
+
+import faiss
+import numpy as np
+
+# Long term memory index tiers, a channel is promoted to the next one once its memory count passes the threshold:
+# flat: exact brute force search, used until HNSW_THRESHOLD memories
+# hnsw: graph search over the full vectors, kept in RAM
+# ivf_pq: inverted lists of product quantized codes, written to a file and memory-mapped instead of loaded,
+#         its distances are approximate so it returns RERANK_FACTOR times more candidates to rerank exactly
+FLAT = "flat"
+HNSW = "hnsw"
+IVF_PQ = "ivf_pq"
+TIERS = [FLAT, HNSW, IVF_PQ]
+
+HNSW_THRESHOLD = int(os.environ.get("LONG_TERM_MEMORY_HNSW_THRESHOLD", 20000))
+IVF_PQ_THRESHOLD = int(os.environ.get("LONG_TERM_MEMORY_IVF_PQ_THRESHOLD", 200000))
+
+HNSW_NEIGHBORS = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+IVF_PQ_SUBQUANTIZERS = 96
+IVF_PQ_BITS = 8
+IVF_PQ_NPROBE = 16
+IVF_PQ_MAX_TRAINING_VECTORS = 100000
+RERANK_FACTOR = 8
+# The first four bytes faiss writes for an IndexIVFPQ
+IVF_PQ_FOURCC = b"IvPQ"
+
+
+def kind_for(memory_count: int) -> str:
+    if memory_count >= IVF_PQ_THRESHOLD:
+        return IVF_PQ
+    if memory_count >= HNSW_THRESHOLD:
+        return HNSW
+    return FLAT
+
+
+# Returns None for indexes that aren't id mapped (positional snapshots from before memory ids were stored)
+def kind_of(index: faiss.Index) -> Optional[str]:
+    if isinstance(index, faiss.IndexIVFPQ):
+        return IVF_PQ
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        if isinstance(faiss.downcast_index(index.index), faiss.IndexHNSW):
+            return HNSW
+        return FLAT
+    return None
+
+
+def is_memory_mapped(kind: str) -> bool:
+    return kind == IVF_PQ
+
+
+def is_approximate(kind: str) -> bool:
+    return kind == IVF_PQ
+
+
+def candidate_count(kind: str, k: int) -> int:
+    return k * RERANK_FACTOR if is_approximate(kind) else k
+
+
+def create(kind: str, dimension: int, embeddings: Optional[np.ndarray] = None) -> faiss.Index:
+    # IVF-PQ needs its coarse centroids and codebooks trained, so it takes the embeddings it will be built from
+    if kind == HNSW:
+        hnsw_index = faiss.IndexHNSWFlat(dimension, HNSW_NEIGHBORS)
+        hnsw_index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        hnsw_index.hnsw.efSearch = HNSW_EF_SEARCH
+        return faiss.IndexIDMap2(hnsw_index)
+    if kind == IVF_PQ:
+        assert embeddings is not None
+        lists = max(1, min(int(4 * np.sqrt(len(embeddings))), len(embeddings) // 39))
+        quantizer = faiss.IndexFlatL2(dimension)
+        ivf_index = faiss.IndexIVFPQ(quantizer, dimension, lists, IVF_PQ_SUBQUANTIZERS, IVF_PQ_BITS)
+        if len(embeddings) > IVF_PQ_MAX_TRAINING_VECTORS:
+            sample = np.random.default_rng(0).choice(len(embeddings), IVF_PQ_MAX_TRAINING_VECTORS, replace=False)
+            ivf_index.train(embeddings[np.sort(sample)])
+        else:
+            ivf_index.train(embeddings)
+        ivf_index.nprobe = IVF_PQ_NPROBE
+        return ivf_index
+    return faiss.IndexIDMap(faiss.IndexFlatL2(dimension))
+
+
+def build(kind: str, dimension: int, ids: List[int], embeddings: np.ndarray) -> faiss.Index:
+    index = create(kind, dimension, embeddings)
+    if len(embeddings):
+        index.add_with_ids(embeddings, np.array(ids, dtype='int64'))
+    return index
+
+
+def read(path: str) -> faiss.Index:
+    # Only the IVF-PQ tier is memory-mapped, the in RAM tiers are read whole since new memories are added to them
+    with open(path, 'rb') as index_file:
+        fourcc = index_file.read(4)
+    if fourcc == IVF_PQ_FOURCC:
+        return read_memory_mapped(path)
+    return faiss.read_index(path)
+
+
+def read_memory_mapped(path: str) -> faiss.Index:
+    index = faiss.read_index(path, faiss.IO_FLAG_MMAP)
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = IVF_PQ_NPROBE
+    return index
+
+
+def write(index: faiss.Index, path: str) -> None:
+    # Written next to the destination then renamed over it, readers that still map the old file keep working
+    temporary_path = path + ".tmp"
+    faiss.write_index(index, temporary_path)
+    os.replace(temporary_path, path)
+
+
+def search(indexes: List[faiss.Index], query: np.ndarray, k: int):
+    # Searches each index and merges the hits by distance, used to search a memory-mapped base and its in RAM delta
+    results = [index.search(query, k) for index in indexes if index.ntotal > 0]
+    if not results:
+        return np.full((1, k), np.inf, dtype='float32'), np.full((1, k), -1, dtype='int64')
+    if len(results) == 1:
+        return results[0]
+    distances = np.concatenate([result[0] for result in results], axis=1)
+    ids = np.concatenate([result[1] for result in results], axis=1)
+    order = np.argsort(distances, axis=1)[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
@@ -0,0 +1,95 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import index_backend
+
+# Recall@10 and per query latency of each long term memory index tier against exact flat search,
+# on synthetic clustered vectors shaped like ada-002 embeddings.
+
+
+def synthetic_embeddings(count: int, dimension: int, clusters: int, rng) -> np.ndarray:
+    centers = rng.standard_normal((clusters, dimension)).astype('float32')
+    assignments = rng.integers(0, clusters, count)
+    vectors = centers[assignments] + 0.5 * rng.standard_normal((count, dimension)).astype('float32')
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype('float32')
+
+
+def measure(index, queries: np.ndarray, k: int):
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), k)
+        latencies.append(time.perf_counter() - start)
+        results.append(ids[0])
+    return np.array(results), np.array(latencies)
+
+
+def measure_reranked(index, queries: np.ndarray, embeddings: np.ndarray, k: int):
+    # What DocumentIndex does for approximate tiers: take more candidates, rerank them by exact distance
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), index_backend.candidate_count(index_backend.IVF_PQ, k))
+        candidates = ids[0][ids[0] != -1]
+        distances = np.sum((embeddings[candidates - 1] - query) ** 2, axis=1)
+        results.append(candidates[np.argsort(distances)[:k]])
+        latencies.append(time.perf_counter() - start)
+    return np.array(results), np.array(latencies)
+
+
+def report(name: str, build_seconds: str, results: np.ndarray, ground_truth: np.ndarray, latencies: np.ndarray) -> None:
+    print(f"{name:14} {build_seconds:>9} {recall(results, ground_truth):10.3f} {np.percentile(latencies, 50) * 1000:8.2f} {np.percentile(latencies, 99) * 1000:8.2f}")
+
+
+def recall(results: np.ndarray, ground_truth: np.ndarray) -> float:
+    hits = sum(len(set(result) & set(truth)) for result, truth in zip(results, ground_truth))
+    return hits / ground_truth.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark long term memory index tiers against flat search")
+    parser.add_argument("--memories", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--clusters", type=int, default=200)
+    args = parser.parse_args()
+    k = 10
+
+    rng = np.random.default_rng(0)
+    embeddings = synthetic_embeddings(args.memories + args.queries, args.dimension, args.clusters, rng)
+    embeddings, queries = embeddings[:args.memories], embeddings[args.memories:]
+    ids = list(range(1, args.memories + 1))
+
+    flat_index = index_backend.build(index_backend.FLAT, args.dimension, ids, embeddings)
+    ground_truth, flat_latencies = measure(flat_index, queries, k)
+
+    print(f"{args.memories} memories, {args.queries} queries, dimension {args.dimension}")
+    print(f"{'tier':14} {'build s':>9} {'recall@10':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    report(index_backend.FLAT, "", ground_truth, ground_truth, flat_latencies)
+    for kind in [index_backend.HNSW, index_backend.IVF_PQ]:
+        start = time.perf_counter()
+        index = index_backend.build(kind, args.dimension, ids, embeddings)
+        build_seconds = f"{time.perf_counter() - start:.2f}"
+        with tempfile.TemporaryDirectory() as work_dir:
+            if index_backend.is_memory_mapped(kind):
+                # Search the index the way it is served, from the memory-mapped file
+                path = os.path.join(work_dir, "benchmark.faiss")
+                index_backend.write(index, path)
+                index = index_backend.read_memory_mapped(path)
+            results, latencies = measure(index, queries, k)
+            report(kind, build_seconds, results, ground_truth, latencies)
+            if index_backend.is_approximate(kind):
+                results, latencies = measure_reranked(index, queries, embeddings, k)
+                report(kind + "+rerank", "", results, ground_truth, latencies)
+            del index
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import asyncio
+import itertools
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, List, Optional, Tuple
+
+# Priority classes of outbound OpenAI calls, lower runs first:
+# interactive: the reply a user is waiting on (and moderation, which gates it)
+# retrieval: the retriever, long term memory searches and web result extraction feeding that reply
+# summarization: background conversation summaries
+# long_term_commit: folding summaries into long term memory
+# shadow: router agreement checks, only worth running when nothing else is
+INTERACTIVE = 0
+RETRIEVAL = 1
+SUMMARIZATION = 2
+LONG_TERM_COMMIT = 3
+SHADOW = 4
+CLASS_NAMES = ["interactive", "retrieval", "summarization", "long_term_commit", "shadow"]
+
+MAX_CONCURRENT_CALLS = int(os.environ.get("LLM_MAX_CONCURRENT_CALLS", 16))
+CLASS_CONCURRENCY = [MAX_CONCURRENT_CALLS, 8, 2, 1, 1]
+TOKENS_PER_MINUTE = int(os.environ.get("LLM_TOKENS_PER_MINUTE", 200000))
+# Lower classes only start while the last minute's tokens are under this share of TOKENS_PER_MINUTE, which keeps
+# headroom for replies
+CLASS_TOKEN_SHARE = [1.0, 1.0, 0.7, 0.5, 0.3]
+DEFAULT_ESTIMATED_TOKENS = [2000, 1000, 1500, 1000, 1000]
+
+
+class LLMScheduler:
+    def __init__(self) -> None:
+        # (priority, sequence, estimated tokens, future), granted in priority then arrival order
+        self.waiters: List[Tuple[int, int, int, asyncio.Future]] = []
+        self.sequence = itertools.count()
+        self.in_flight = 0
+        self.class_in_flight = [0] * len(CLASS_NAMES)
+        self.token_log: Deque[Tuple[float, int]] = deque()
+        self.tokens_in_window = 0
+        self.wakeup: Optional[asyncio.TimerHandle] = None
+        self.calls = [0] * len(CLASS_NAMES)
+        self.total_wait = [0.0] * len(CLASS_NAMES)
+        self.max_wait = [0.0] * len(CLASS_NAMES)
+
+    @asynccontextmanager
+    async def slot(self, priority: int, estimated_tokens: Optional[int] = None):
+        await self.acquire(priority, estimated_tokens)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    async def acquire(self, priority: int, estimated_tokens: Optional[int] = None) -> None:
+        if estimated_tokens is None:
+            estimated_tokens = DEFAULT_ESTIMATED_TOKENS[priority]
+        enqueued = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((priority, next(self.sequence), estimated_tokens, future))
+        self.__dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as the caller was cancelled
+                self.release(priority)
+            else:
+                self.waiters = [waiter for waiter in self.waiters if waiter[3] is not future]
+            raise
+        waited = time.monotonic() - enqueued
+        self.calls[priority] += 1
+        self.total_wait[priority] += waited
+        self.max_wait[priority] = max(self.max_wait[priority], waited)
+
+    def release(self, priority: int) -> None:
+        self.in_flight -= 1
+        self.class_in_flight[priority] -= 1
+        self.__dispatch()
+
+    def stats(self) -> Dict[str, float]:
+        stats: Dict[str, float] = {
+            "in_flight": self.in_flight,
+            "waiting": len(self.waiters),
+            "tokens_last_minute": self.tokens_in_window,
+        }
+        for priority, name in enumerate(CLASS_NAMES):
+            stats[name + "_calls"] = self.calls[priority]
+            stats[name + "_avg_wait_ms"] = (self.total_wait[priority] / self.calls[priority] * 1000) if self.calls[priority] else 0.0
+            stats[name + "_max_wait_ms"] = self.max_wait[priority] * 1000
+        return stats
+
+    def __dispatch(self) -> None:
+        now = time.monotonic()
+        while self.token_log and now - self.token_log[0][0] >= 60:
+            self.tokens_in_window -= self.token_log.popleft()[1]
+        self.waiters.sort(key=lambda waiter: (waiter[0], waiter[1]))
+        remaining = []
+        token_blocked = False
+        for waiter in self.waiters:
+            priority, _, estimated_tokens, future = waiter
+            if future.done():
+                continue
+            if token_blocked or self.in_flight >= MAX_CONCURRENT_CALLS or self.class_in_flight[priority] >= CLASS_CONCURRENCY[priority]:
+                remaining.append(waiter)
+                continue
+            # An empty window always admits one call, so a single large estimate can't block forever
+            if self.tokens_in_window and self.tokens_in_window + estimated_tokens > TOKENS_PER_MINUTE * CLASS_TOKEN_SHARE[priority]:
+                # Nothing of lower priority may overtake a call waiting on the token budget
+                token_blocked = True
+                remaining.append(waiter)
+                continue
+            self.in_flight += 1
+            self.class_in_flight[priority] += 1
+            self.token_log.append((now, estimated_tokens))
+            self.tokens_in_window += estimated_tokens
+            future.set_result(None)
+        self.waiters = remaining
+        if token_blocked and self.wakeup is None and self.token_log:
+            # Try again once the oldest tokens leave the window
+            def wake():
+                self.wakeup = None
+                self.__dispatch()
+            self.wakeup = asyncio.get_running_loop().call_later(max(0.0, 60 - (now - self.token_log[0][0])), wake)
+
+
+llm_scheduler = LLMScheduler()
@@ -0,0 +1,399 @@
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import itertools
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+from aiohttp import web
+
+from openai_stub_server import OpenAIStubServer
+
+# Replays synthetic multi-channel Discord traffic through main.on_message, process_queue and queue_on_message with
+# every outside service stood in for locally: fake Discord users, channels and messages, a stub OpenAI server (chat,
+# moderation) that also serves a fake Bing search API and the pages it links to, and a deterministic embedder.
+# Reports throughput, reply and per stage latency percentiles, LLM calls and SQLite statements per message.
+#
+# The tokenizer still needs tiktoken's vocabulary, offline it must already be in TIKTOKEN_CACHE_DIR.
+
+DIMENSION = 1536
+TOPICS = ["rust lifetimes", "sourdough starters", "the mars rover", "interest rates", "marathon training", "jazz chords",
+          "the new zelda game", "home espresso", "kubernetes upgrades", "the champions league final"]
+MESSAGE_TEMPLATES = {
+    "greeting": ["hey {bot}", "thanks {bot}!", "lol nice {bot}"],
+    "question": ["{bot} what do you think about {topic}?", "{bot} can you explain {topic} to me like I'm five?",
+                 "{bot} what would you recommend for someone getting into {topic}?"],
+    "recall": ["{bot} do you remember what we said about {topic} earlier?", "{bot} what did I tell you about {topic} last time?"],
+    "news": ["{bot} what's the latest news on {topic}?"],
+    "code": ["{bot} can you write a python function for {topic}?"],
+    "chatter": ["has anyone tried {topic}?", "I've been reading about {topic} all week", "honestly {topic} is overrated",
+                "ok but what about {topic}", "brb, {topic} emergency"],
+}
+MENTION_KINDS = ["greeting", "question", "question", "recall", "news", "code"]
+
+
+class TrafficProfile:
+    def __init__(self, name: str, channels: int, messages_per_channel: int, messages_per_second: float, mention_fraction: float, users_per_channel: int = 4) -> None:
+        self.name = name
+        self.channels = channels
+        self.messages_per_channel = messages_per_channel
+        # Per channel, arrivals are Poisson
+        self.messages_per_second = messages_per_second
+        self.mention_fraction = mention_fraction
+        self.users_per_channel = users_per_channel
+
+
+PROFILES = {
+    "quiet": TrafficProfile("quiet", channels=4, messages_per_channel=15, messages_per_second=0.5, mention_fraction=0.3),
+    "busy": TrafficProfile("busy", channels=16, messages_per_channel=30, messages_per_second=2.0, mention_fraction=0.2),
+    "burst": TrafficProfile("burst", channels=8, messages_per_channel=30, messages_per_second=10.0, mention_fraction=0.5),
+}
+
+
+class FakeUser:
+    ids = itertools.count(1000)
+
+    def __init__(self, name: str, discriminator: str) -> None:
+        self.id = next(FakeUser.ids)
+        self.name = name
+        self.discriminator = discriminator
+
+    def __repr__(self) -> str:
+        return f"<FakeUser {self.name}#{self.discriminator}>"
+
+
+class FakeMessage:
+    ids = itertools.count(1)
+
+    def __init__(self, author: FakeUser, channel: "FakeChannel", content: str, mentions: List[FakeUser]) -> None:
+        self.id = next(FakeMessage.ids)
+        self.author = author
+        self.channel = channel
+        self.content = content
+        self.mentions = mentions
+
+    async def edit(self, content: str) -> None:
+        self.content = content
+        self.channel.harness.edits += 1
+
+    async def delete(self) -> None:
+        self.channel.harness.deletes += 1
+
+    def __repr__(self) -> str:
+        return f"<FakeMessage {self.id} {self.author.name}: {self.content[:40]!r}>"
+
+
+class FakeChannel:
+    def __init__(self, harness: "LoadHarness", channel_id: int, members: List[FakeUser]) -> None:
+        self.harness = harness
+        self.id = channel_id
+        self.members = members
+        # Arrival times of mentions not answered yet
+        self.pending_mentions: List[float] = []
+
+    async def send(self, content: str) -> FakeMessage:
+        message = FakeMessage(self.harness.bot, self, content, [])
+        self.harness.sent += 1
+        now = time.perf_counter()
+        for arrived in self.pending_mentions:
+            self.harness.stage_latencies["reply_visible"].append(now - arrived)
+        self.pending_mentions = []
+        # Discord echoes the bot's own messages back through on_message
+        self.harness.deliver(message)
+        return message
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        yield
+
+
+class DeterministicEmbeddings:
+    # Stands in for OpenAIEmbeddings, the same text always gets the same unit vector
+    def __init__(self, latency_seconds: float = 0.0) -> None:
+        self.model = "text-embedding-ada-002"
+        self.latency_seconds = latency_seconds
+        self.calls = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        return [self.__embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self.calls += 1
+        return self.__embed(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency_seconds)
+        return self.embed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        await asyncio.sleep(self.latency_seconds)
+        return self.embed_query(text)
+
+    def __embed(self, text: str) -> List[float]:
+        rng = np.random.default_rng(int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little"))
+        vector = rng.standard_normal(DIMENSION).astype('float32')
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+class HarnessStubServer(OpenAIStubServer):
+    # Answers the retriever prompt with tools picked from the last message, so replies exercise every retrieval path,
+    # and serves Bing search results pointing back at its own pages
+    RETRIEVER_MARKER = "You are an information retrieval bot"
+
+    def add_routes(self, app: web.Application) -> None:
+        super().add_routes(app)
+        app.router.add_get("/bing/v7.0/search", self.bing_search)
+        app.router.add_get("/pages/{page}", self.page)
+
+    @property
+    def bing_search_url(self) -> str:
+        return f"{self.scheme}://127.0.0.1:{self.port}/bing/v7.0/search"
+
+    def completion_for(self, body: dict) -> str:
+        prompt = body["messages"][-1]["content"] if body.get("messages") else ''
+        if self.RETRIEVER_MARKER not in prompt:
+            return super().completion_for(body)
+        last_message = prompt.strip().split('\n')[-1].lower()
+        tools = ['SummarizedMemory[]']
+        if "remember" in last_message or "last time" in last_message:
+            tools.append('LongTermMemory["' + last_message[-40:].replace('"', '') + '"]')
+        if "news" in last_message or "latest" in last_message:
+            tools.append('WebSearch["' + last_message[-40:].replace('"', '') + '"]')
+        return "Thought: synthetic\nTools:\n" + "\n".join(tools + ["Answer[]"])
+
+    async def bing_search(self, request: web.Request) -> web.Response:
+        await self.delay(request)
+        query = request.query.get("q", "")
+        values = [{
+            "id": f"result-{i}", "name": f"{query} result {i}", "url": f"{self.scheme}://127.0.0.1:{self.port}/pages/{i}",
+            "displayUrl": f"example.com/{i}", "snippet": f"Synthetic snippet {i} about {query}.", "dateLastCrawled": "2024-01-01T00:00:00Z",
+            "language": "en", "isNavigational": False,
+        } for i in range(3)]
+        return web.json_response({"webPages": {"value": values}})
+
+    async def page(self, request: web.Request) -> web.Response:
+        await self.delay(request)
+        paragraphs = "".join(f"<p>Synthetic page {request.match_info['page']} paragraph {i}.</p>" for i in range(50))
+        return web.Response(text=f"<html><body>{paragraphs}</body></html>", content_type="text/html")
+
+
+class StatementCounter:
+    # Counts SQLite statements by their first keyword, across the event loop and the write-behind thread
+    def __init__(self) -> None:
+        self.counts: Counter = Counter()
+        self.lock = threading.Lock()
+
+    def install(self, connection_manager) -> None:
+        open_connection = connection_manager.open
+        def counting_open(db_path: str):
+            connection = open_connection(db_path)
+            connection.set_trace_callback(self.trace)
+            return connection
+        connection_manager.open = counting_open
+
+    def trace(self, statement: str) -> None:
+        keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+        with self.lock:
+            self.counts[keyword] += 1
+
+    def reads(self) -> int:
+        return self.counts["SELECT"]
+
+    def writes(self) -> int:
+        return self.counts["INSERT"] + self.counts["UPDATE"] + self.counts["DELETE"]
+
+
+class LoadHarness:
+    def __init__(self, main, profile: TrafficProfile, seed: int) -> None:
+        self.main = main
+        self.profile = profile
+        self.random = random.Random(seed)
+        self.bot = FakeUser(main.DISCORD_NAME, "0001")
+        self.stage_latencies: Dict[str, List[float]] = {"reply_visible": []}
+        self.deliveries: set = set()
+        self.user_messages = 0
+        self.mentions = 0
+        self.sent = 0
+        self.edits = 0
+        self.deletes = 0
+
+    def deliver(self, message: FakeMessage) -> None:
+        task = asyncio.create_task(self.main.on_message(message))
+        self.deliveries.add(task)
+        task.add_done_callback(self.deliveries.discard)
+
+    def time_stage(self, owner, attribute: str, stage: str) -> None:
+        # Wraps owner.attribute (a module function, a method on a class or on an instance) to record its latency
+        original = getattr(owner, attribute)
+        latencies = self.stage_latencies.setdefault(stage, [])
+        if asyncio.iscoroutinefunction(original):
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    latencies.append(time.perf_counter() - start)
+        else:
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    latencies.append(time.perf_counter() - start)
+        setattr(owner, attribute, timed)
+
+    def instrument(self) -> None:
+        from prompt_assembler import PromptAssembler
+        from repository import Repository
+        from retrieval_executor import RetrievalExecutor
+        main = self.main
+        self.time_stage(main, "handle_messages", "handle_messages")
+        self.time_stage(main.moderation_service, "violates_content_policy", "moderation")
+        self.time_stage(main.retrieval_router, "arun", "routing")
+        self.time_stage(RetrievalExecutor, "run", "retrieval")
+        self.time_stage(PromptAssembler, "assemble", "prompt_assembly")
+        self.time_stage(main, "run_chain", "reply_chain")
+        self.time_stage(Repository, "summarize_conversation", "summarization")
+
+    async def run(self) -> float:
+        channels = []
+        for channel_index in range(self.profile.channels):
+            users = [FakeUser(f"user{channel_index}_{i}", f"{i:04d}") for i in range(self.profile.users_per_channel)]
+            channels.append(FakeChannel(self, 900000 + channel_index, users + [self.bot]))
+        start = time.perf_counter()
+        await asyncio.gather(*[self.__replay_channel(channel) for channel in channels])
+        await self.__drain()
+        return time.perf_counter() - start
+
+    async def __replay_channel(self, channel: FakeChannel) -> None:
+        rng = random.Random(self.random.random())
+        users = [member for member in channel.members if member is not self.bot]
+        for _ in range(self.profile.messages_per_channel):
+            await asyncio.sleep(rng.expovariate(self.profile.messages_per_second))
+            mentioned = rng.random() < self.profile.mention_fraction
+            kind = rng.choice(MENTION_KINDS) if mentioned else "chatter"
+            content = rng.choice(MESSAGE_TEMPLATES[kind]).format(bot=f"<@{self.bot.id}>", topic=rng.choice(TOPICS))
+            self.user_messages += 1
+            if mentioned:
+                self.mentions += 1
+                channel.pending_mentions.append(time.perf_counter())
+            self.deliver(FakeMessage(rng.choice(users), channel, content, [self.bot] if mentioned else []))
+
+    async def __drain(self) -> None:
+        # Until every queued message, echoed reply and debounced summary has been handled
+        while True:
+            if self.deliveries:
+                await asyncio.gather(*list(self.deliveries))
+            for conversation in list(self.main.conversations.values()):
+                await conversation.queue.join()
+            pending_summaries = list(self.main.summarization_scheduler.pending.values())
+            if pending_summaries:
+                await asyncio.gather(*pending_summaries, return_exceptions=True)
+            # Router agreement checks and long term memory commits run in tasks nobody awaits
+            background = [task for task in asyncio.all_tasks() if not task.done() and (task in self.main.retrieval_router.shadow_tasks
+                          or getattr(task.get_coro(), "__qualname__", "") == "Conversation.commit_to_long_term_memory")]
+            if not self.deliveries and not pending_summaries and not background:
+                break
+            if background:
+                await asyncio.wait(background, timeout=1)
+        await self.main.write_behind_queue.aflush()
+
+
+def percentiles(latencies: List[float]) -> str:
+    if not latencies:
+        return "no samples"
+    return (f"n {len(latencies):5d}, p50 {np.percentile(latencies, 50) * 1000:8.1f} ms, p95 {np.percentile(latencies, 95) * 1000:8.1f} ms, "
+            f"p99 {np.percentile(latencies, 99) * 1000:8.1f} ms")
+
+
+async def benchmark(args, work_dir: str) -> None:
+    profile = PROFILES[args.profile]
+    stub = HarnessStubServer(args.latency_ms / 1000, completion="Investigation results: none\nResponse: Synthetic reply", completion_tokens=args.completion_tokens,
+                             slow_fraction=args.slow_fraction, slow_latency_seconds=args.slow_latency_ms / 1000, seed=args.seed)
+    await stub.start()
+    os.environ["OPENAI_API_BASE"] = stub.api_base
+    os.environ["BING_SUBSCRIPTION_KEY"] = "load-benchmark"
+    os.environ["BING_SEARCH_URL"] = stub.bing_search_url
+    # WebExtractor only checks it is set, pages are fetched with requests
+    os.environ.setdefault("CHROME_DRIVER_PATH", "unused")
+    os.environ["STREAM_REPLIES"] = "1" if args.stream else "0"
+
+    import openai
+    openai.api_base = stub.api_base
+    from connection_manager import connection_manager
+    statements = StatementCounter()
+    statements.install(connection_manager)
+    from client_registry import client_registry
+    embeddings = DeterministicEmbeddings(args.embedding_latency_ms / 1000)
+    client_registry.embedding_models[embeddings.model] = embeddings
+    import main
+
+    harness = LoadHarness(main, profile, args.seed)
+    main.client_user = harness.bot
+    harness.instrument()
+    await client_registry.open_session()
+    from loop_watchdog import loop_watchdog
+    loop_watchdog.start()
+
+    print(f"Profile {profile.name}: {profile.channels} channels x {profile.messages_per_channel} messages at {profile.messages_per_second}/s, "
+          f"{profile.mention_fraction:.0%} mentions, {args.latency_ms:.0f} ms OpenAI latency, {args.completion_tokens} token completions")
+    bot_output = io.StringIO()
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else bot_output):
+        elapsed = await harness.run()
+    await loop_watchdog.stop()
+    await client_registry.close_session()
+    await stub.stop()
+
+    chat_calls = stub.requests_by_path.get("/v1/chat/completions", 0)
+    moderation_calls = stub.requests_by_path.get("/v1/moderations", 0)
+    messages = harness.user_messages
+    print(f"{messages} user messages ({harness.mentions} mentions) in {elapsed:.2f}s: {messages / elapsed:.1f} messages/s, "
+          f"{harness.sent} bot messages sent, {harness.edits} edits, {harness.deletes} deletes")
+    print("Latency per stage:")
+    for stage, latencies in harness.stage_latencies.items():
+        print(f"  {stage:16} {percentiles(latencies)}")
+    print(f"LLM calls per message: {chat_calls / messages:.2f} chat completions, {embeddings.calls / messages:.2f} embeddings, "
+          f"{moderation_calls / messages:.2f} moderation requests")
+    write_stats = main.write_behind_queue.stats()
+    print(f"SQLite per message: {statements.reads() / messages:.2f} reads, {statements.writes() / messages:.2f} writes, "
+          f"{write_stats['batches_flushed'] / messages:.2f} write-behind transactions")
+    print(f"Database files: {len([name for name in os.listdir(os.path.join(work_dir, 'conversations')) if name.endswith('.db')])}")
+    main.print_stats()
+    errors = len(re.findall(r"^Ignoring error", bot_output.getvalue(), re.MULTILINE))
+    if errors:
+        print(f"{errors} errors were logged, rerun with --verbose to see them")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay synthetic Discord traffic through the bot against local stand-ins for every service")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="busy")
+    parser.add_argument("--latency-ms", type=float, default=150)
+    parser.add_argument("--slow-fraction", type=float, default=0.0)
+    parser.add_argument("--slow-latency-ms", type=float, default=0)
+    parser.add_argument("--completion-tokens", type=int, default=60)
+    parser.add_argument("--embedding-latency-ms", type=float, default=20)
+    parser.add_argument("--no-stream", dest="stream", action="store_false")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own logging")
+    args = parser.parse_args()
+    os.environ.setdefault("OPENAI_API_KEY", "load-benchmark")
+    # Channel databases are created under the working directory
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        asyncio.run(benchmark(args, work_dir))
+
+
+if __name__ == "__main__":
+    main()
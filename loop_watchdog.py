@@ -0,0 +1,155 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, List, Optional
+
+from tracing import tracer
+
+REPOSITORY_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class StallSite:
+    __slots__ = ("site", "samples", "stalls", "last_stall", "stack")
+
+    def __init__(self, site: str, stack: List[str]) -> None:
+        self.site = site
+        self.samples = 0
+        self.stalls = 0
+        self.last_stall = -1
+        # The first stack seen blocking here, innermost frame last
+        self.stack = stack
+
+
+class LoopWatchdog:
+    # A heartbeat task measures how late the event loop wakes it up, every lag goes to the loop_lag histogram. While
+    # the heartbeat is overdue by more than STALL_THRESHOLD_SECONDS a sampler thread grabs the loop thread's stack every
+    # SAMPLE_INTERVAL_SECONDS and charges the sample to the innermost frame in this repository, the call that blocked
+    # the loop. Offenders are aggregated by that call site, logged to LOOP_WATCHDOG_LOG and reported by report().
+    HEARTBEAT_INTERVAL_SECONDS = 0.1
+    SAMPLE_INTERVAL_SECONDS = 0.02
+    STALL_THRESHOLD_SECONDS = float(os.environ.get("LOOP_STALL_THRESHOLD_SECONDS", 0.1))
+    LOG_PATH = os.environ.get("LOOP_WATCHDOG_LOG", "")
+
+    def __init__(self) -> None:
+        self.sites: Dict[str, StallSite] = {}
+        self.lock = threading.Lock()
+        self.loop_thread_id: Optional[int] = None
+        self.heartbeat_task: Optional[asyncio.Task] = None
+        self.sampler: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+        self.last_beat = time.monotonic()
+        self.stall_number = 0
+        self.in_stall = False
+        self.stalls = 0
+        self.stall_seconds = 0.0
+        self.max_lag = 0.0
+
+    def start(self) -> None:
+        if self.heartbeat_task is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.stopping.clear()
+        self.heartbeat_task = asyncio.get_running_loop().create_task(self.__heartbeat())
+        self.sampler = threading.Thread(target=self.__sample, name="loop-watchdog", daemon=True)
+        self.sampler.start()
+
+    async def stop(self) -> None:
+        self.stopping.set()
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            try:
+                await self.heartbeat_task
+            except asyncio.CancelledError:
+                pass
+            self.heartbeat_task = None
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "stalls": self.stalls,
+            "stall_seconds": self.stall_seconds,
+            "max_lag_ms": self.max_lag * 1000,
+            "stall_sites": len(self.sites),
+        }
+
+    def report(self, top: int = 10) -> str:
+        with self.lock:
+            sites = sorted(self.sites.values(), key=lambda site: site.samples, reverse=True)[:top]
+        if not sites:
+            return f"No event loop stalls over {self.STALL_THRESHOLD_SECONDS * 1000:.0f} ms"
+        lines = [f"{self.stalls} event loop stalls over {self.STALL_THRESHOLD_SECONDS * 1000:.0f} ms, {self.stall_seconds:.2f}s in total, "
+                 f"worst lag {self.max_lag * 1000:.0f} ms. Blocking call sites:"]
+        for site in sites:
+            lines.append(f"{site.samples * self.SAMPLE_INTERVAL_SECONDS * 1000:8.0f} ms in {site.stalls:4d} stalls  {site.site}")
+        return "\n".join(lines)
+
+    async def __heartbeat(self) -> None:
+        while True:
+            expected = time.monotonic() + self.HEARTBEAT_INTERVAL_SECONDS
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL_SECONDS)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.last_beat = now
+            tracer.observe("loop_lag", lag, channel='')
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.STALL_THRESHOLD_SECONDS:
+                self.stalls += 1
+                self.stall_seconds += lag
+
+    def __sample(self) -> None:
+        while not self.stopping.wait(self.SAMPLE_INTERVAL_SECONDS):
+            overdue = time.monotonic() - self.last_beat - self.HEARTBEAT_INTERVAL_SECONDS
+            if overdue <= self.STALL_THRESHOLD_SECONDS:
+                self.in_stall = False
+                continue
+            if not self.in_stall:
+                self.in_stall = True
+                self.stall_number += 1
+            frame = sys._current_frames().get(self.loop_thread_id) if self.loop_thread_id is not None else None
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            self.__record(stack, overdue)
+
+    def __record(self, stack: traceback.StackSummary, overdue: float) -> None:
+        # The innermost frame in this repository is the call to move off the loop, the library frames under it are
+        # only how it blocks
+        culprit = stack[-1]
+        for frame in reversed(stack):
+            if frame.filename.startswith(REPOSITORY_DIR) and not frame.filename.endswith(os.sep + "loop_watchdog.py"):
+                culprit = frame
+                break
+        site = f"{os.path.relpath(culprit.filename, REPOSITORY_DIR) if culprit.filename.startswith(REPOSITORY_DIR) else culprit.filename}:{culprit.lineno} in {culprit.name}"
+        with self.lock:
+            stall_site = self.sites.get(site)
+            new_site = stall_site is None
+            if stall_site is None:
+                stall_site = self.sites[site] = StallSite(site, [line.rstrip() for line in traceback.format_list(stack)])
+            stall_site.samples += 1
+            first_in_stall = stall_site.last_stall != self.stall_number
+            if first_in_stall:
+                stall_site.last_stall = self.stall_number
+                stall_site.stalls += 1
+        # One line per call site and stall, with the stack the first time the site shows up
+        if self.LOG_PATH and first_in_stall:
+            self.__log(stall_site, overdue, new_site)
+
+    def __log(self, stall_site: StallSite, overdue: float, new_site: bool) -> None:
+        try:
+            with open(self.LOG_PATH, "a") as log:
+                log.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} loop blocked {overdue * 1000:.0f} ms at {stall_site.site}"
+                          f" ({stall_site.samples} samples in {stall_site.stalls} stalls)\n")
+                if new_site:
+                    log.write("".join(line + "\n" for line in stall_site.stack))
+        except OSError as e:
+            print("Failed to write the loop watchdog log: " + str(e))
+
+
+loop_watchdog = LoopWatchdog()
@@ -1,47 +1,44 @@
 import traceback
-from typing import Dict, Set
+from typing import Dict, Optional, Set
 from builtins import Exception, int, isinstance, len, print, set, str
 import asyncio
 import os
 import pprint
 import random
-from memory_retriever import MemoryRetriever
 from web_searcher import WebSearcher
 import time
 
 import discord
 from discord import DMChannel, TextChannel
-from langchain.chains import LLMChain
-from langchain.chat_models import ChatOpenAI
 from langchain.prompts.chat import ChatPromptTemplate
 
+from client_registry import client_registry
+from connection_manager import connection_manager
 from conversation import Conversation
+from embedding_cache import embedding_cache
+from llm_scheduler import INTERACTIVE, llm_scheduler
+from loop_watchdog import loop_watchdog
+from memory_retriever import MemoryRetriever
 from message import Message
+from moderation import moderation_service
+from prompt_assembler import CONVERSATION_CONTEXT, LATEST_MESSAGES, LONG_TERM_MEMORY, SEARCH_RESULTS, PromptAssembler
 from repository import Repository
-from utils import format_discord_mentions, get_formatted_date, scold, truncate_text
+from request_policy import request_policy
+from summarization_scheduler import summarization_scheduler
+from token_ledger import NO_GPT_4, NO_WEB_SEARCH, OVER_BUDGET, token_ledger
+from tracing import tracer
+from write_behind import write_behind_queue
+from tokenizer import count_tokens, truncate_text
+from reply_streamer import stream_reply
+from retrieval_executor import RetrievalExecutor
+from retrieval_router import retrieval_router
+from utils import clean_up_response, format_discord_mentions, get_formatted_date, scold, split_message
 from web_searcher import WebSearcher
 
 DISCORD_NAME = 'EhrlichGPT'
 
-def clean_up_response(discord_name, original_response):
-    print(f"Original response: {original_response}")
-    search_term = "Response:"
-    start_index = original_response.find(search_term)
-    response = ""
-    if start_index != -1:
-        response_start = start_index + len(search_term)
-        response = original_response[response_start:].strip()
-        response = response.strip('\"')
-    else:
-        response = original_response
-    if response.startswith(discord_name + ":"):
-        response = response[len(discord_name + ":"):]
-    elif response.startswith("AI:"):
-        response = response[len("AI:"):]
-    return response.strip()
-
 async def run_chain(channel, chain, discord_context, conversation_context, long_term_memory, search_results, latest_messages):
-    response = await chain.arun(
+    inputs = dict(
         discord_name=DISCORD_NAME,
         discord_context=discord_context,
         conversation_context=conversation_context,
@@ -50,30 +47,46 @@ async def run_chain(channel, chain, discord_context, conversation_context, long_
         current_date=get_formatted_date(),
         latest_messages=latest_messages,
     )
+    estimated_tokens = count_tokens(conversation_context + long_term_memory + search_results + latest_messages) + (chain.llm.max_tokens or 0)
+    if STREAM_REPLIES:
+        # Our own messages are handled after this reply finishes, by then they should be recorded with their final
+        # content, or what was sent of them if it failed
+        with tracer.span("reply_chain", chain.llm.model_name):
+            _, completion = await stream_reply(chain.llm, chain.prompt.format_prompt(**inputs).to_messages(), channel, DISCORD_NAME,
+                                               lambda attempt: request_policy("reply").run(attempt, INTERACTIVE, estimated_tokens),
+                                               lambda partial_completion: token_ledger.record_chain("run_chain", chain, inputs, partial_completion),
+                                               streamed_reply_contents)
+        token_ledger.record_chain("run_chain", chain, inputs, completion)
+        return
+    with tracer.span("reply_chain", chain.llm.model_name):
+        # Abandoned attempts are charged their prompt, what they completed before they failed is unknown
+        response = await request_policy("reply").run(lambda: chain.arun(**inputs), INTERACTIVE, estimated_tokens,
+                                                      lambda: token_ledger.record_chain("run_chain", chain, inputs, ''))
+    token_ledger.record_chain("run_chain", chain, inputs, response)
 
     response = clean_up_response(DISCORD_NAME, response)
-    message_to_send = response[:2000]
-    print(f"Sending message: {message_to_send}")
-    await channel.send(message_to_send)
+    print(f"Sending message: {response}")
+    with tracer.span("discord_send"):
+        for part in split_message(response):
+            await channel.send(part)
 
 def get_chat_llm(temperature=0.8, max_tokens=500, gpt_version=3):
     if gpt_version == 4:
-        chat_llm = ChatOpenAI(temperature=temperature, max_tokens=max_tokens, model='gpt-4o')
+        chat_llm = client_registry.chat_model('gpt-4o', temperature, max_tokens)
     else:
-        chat_llm = ChatOpenAI(temperature=temperature, max_tokens=max_tokens, model="gpt-4o-mini")
+        chat_llm = client_registry.chat_model("gpt-4o-mini", temperature, max_tokens)
     return chat_llm
 
-def load_conversation(channel_id):
+async def load_conversation(channel_id):
     repository = Repository(channel_id)
-    messages = repository.load_messages()
-    conversation_context = repository.load_conversation_context()
+    messages = await repository.aload_messages()
+    conversation_context = await repository.aload_conversation_context()
     long_term_memory = ''
     conversation = Conversation(channel_id, [], conversation_context, long_term_memory)
     for sender, content in messages:
         conversation.add_message(Message(sender, content, int(time.time())))
     return conversation
 
-discord_bot_key = os.environ['DISCORD_BOT_TOKEN']
 intents = discord.Intents.default()
 intents.message_content = True
 paused = False
@@ -81,40 +94,108 @@ paused = False
 # TODO: Make this configurable
 admin = 'adotout#7295'
 
-client = discord.Client(intents=intents)
+class EhrlichClient(discord.Client):
+    async def setup_hook(self):
+        # Runs in the task that dispatches every event, so all of them share the keep-alive session
+        await client_registry.open_session()
+        await tracer.start_server()
+        loop_watchdog.start()
+
+    async def close(self):
+        await super().close()
+        await client_registry.close_session()
+        await tracer.stop_server()
+        await loop_watchdog.stop()
+
+client = EhrlichClient(intents=intents)
 client_user = None
 conversations: Dict[int, Conversation] = {}
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "1") == "1"
+# Final content of streamed reply messages by message id, None for ones deleted when the reply got shorter
+streamed_reply_contents: Dict[int, Optional[str]] = {}
 global_message_lock: asyncio.Lock = asyncio.Lock()
+MENTION_COALESCING_WINDOW_SECONDS = float(os.environ.get("MENTION_COALESCING_WINDOW_SECONDS", 0))
+# The retriever and the response chain, what each reply folded into another one doesn't spend
+LLM_CALLS_PER_REPLY = 2
+coalescing_stats = {"mentions": 0, "replies": 0, "llm_calls_saved": 0}
+# When each channel over its budget was last told so, it is told at most once per BUDGET_NOTICE_INTERVAL_SECONDS
+BUDGET_NOTICE_INTERVAL_SECONDS = 3600
+budget_notices_sent: Dict[int, float] = {}
 
 os.makedirs("conversations", exist_ok=True)
 
 async def process_queue(conversation):
     while True:
         try:
-            message = await conversation.queue.get()
-            await queue_on_message(message)
-            conversation.queue.task_done()
+            queued = [await conversation.queue.get()]
+            # Without a coalescing window every message is handled, and answered, on its own
+            if MENTION_COALESCING_WINDOW_SECONDS > 0:
+                if is_at_mentioned(queued[0][1]):
+                    # Give a burst of mentions a moment to arrive so they get one reply
+                    await asyncio.sleep(MENTION_COALESCING_WINDOW_SECONDS)
+                while not conversation.queue.empty():
+                    queued.append(conversation.queue.get_nowait())
+            messages = [message for _, message in queued]
+            try:
+                with tracer.trace(conversation.conversation_id):
+                    dequeued = time.perf_counter()
+                    for enqueued, _ in queued:
+                        tracer.observe("queue_wait", dequeued - enqueued)
+                    await handle_messages(conversation, messages)
+            finally:
+                for _ in messages:
+                    conversation.queue.task_done()
         except Exception as e:
             print("Ignoring error on_message: " + str(e))
             traceback.print_exc()
         except asyncio.CancelledError:
             break
 
-async def queue_on_message(message):
+def is_at_mentioned(message):
+    if client_user in message.mentions:
+        return True
+    if "<@" + str(client_user.id) + ">" in message.content:
+        return True
+    return isinstance(message.channel, DMChannel)
+
+async def handle_messages(conversation, messages):
+    # Everything pending in the channel is moderated in one go, saved in order, and answered with a single reply
+    moderation = {}
+    if not paused:
+        user_messages = [message for message in messages if message.author != client_user]
+        with tracer.span("moderation"):
+            verdicts = await asyncio.gather(*[Message.violates_content_policy(message.content) for message in user_messages])
+        moderation = {message.id: verdict for message, verdict in zip(user_messages, verdicts)}
+    reply_requests = []
+    for message in messages:
+        reply_request = await queue_on_message(message, moderation.get(message.id))
+        if reply_request is not None:
+            reply_requests.append(reply_request)
+    if not reply_requests:
+        return
+    coalescing_stats["mentions"] += len(reply_requests)
+    coalescing_stats["replies"] += 1
+    coalescing_stats["llm_calls_saved"] += (len(reply_requests) - 1) * LLM_CALLS_PER_REPLY
+    context, channel, inbound_message, _ = reply_requests[-1]
+    if len(reply_requests) > 1:
+        senders = [message.author.name + "#" + message.author.discriminator for _, _, message, _ in reply_requests]
+        context += ". Since your last reply you were mentioned by " + ", ".join(senders) + ", answer all of them in one response"
+    # Later messages in the batch may not mention us, the reply is to these
+    answered = [conversation_message for _, _, _, conversation_message in reply_requests]
+    await send_message_with_typing_indicator(conversation, context, channel, inbound_message, answered)
+
+async def queue_on_message(message, violates_rules=None):
+    # Returns (discord context, channel, message, the Message added to the conversation) when the message needs a
+    # reply, violates_rules is the moderation verdict if handle_messages already has it
     global paused, conversations, client_user
     pprint.pprint(message)
     channel_id = message.channel.id
     repository = Repository(channel_id)
     formatted_sender = message.author.name + "#" + message.author.discriminator
-    at_mentioned = False
-    if client_user in message.mentions:
-        at_mentioned = True
-    if "<@" + str(client_user.id) + ">" in message.content:
-        at_mentioned = True
+    at_mentioned = is_at_mentioned(message)
 
     if isinstance(message.channel, DMChannel):
         context = "Direct Message"
-        at_mentioned = True
     elif isinstance(message.channel, TextChannel):
         context = "Group Room with " + str(len(message.channel.members)) + " members"
     else:
@@ -133,25 +214,41 @@ async def queue_on_message(message):
             paused = True
             await message.channel.send("Bye 😴")
             return
+        if formatted_sender == admin and at_mentioned and 'stall report' in message.content.lower():
+            # Debug command, what has been blocking the event loop
+            for part in split_message("```\n" + loop_watchdog.report() + "\n```"):
+                await message.channel.send(part)
+            return
+        if formatted_sender == admin and at_mentioned and 'usage report' in message.content.lower():
+            # Debug command, where this channel's tokens went
+            for part in split_message("```\n" + await token_ledger.areport(channel_id) + "\n```"):
+                await message.channel.send(part)
+            return
 
     formatted_content = format_discord_mentions(message)
     current_conversation = conversations[channel_id]
     if message.author == client_user:
+        if message.id in streamed_reply_contents:
+            # Streamed replies are sent with their first few words and edited from there
+            formatted_content = streamed_reply_contents.pop(message.id)
+            if formatted_content is None:
+                return
         # Add our own AI message to conversation
         truncated_content = truncate_text(formatted_content, 100)
-        violates_rules = Message.violates_content_policy(truncated_content)
+        violates_rules = await Message.violates_content_policy(truncated_content)
         if not violates_rules:
             current_conversation.add_message(Message("ai", truncated_content, int(time.time())))
             repository.save_message("ai", truncated_content)
             # We're responding, so we're being talked to, we don't want to constantly summarize, but we also
             # don't want to re-submit huge history in prompts, so 500,300,[add when you try another]? Idk
-            await repository.summarize_conversation(current_conversation, trigger_token_limit=300)
+            summarization_scheduler.schedule(current_conversation, trigger_token_limit=300)
         else:
             print("Not saving message because it violates rules: " + truncated_content)
             await message.channel.send("You managed to make the AI say something that violates the rules. Impressive! Please write a thank you letter to OpenAI for saving you from the content of this message.")
         return
     else:
-        violates_rules = Message.violates_content_policy(message.content) # Use raw content here just in case usernames contain something that would censor
+        if violates_rules is None:
+            violates_rules = await Message.violates_content_policy(message.content) # Use raw content here just in case usernames contain something that would censor
         if violates_rules:
             censored_content = Message.CENSORED
             if at_mentioned:
@@ -167,14 +264,15 @@ async def queue_on_message(message):
         requested_gpt_version = 3
         if at_mentioned and 'think hard' in censored_content.lower():
             requested_gpt_version = 4
-        current_conversation.add_message(Message(formatted_sender, censored_content, int(time.time()), requested_gpt_version, at_mentioned))
+        conversation_message = Message(formatted_sender, censored_content, int(time.time()), requested_gpt_version, at_mentioned)
+        current_conversation.add_message(conversation_message)
         repository.save_message(formatted_sender, censored_content)
 
         if at_mentioned:
-            await send_message_with_typing_indicator(current_conversation, context, message.channel, message)
+            return context, message.channel, message, conversation_message
         else:
             # Nobody is talking to us, summarize larger chunks so we're not constantly churning through summarization
-            await repository.summarize_conversation(current_conversation, trigger_token_limit=500)
+            summarization_scheduler.schedule(current_conversation, trigger_token_limit=500)
 
 @client.event
 async def on_ready():
@@ -182,11 +280,12 @@ async def on_ready():
     print(f'We have logged in as {client.user}')
     client_user = client.user
     for db_file in os.listdir("conversations"):
-        if db_file == ".gitignore":
+        # Skip .gitignore and the -wal/-shm files SQLite keeps next to each database
+        if not db_file.endswith(".db"):
             continue
         channel_db = os.path.splitext(db_file)[0]
         channel_id = int(channel_db.split('.')[0])
-        conversations[channel_id] = load_conversation(channel_id)
+        conversations[channel_id] = await load_conversation(channel_id)
         asyncio.create_task(process_queue(conversations[channel_id]))
 
 @client.event
@@ -201,10 +300,18 @@ async def on_message(message):
         conversations[channel_id].enqueue_discord_message(message)
 
 
-async def send_message_with_typing_indicator(current_conversation, discord_context, channel, inbound_message):
+async def send_message_with_typing_indicator(current_conversation, discord_context, channel, inbound_message, answered):
     channel_id = channel.id
-    repository = Repository(channel_id)
-    if current_conversation.requests_gpt_4():
+    # Channels spending through their budget lose gpt-4o, then web search, then LLM replies altogether
+    await token_ledger.aload(channel_id)
+    budget_level = token_ledger.budget_level(channel_id)
+    token_ledger.replies_by_level[budget_level] += 1
+    if budget_level >= OVER_BUDGET:
+        if time.time() - budget_notices_sent.get(channel_id, 0) >= BUDGET_NOTICE_INTERVAL_SECONDS:
+            budget_notices_sent[channel_id] = time.time()
+            await channel.send("I've used up my budget for this channel, I'll be back once some of it frees up 💸")
+        return
+    if current_conversation.requests_gpt_4(answered) and budget_level < NO_GPT_4:
         print("GPT-4")
         gpt_version = 4
     else:
@@ -212,30 +319,20 @@ async def send_message_with_typing_indicator(current_conversation, discord_conte
 
     if gpt_version == 4:
         # Force a summarization, so if we haven't been summoned in awhile we don't submit 1000 tokens to gpt-4
-        await repository.summarize_conversation(current_conversation, trigger_token_limit=300)
-    # Construct a memory retreiver, arun it to get the requested memory, loop through the memory, if .SHORT_TERM_MEMORY for example then fill in get_active_memory()
-    memory_retriever = MemoryRetriever()
-    requested_memory = await memory_retriever.arun(current_conversation.get_formatted_conversation(), DISCORD_NAME)
-    active_memory = ''
-    long_term_memory = ''
-    search_results = ''
-
-    chat_prompt_template = ChatPromptTemplate.from_messages(conversations[channel_id].get_conversation_prompts())
-    for memory in requested_memory:
-        command, parameter = memory
-        if command == MemoryRetriever.LONG_TERM_MEMORY:
-            print("Long term memory: " + parameter)
-            long_term_memory = current_conversation.get_long_term_memories(parameter)
-        if command == MemoryRetriever.SUMMARIZED_MEMORY:
-            print("Summarized memory")
-            active_memory = current_conversation.active_memory
-        if command == MemoryRetriever.WEB_SEARCH:
-            print("Web search: " + parameter)
-            web_searcher = WebSearcher()
-            browse_results = await web_searcher.run(parameter)
-            if browse_results != '':
-                search_results = "Web browsing results which may contain information up to {current_date}:\n" + browse_results
-    chain = LLMChain(llm=get_chat_llm(gpt_version=gpt_version), prompt=chat_prompt_template)
+        await summarization_scheduler.summarize_now(current_conversation, trigger_token_limit=300)
+    # The router answers simple messages itself and asks the MemoryRetriever for the rest
+    with tracer.span("routing"):
+        requested_memory = await retrieval_router.arun(current_conversation, DISCORD_NAME, answered)
+    if budget_level >= NO_WEB_SEARCH:
+        requested_memory = [(command, parameter) for command, parameter in requested_memory if command != MemoryRetriever.WEB_SEARCH]
+    with tracer.span("retrieval"):
+        active_memory, long_term_memories, browse_results = await RetrievalExecutor(current_conversation).run(requested_memory)
+
+    # The reply prompt is the same for every conversation, only the model differs
+    chat_llm = get_chat_llm(gpt_version=gpt_version)
+    with tracer.span("prompt_assembly", chat_llm.model_name):
+        sections = PromptAssembler(chat_llm.model_name, gpt_version).assemble(current_conversation, active_memory, long_term_memories, browse_results, answered[-1])
+    chain = client_registry.chain("reply", lambda: ChatPromptTemplate.from_messages(current_conversation.get_conversation_prompts()), chat_llm.model_name, chat_llm.temperature, chat_llm.max_tokens)
     async def typing_indicator_wrapper():
         try:
             async with channel.typing():
@@ -247,8 +344,37 @@ async def send_message_with_typing_indicator(current_conversation, discord_conte
 
     typing_task = asyncio.create_task(typing_indicator_wrapper())
     try:
-        await run_chain(inbound_message.channel, chain, discord_context, active_memory, long_term_memory, search_results, current_conversation.get_formatted_conversation(True))
+        await run_chain(inbound_message.channel, chain, discord_context, sections[CONVERSATION_CONTEXT], sections[LONG_TERM_MEMORY], sections[SEARCH_RESULTS], sections[LATEST_MESSAGES])
     finally:
         typing_task.cancel()
 
-client.run(discord_bot_key)
+tracer.register_stats("summarization_scheduler", summarization_scheduler.stats)
+tracer.register_stats("moderation", moderation_service.stats)
+tracer.register_stats("client_registry", client_registry.stats)
+tracer.register_stats("retrieval_router", retrieval_router.stats)
+tracer.register_stats("mention_coalescing", lambda: coalescing_stats)
+tracer.register_stats("llm_scheduler", llm_scheduler.stats)
+tracer.register_stats("request_policies", request_policy.stats)
+tracer.register_stats("write_behind", write_behind_queue.stats)
+tracer.register_stats("loop_watchdog", loop_watchdog.stats)
+tracer.register_stats("token_ledger", token_ledger.stats)
+tracer.register_stats("embedding_cache", embedding_cache.stats)
+
+def print_stats():
+    print("Summarization scheduler: " + str(summarization_scheduler.stats()))
+    print("Moderation service: " + str(moderation_service.stats()))
+    print("Client registry: " + str(client_registry.stats()))
+    print("Retrieval router: " + str(retrieval_router.stats()))
+    print("Mention coalescing: " + str(coalescing_stats))
+    print("LLM scheduler: " + str(llm_scheduler.stats()))
+    print("Request policies: " + str(request_policy.stats()))
+    print("Token ledger: " + str(token_ledger.stats()))
+    print("Embedding cache: " + str(embedding_cache.stats()))
+    print(loop_watchdog.report())
+
+# Importing this module sets up the bot without connecting, so load_benchmark.py can drive its handlers
+if __name__ == "__main__":
+    client.run(os.environ['DISCORD_BOT_TOKEN'])
+    print_stats()
+    write_behind_queue.close()
+    connection_manager.close_all()
@@ -1,7 +1,7 @@
 
 
 import time
-from utils import tokenize_text
+from tokenizer import count_tokens
 
 class Memory:
     def __init__(self, id, memory_text, unix_timestamp, serialized_embedding):
@@ -14,7 +14,7 @@ class Memory:
     # Function that gets the token count of memory_text
     def get_token_count(self):
         if self.text_token_count == -1:
-            self.text_token_count = len(tokenize_text(self.memory_text))
+            self.text_token_count = count_tokens(self.memory_text)
         return self.text_token_count
 
     def __str__(self):
@@ -11,6 +11,12 @@ from langchain import LLMChain, LLMMathChain, SerpAPIWrapper
 from langchain.agents import load_tools
 from langchain.prompts import PromptTemplate
 from langchain.schema import (HumanMessage, AIMessage)
+from client_registry import client_registry
+from llm_scheduler import RETRIEVAL
+from request_policy import request_policy
+from token_ledger import token_ledger
+from tracing import tracer
+from tokenizer import count_tokens
 from utils import get_formatted_date
 
 
@@ -60,14 +66,10 @@ END EXAMPLES
 {message}"""
 
     def __init__(self) -> None:
-        llm = ChatOpenAI(temperature=0.0, model="gpt-4o-mini") # type: ignore
-
-        prompt = PromptTemplate(
+        self.chain = client_registry.chain("memory_retriever", lambda: PromptTemplate(
             template=self.TEMPLATE,
             input_variables=["message", "discord_name", "current_date"],
-        )
-
-        self.chain = LLMChain(llm=llm, prompt=prompt)
+        ), temperature=0.0)
 
     def _parse_tools(self, output: str) -> List[Tuple[str, str]]:
         print(output)
@@ -93,6 +95,10 @@ END EXAMPLES
         output = self.chain.run(message=message)
         return self._parse_tools(output)
 
-    async def arun(self, message: str, discord_name: str) -> List[Tuple[str, str]]:
-        output = await self.chain.arun(message=message, discord_name=discord_name, current_date=get_formatted_date())
+    async def arun(self, message: str, discord_name: str, priority: int = RETRIEVAL) -> List[Tuple[str, str]]:
+        inputs = dict(message=message, discord_name=discord_name, current_date=get_formatted_date())
+        with tracer.span("retriever", self.chain.llm.model_name):
+            output = await request_policy("memory_retriever").run(lambda: self.chain.arun(**inputs), priority, count_tokens(message) + len(self.TEMPLATE) // 4,
+                                                                  lambda: token_ledger.record_chain("MemoryRetriever", self.chain, inputs, ''))
+        token_ledger.record_chain("MemoryRetriever", self.chain, inputs, output)
         return self._parse_tools(output)
@@ -1,9 +1,9 @@
-from langchain.chains import OpenAIModerationChain
-from langchain.chat_models import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain.prompts.chat import (AIMessagePromptTemplate,
                                     HumanMessagePromptTemplate)
 
+from moderation import moderation_service
+from tokenizer import count_tokens
 from utils import escape_prompt_content
 
 
@@ -37,16 +37,9 @@ class Message:
 
     def get_number_of_tokens(self):
         if self.token_count == 0 and self.content != "":
-            llm = ChatOpenAI()
-            self.token_count = llm.get_num_tokens(self.content)
+            self.token_count = count_tokens(self.content)
         return self.token_count
 
     @staticmethod
-    def violates_content_policy(text):
-        moderation_chain = OpenAIModerationChain(error=True)
-        try:
-            moderation_chain.run(text)
-            return False
-        except:
-            return True
-
+    async def violates_content_policy(text):
+        return await moderation_service.violates_content_policy(text)
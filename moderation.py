@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import os
+import time
+import traceback
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set
+
+import openai
+
+from llm_scheduler import INTERACTIVE, llm_scheduler
+from token_ledger import token_ledger
+from tokenizer import count_tokens
+
+
+class OpenAIModerationBackend:
+    async def moderate(self, texts: List[str]) -> List[bool]:
+        # The moderation endpoint takes a list of inputs and returns one result per input, in order
+        # Moderation doesn't count against the token budget, but a reply waits on it
+        async with llm_scheduler.slot(INTERACTIVE, 0):
+            response = await openai.Moderation.acreate(input=texts)
+        return [result["flagged"] for result in response["results"]]
+
+
+class StubModerationBackend:
+    # Offline backend for benchmarks: flags texts containing one of flagged_words after a fixed round trip
+    def __init__(self, latency_seconds: float = 0.2, flagged_words: Iterable[str] = ()) -> None:
+        self.latency_seconds = latency_seconds
+        self.flagged_words = [word.lower() for word in flagged_words]
+        self.requests = 0
+        self.texts = 0
+
+    async def moderate(self, texts: List[str]) -> List[bool]:
+        self.requests += 1
+        self.texts += len(texts)
+        await asyncio.sleep(self.latency_seconds)
+        return [any(word in text.lower() for word in self.flagged_words) for text in texts]
+
+    def moderate_blocking(self, texts: List[str]) -> List[bool]:
+        # The round trip the synchronous moderation chain made on the event loop thread
+        self.requests += 1
+        self.texts += len(texts)
+        time.sleep(self.latency_seconds)
+        return [any(word in text.lower() for word in self.flagged_words) for text in texts]
+
+
+class ModerationService:
+    # Texts from every channel that arrive within BATCH_WINDOW_SECONDS of each other share one moderation request,
+    # verdicts are cached by content hash so repeated text is only moderated once
+    BATCH_WINDOW_SECONDS = float(os.environ.get("MODERATION_BATCH_WINDOW_SECONDS", 0.05))
+    MAX_BATCH_SIZE = 32
+    CACHE_SIZE = 4096
+
+    def __init__(self, backend=None) -> None:
+        self.backend = backend or OpenAIModerationBackend()
+        self.cache: "OrderedDict[bytes, bool]" = OrderedDict()
+        # Texts waiting for the next batch, identical texts share one future
+        self.pending: Dict[bytes, "asyncio.Future[bool]"] = {}
+        self.pending_texts: Dict[bytes, str] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+        # The event loop only keeps weak references to tasks
+        self.batch_tasks: Set[asyncio.Task] = set()
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.batches_sent = 0
+        self.texts_sent = 0
+        self.backend_errors = 0
+        self.total_batch_latency = 0.0
+
+    async def violates_content_policy(self, text: str) -> bool:
+        key = hashlib.sha256(text.encode('utf-8')).digest()
+        if key in self.cache:
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        future = self.pending.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        self.pending_texts[key] = text
+        # Charged to the caller's channel here, a batch mixes texts from every channel
+        token_ledger.record("moderation", "text-moderation-latest", count_tokens(text), 0)
+        if len(self.pending) >= self.MAX_BATCH_SIZE:
+            self.__send_pending()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.__flush_after_window())
+        # Shielded so a cancelled waiter doesn't cancel the verdict other waiters share
+        return await asyncio.shield(future)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "cache_size": len(self.cache),
+            "cache_hits": self.cache_hits,
+            "coalesced": self.coalesced,
+            "batches_sent": self.batches_sent,
+            "texts_sent": self.texts_sent,
+            "avg_batch_size": self.texts_sent / self.batches_sent if self.batches_sent else 0.0,
+            "avg_batch_latency_ms": (self.total_batch_latency / self.batches_sent * 1000) if self.batches_sent else 0.0,
+            "backend_errors": self.backend_errors,
+        }
+
+    async def __flush_after_window(self) -> None:
+        await asyncio.sleep(self.BATCH_WINDOW_SECONDS)
+        self.flush_task = None
+        self.__send_pending()
+
+    def __send_pending(self) -> None:
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        batch = self.pending
+        texts = self.pending_texts
+        self.pending = {}
+        self.pending_texts = {}
+        if batch:
+            batch_task = asyncio.create_task(self.__moderate_batch(batch, texts))
+            self.batch_tasks.add(batch_task)
+            batch_task.add_done_callback(self.batch_tasks.discard)
+
+    async def __moderate_batch(self, batch: Dict[bytes, "asyncio.Future[bool]"], texts: Dict[bytes, str]) -> None:
+        keys = list(batch)
+        start = time.monotonic()
+        try:
+            verdicts = await self.backend.moderate([texts[key] for key in keys])
+            if len(verdicts) != len(keys):
+                raise ValueError(f"{len(verdicts)} verdicts for {len(keys)} texts")
+            for key, flagged in zip(keys, verdicts):
+                self.cache[key] = flagged
+                self.cache.move_to_end(key)
+                if not batch[key].done():
+                    batch[key].set_result(flagged)
+        except Exception as e:
+            # Fail closed like the moderation chain did, without caching the verdict
+            print("Moderation request failed, treating " + str(len(keys)) + " texts as violations: " + str(e))
+            traceback.print_exc()
+            self.backend_errors += 1
+        finally:
+            # Every waiter gets a verdict, also when this task is cancelled
+            for future in batch.values():
+                if not future.done():
+                    future.set_result(True)
+            self.batches_sent += 1
+            self.texts_sent += len(keys)
+            self.total_batch_latency += time.monotonic() - start
+            while len(self.cache) > self.CACHE_SIZE:
+                self.cache.popitem(last=False)
+
+
+moderation_service = ModerationService()
@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import random
+import time
+
+from moderation import ModerationService, StubModerationBackend
+
+# Moderates the messages of several busy channels against a stub moderation endpoint, once with one synchronous
+# request per message as Message.violates_content_policy used to, and once through the batching, caching
+# ModerationService.
+
+COPYPASTA = [
+    "What the heck did you just say about me",
+    "I'd just like to interject for a moment",
+    "lol",
+    "@EhrlichGPT",
+]
+
+
+def generate_channels(channels: int, messages: int, repeat_ratio: float, rng):
+    traffic = []
+    for channel in range(channels):
+        channel_messages = []
+        for i in range(messages):
+            if rng.random() < repeat_ratio:
+                channel_messages.append(rng.choice(COPYPASTA))
+            else:
+                channel_messages.append(f"channel {channel} message {i} {rng.random()}")
+        traffic.append(channel_messages)
+    return traffic
+
+
+async def per_message(traffic, backend, interval: float):
+    # The old synchronous call, which held up the event loop and with it every other channel
+    async def run_channel(channel_messages):
+        for text in channel_messages:
+            backend.moderate_blocking([text])
+            await asyncio.sleep(interval)
+    await asyncio.gather(*[run_channel(channel_messages) for channel_messages in traffic])
+
+
+async def batched(traffic, service: ModerationService, interval: float):
+    async def run_channel(channel_messages):
+        for text in channel_messages:
+            await service.violates_content_policy(text)
+            await asyncio.sleep(interval)
+    await asyncio.gather(*[run_channel(channel_messages) for channel_messages in traffic])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batched moderation against one request per message")
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--interval-ms", type=float, default=10)
+    parser.add_argument("--repeat-ratio", type=float, default=0.3)
+    args = parser.parse_args()
+
+    traffic = generate_channels(args.channels, args.messages, args.repeat_ratio, random.Random(0))
+    total = args.channels * args.messages
+    interval = args.interval_ms / 1000
+
+    backend = StubModerationBackend(args.latency_ms / 1000)
+    start = time.perf_counter()
+    asyncio.run(per_message(traffic, backend, interval))
+    per_message_seconds = time.perf_counter() - start
+    per_message_requests = backend.requests
+
+    backend = StubModerationBackend(args.latency_ms / 1000)
+    service = ModerationService(backend)
+    start = time.perf_counter()
+    asyncio.run(batched(traffic, service, interval))
+    batched_seconds = time.perf_counter() - start
+
+    print(f"{args.channels} channels x {args.messages} messages, {args.latency_ms:.0f} ms moderation round trip")
+    print(f"per message: {per_message_seconds:7.2f} s, {total / per_message_seconds:8.1f} messages/s, {per_message_requests} requests")
+    print(f"batched:     {batched_seconds:7.2f} s, {total / batched_seconds:8.1f} messages/s, {backend.requests} requests")
+    print(f"service stats: {service.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import argparse
+import asyncio
+import json
+import random
+import ssl
+import time
+from typing import Dict, Optional, Set, Tuple
+
+from aiohttp import web
+
+# A local stand in for the OpenAI endpoints the bot uses (chat completions, embeddings, moderations), for
+# benchmarks and load tests that must not reach the real API. Counts requests and the TCP connections they arrive on.
+# A fraction of requests can be made slow (slow_fraction, slow_latency_seconds) or fail with a 500 (error_rate), to
+# exercise deadlines, retries and hedging. completion_tokens pads every completion to about that many tokens, and
+# subclasses can answer per prompt by overriding completion_for or serve more endpoints from add_routes.
+
+
+class OpenAIStubServer:
+    def __init__(self, latency_seconds: float = 0.0, embedding_dimension: int = 1536, completion: str = "Investigation results: none\nResponse: Hello from the stub",
+                 slow_fraction: float = 0.0, slow_latency_seconds: float = 0.0, error_rate: float = 0.0, seed: Optional[int] = None,
+                 completion_tokens: int = 0) -> None:
+        self.latency_seconds = latency_seconds
+        self.slow_fraction = slow_fraction
+        self.slow_latency_seconds = slow_latency_seconds
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.embedding_dimension = embedding_dimension
+        self.completion = completion
+        self.completion_tokens = completion_tokens
+        self.requests = 0
+        self.requests_by_path: Dict[str, int] = {}
+        self.slow_requests = 0
+        self.failed_requests = 0
+        # Client (host, port) pairs seen, one per TCP connection
+        self.peers: Set[Tuple[str, int]] = set()
+        self.runner: Optional[web.AppRunner] = None
+        self.port = 0
+        self.scheme = "http"
+
+    @property
+    def api_base(self) -> str:
+        return f"{self.scheme}://127.0.0.1:{self.port}/v1"
+
+    @property
+    def connections(self) -> int:
+        return len(self.peers)
+
+    async def start(self, certificate: Optional[Tuple[str, str]] = None, port: int = 0) -> None:
+        app = web.Application()
+        self.add_routes(app)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        ssl_context = None
+        if certificate is not None:
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(*certificate)
+            self.scheme = "https"
+        site = web.TCPSite(self.runner, "127.0.0.1", port, ssl_context=ssl_context)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+
+    def add_routes(self, app: web.Application) -> None:
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/embeddings", self.embeddings)
+        app.router.add_post("/v1/moderations", self.moderations)
+
+    def completion_for(self, body: dict) -> str:
+        if not self.completion_tokens:
+            return self.completion
+        # Roughly one token per word
+        return self.completion + " " + " ".join(["lorem"] * max(0, self.completion_tokens - len(self.completion.split())))
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def delay(self, request: web.Request) -> None:
+        self.requests += 1
+        self.requests_by_path[request.path] = self.requests_by_path.get(request.path, 0) + 1
+        if request.transport is not None:
+            self.peers.add(request.transport.get_extra_info("peername"))
+        latency_seconds = self.latency_seconds
+        if self.slow_fraction and self.random.random() < self.slow_fraction:
+            self.slow_requests += 1
+            latency_seconds = self.slow_latency_seconds
+        if latency_seconds:
+            await asyncio.sleep(latency_seconds)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.failed_requests += 1
+            raise web.HTTPInternalServerError(text=json.dumps({"error": {"message": "Injected stub failure", "type": "server_error", "param": None, "code": None}}),
+                                              content_type="application/json")
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        await self.delay(request)
+        created = int(time.time())
+        completion = self.completion_for(body)
+        if body.get("stream"):
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            for i in range(0, len(completion), 4):
+                chunk = {"id": "stub", "object": "chat.completion.chunk", "created": created, "model": body.get("model"),
+                         "choices": [{"index": 0, "delta": {"content": completion[i:i + 4]}, "finish_reason": None}]}
+                await response.write(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+            await response.write(b"data: [DONE]\n\n")
+            return response
+        return web.json_response({
+            "id": "stub", "object": "chat.completion", "created": created, "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": completion}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20},
+        })
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        await self.delay(request)
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        data = []
+        for i, text in enumerate(inputs):
+            rng = random.Random(str(text))
+            data.append({"object": "embedding", "index": i, "embedding": [rng.uniform(-0.05, 0.05) for _ in range(self.embedding_dimension)]})
+        return web.json_response({"object": "list", "data": data, "model": body.get("model"), "usage": {"prompt_tokens": 1, "total_tokens": 1}})
+
+    async def moderations(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        await self.delay(request)
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        return web.json_response({"id": "stub", "model": "text-moderation-stub", "results": [{"flagged": False, "categories": {}, "category_scores": {}} for _ in inputs]})
+
+
+async def serve(port: int, latency_seconds: float, slow_fraction: float, slow_latency_seconds: float, error_rate: float) -> None:
+    stub = OpenAIStubServer(latency_seconds, slow_fraction=slow_fraction, slow_latency_seconds=slow_latency_seconds, error_rate=error_rate)
+    await stub.start(port=port)
+    print(f"OpenAI stub listening, set OPENAI_API_BASE={stub.api_base}")
+    while True:
+        await asyncio.sleep(3600)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the OpenAI stub server")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--slow-fraction", type=float, default=0)
+    parser.add_argument("--slow-latency-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    args = parser.parse_args()
+    asyncio.run(serve(args.port, args.latency_ms / 1000, args.slow_fraction, args.slow_latency_ms / 1000, args.error_rate))
@@ -0,0 +1,106 @@
+import os
+from typing import Dict, List, Optional
+
+from conversation import Conversation
+from message import Message
+from tokenizer import count_tokens, count_tokens_batch, truncate_text
+
+CONVERSATION_CONTEXT = "conversation_context"
+LONG_TERM_MEMORY = "long_term_memory"
+SEARCH_RESULTS = "search_results"
+LATEST_MESSAGES = "latest_messages"
+
+
+class PromptAssembler:
+    # Fits the variable sections of RESPONSE_TEMPLATE into a per model prompt budget. Each section is guaranteed its
+    # share of the budget, what a section doesn't use goes to the others in PRIORITY order, and sections over their
+    # budget lose their lowest value content first: the oldest messages and summaries, the lowest ranked memories and
+    # the last web results.
+    PROMPT_TOKEN_LIMITS = {
+        "gpt-4o": int(os.environ.get("PROMPT_TOKEN_LIMIT_GPT_4O", 3000)),
+        "gpt-4o-mini": int(os.environ.get("PROMPT_TOKEN_LIMIT_GPT_4O_MINI", 6000)),
+    }
+    DEFAULT_PROMPT_TOKEN_LIMIT = 3000
+    PRIORITY = [LATEST_MESSAGES, CONVERSATION_CONTEXT, LONG_TERM_MEMORY, SEARCH_RESULTS]
+    SHARES = {LATEST_MESSAGES: 0.4, CONVERSATION_CONTEXT: 0.2, LONG_TERM_MEMORY: 0.2, SEARCH_RESULTS: 0.2}
+    SEARCH_RESULTS_HEADER = "Web browsing results which may contain information up to {current_date}:\n"
+
+    def __init__(self, model: str, gpt_version: int = 3) -> None:
+        self.model = model
+        self.token_limit = self.PROMPT_TOKEN_LIMITS.get(model, self.DEFAULT_PROMPT_TOKEN_LIMIT)
+        self.template_tokens = count_tokens(Conversation.get_system_prompt_template(gpt_version).prompt.template)
+
+    def assemble(self, conversation: Conversation, active_memory: str, long_term_memories, browse_results: List[str], answered: Optional[Message] = None) -> Dict[str, str]:
+        # long_term_memories is None when no LongTermMemory tool ran, so the section is left out rather than empty.
+        # The latest messages end at answered, the template tells the model their last line is addressed to it.
+        memory_lines = [memory.llm_readable_time_in_past() + ": " + memory.memory_text + "\n" for memory in long_term_memories or []]
+        summaries = active_memory.split(',') if active_memory else []
+        message_lines = conversation.escaped_transcript_lines[:conversation.history_length_through(answered)]
+
+        line_tokens = {
+            LATEST_MESSAGES: count_tokens_batch(message_lines),
+            CONVERSATION_CONTEXT: count_tokens_batch(summaries),
+            LONG_TERM_MEMORY: count_tokens_batch(memory_lines),
+            SEARCH_RESULTS: count_tokens_batch(browse_results),
+        }
+        overhead = {
+            LATEST_MESSAGES: 0,
+            CONVERSATION_CONTEXT: 0,
+            LONG_TERM_MEMORY: count_tokens(Conversation.format_long_term_memories([])) if long_term_memories is not None else 0,
+            SEARCH_RESULTS: count_tokens(self.SEARCH_RESULTS_HEADER) if browse_results else 0,
+        }
+        wanted = {section: overhead[section] + sum(tokens) for section, tokens in line_tokens.items()}
+        budgets = self.__budgets(wanted)
+
+        # Messages and summaries keep their newest entries, memories and web results their first (best ranked)
+        kept_messages = self.__keep_newest(message_lines, line_tokens[LATEST_MESSAGES], budgets[LATEST_MESSAGES])
+        kept_summaries = self.__keep_newest(summaries, line_tokens[CONVERSATION_CONTEXT], budgets[CONVERSATION_CONTEXT])
+        kept_memories = self.__keep_first(list(long_term_memories or []), line_tokens[LONG_TERM_MEMORY], budgets[LONG_TERM_MEMORY] - overhead[LONG_TERM_MEMORY])
+        kept_results = self.__keep_first(browse_results, line_tokens[SEARCH_RESULTS], budgets[SEARCH_RESULTS] - overhead[SEARCH_RESULTS], truncate_last=True)
+
+        sections = {
+            LATEST_MESSAGES: ''.join(kept_messages),
+            CONVERSATION_CONTEXT: ','.join(kept_summaries),
+            LONG_TERM_MEMORY: Conversation.format_long_term_memories(kept_memories) if long_term_memories is not None else '',
+            SEARCH_RESULTS: self.SEARCH_RESULTS_HEADER + "\n\n".join(kept_results) if kept_results else '',
+        }
+        used = {section: count_tokens(text) for section, text in sections.items()}
+        print(f"Prompt for {self.model}: {self.template_tokens + sum(used.values())}/{self.token_limit} tokens, template {self.template_tokens}, "
+              + ", ".join(f"{section} {used[section]}/{wanted[section]}" for section in self.PRIORITY))
+        return sections
+
+    def __budgets(self, wanted: Dict[str, int]) -> Dict[str, int]:
+        available = max(0, self.token_limit - self.template_tokens)
+        budgets = {section: min(wanted[section], int(available * self.SHARES[section])) for section in self.PRIORITY}
+        spare = available - sum(budgets.values())
+        for section in self.PRIORITY:
+            extra = min(spare, wanted[section] - budgets[section])
+            budgets[section] += extra
+            spare -= extra
+        return budgets
+
+    def __keep_newest(self, items: List[str], tokens: List[int], budget: int) -> List[str]:
+        kept: List[str] = []
+        total_tokens = 0
+        for item, item_tokens in zip(reversed(items), reversed(tokens)):
+            if total_tokens + item_tokens > budget:
+                if not kept and budget > 0:
+                    # Always keep the newest entry, cut to the budget from its start
+                    kept.append(truncate_text(item, budget, direction=-1))
+                break
+            kept.append(item)
+            total_tokens += item_tokens
+        kept.reverse()
+        return kept
+
+    def __keep_first(self, items: list, tokens: List[int], budget: int, truncate_last: bool = False) -> list:
+        kept = []
+        total_tokens = 0
+        for item, item_tokens in zip(items, tokens):
+            if total_tokens + item_tokens > budget:
+                if truncate_last and budget - total_tokens > 0:
+                    kept.append(truncate_text(item, budget - total_tokens))
+                break
+            kept.append(item)
+            total_tokens += item_tokens
+        return kept
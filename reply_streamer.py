@@ -0,0 +1,135 @@
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+import openai
+
+from tracing import tracer
+from utils import clean_up_response, split_message
+
+
+class ReplyStreamer:
+    # Posts the part of a streamed completion after the "Response:" marker as soon as it starts, then edits it at
+    # most every EDIT_INTERVAL_SECONDS as more tokens arrive. Past MAX_MESSAGE_LENGTH the reply continues in a new
+    # message instead of being cut off.
+    RESPONSE_MARKER = "Response:"
+    EDIT_INTERVAL_SECONDS = float(os.environ.get("STREAMING_EDIT_INTERVAL_SECONDS", 1.0))
+    MAX_MESSAGE_LENGTH = 2000
+
+    def __init__(self, channel, discord_name: str) -> None:
+        self.channel = channel
+        self.discord_name = discord_name
+        self.raw_response = ''
+        self.marker_search_start = 0
+        self.response_start: Optional[int] = None
+        self.sent_messages: List = []
+        self.sent_contents: List[str] = []
+        self.last_edit = 0.0
+        self.started = time.monotonic()
+        self.first_visible_seconds: Optional[float] = None
+
+    async def stream(self, llm, messages) -> None:
+        # Starting over keeps the messages already sent, a retried completion edits them instead of posting again
+        self.raw_response = ''
+        self.marker_search_start = 0
+        self.response_start = None
+        chunks = llm.astream(messages).__aiter__()
+        while True:
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                break
+            except aiohttp.ClientError as e:
+                # openai only wraps errors from opening the stream, a retry should still see this one as OpenAI's.
+                # Errors from Discord, raised by feed(), aren't retried, they would replay the whole completion.
+                raise openai.error.APIConnectionError(f"Reply stream failed: {type(e).__name__} {e}") from e
+            await self.feed(chunk.content)
+
+    async def feed(self, delta: str) -> None:
+        self.raw_response += delta
+        if self.response_start is None:
+            marker_index = self.raw_response.find(self.RESPONSE_MARKER, self.marker_search_start)
+            if marker_index == -1:
+                # The marker may be split across deltas
+                self.marker_search_start = max(0, len(self.raw_response) - len(self.RESPONSE_MARKER) + 1)
+                return
+            self.response_start = marker_index + len(self.RESPONSE_MARKER)
+        visible_text = self.__visible_text()
+        if not visible_text:
+            return
+        if self.sent_messages and time.monotonic() - self.last_edit < self.EDIT_INTERVAL_SECONDS:
+            return
+        await self.__publish(visible_text)
+
+    async def finish(self) -> Dict[int, Optional[str]]:
+        # Settles the messages on the cleaned up response, returns the final content of every message sent,
+        # None for messages that were deleted because the reply got shorter
+        response = clean_up_response(self.discord_name, self.raw_response)
+        print(f"Sending message: {response}")
+        if response:
+            await self.__publish(response)
+        final_contents = self.contents()
+        for message in self.sent_messages[len(split_message(response, self.MAX_MESSAGE_LENGTH)) if response else 0:]:
+            await message.delete()
+            final_contents[message.id] = None
+        return final_contents
+
+    def contents(self) -> Dict[int, Optional[str]]:
+        # The content of every message sent so far, as last sent
+        return {message.id: content for message, content in zip(self.sent_messages, self.sent_contents)}
+
+    def __visible_text(self) -> str:
+        # What clean_up_response would return so far, held back while it could still turn into a name prefix
+        assert self.response_start is not None
+        text = self.raw_response[self.response_start:].lstrip().lstrip('"')
+        for prefix in [self.discord_name + ":", "AI:"]:
+            if text.startswith(prefix):
+                return text[len(prefix):].lstrip()
+            if prefix.startswith(text):
+                return ''
+        return text
+
+    async def __publish(self, text: str) -> None:
+        for i, chunk in enumerate(split_message(text, self.MAX_MESSAGE_LENGTH)):
+            if i < len(self.sent_messages):
+                if self.sent_contents[i] != chunk:
+                    with tracer.span("discord_edit"):
+                        await self.sent_messages[i].edit(content=chunk)
+                    self.sent_contents[i] = chunk
+            else:
+                with tracer.span("discord_send"):
+                    self.sent_messages.append(await self.channel.send(chunk))
+                self.sent_contents.append(chunk)
+                if self.first_visible_seconds is None:
+                    self.first_visible_seconds = time.monotonic() - self.started
+        self.last_edit = time.monotonic()
+
+
+async def stream_reply(llm, messages, channel, discord_name: str, run: Optional[Callable[[Callable[[], Awaitable[None]]], Awaitable[None]]] = None,
+                       charge_abandoned: Optional[Callable[[str], None]] = None, sent_contents: Optional[Dict[int, Optional[str]]] = None) -> Tuple[Dict[int, Optional[str]], str]:
+    # Returns finish()'s message contents and the raw completion. run wraps each attempt at the stream, e.g. with a
+    # RequestPolicy's deadline and retries. An attempt that fails midway still streamed (and was billed for) part of
+    # a completion, charge_abandoned gets that part. sent_contents is updated with the same contents, or if the
+    # reply fails, with those of the messages it got out.
+    streamer = ReplyStreamer(channel, discord_name)
+    async def attempt():
+        try:
+            await streamer.stream(llm, messages)
+        except BaseException:
+            if charge_abandoned is not None:
+                charge_abandoned(streamer.raw_response)
+            raise
+    final_contents: Optional[Dict[int, Optional[str]]] = None
+    try:
+        if run is None:
+            await attempt()
+        else:
+            await run(attempt)
+        final_contents = await streamer.finish()
+    finally:
+        if sent_contents is not None:
+            sent_contents.update(streamer.contents() if final_contents is None else final_contents)
+    if streamer.first_visible_seconds is not None:
+        print(f"Streamed reply visible after {streamer.first_visible_seconds:.2f}s, finished after {time.monotonic() - streamer.started:.2f}s")
+    return final_contents, streamer.raw_response
@@ -1,133 +1,230 @@
+import asyncio
 import os
 import sqlite3
 import time
+from concurrent.futures import Future
+from typing import List, Tuple
 import faiss
 import numpy as np
 
+import index_backend
+from connection_manager import connection_manager
 from memory import Memory
+from write_behind import write_behind_queue
 
 
 class Repository:
+    # Embeddings are stored as raw little-endian float32 BLOBs
+    EMBEDDING_DTYPE = np.dtype('<f4')
+    # PRAGMA user_version, bumped by each migration in __migrate
+    SCHEMA_VERSION = 3
+    MIGRATION_BATCH_SIZE = 1000
+
     def __init__(self, channel_id: int) -> None:
         self.db_path = self.__get_db_path(channel_id)
-        self.__create_db_if_not_exists()
+        # Index snapshots are stored in a file next to the database, only ones from before that in a BLOB
+        self.index_path = os.path.join("conversations", f"{channel_id}.faiss")
+        self.conn = connection_manager.get(self.db_path, self.__create_db_if_not_exists)
 
+    # Writes go through the write-behind queue and are committed in the background, call flush()/aflush()
+    # before reading back anything that was just written
     def clear_messages(self) -> None:
-        conn = sqlite3.connect(self.db_path)
-        conn.execute("DELETE FROM messages")
-        conn.commit()
-        conn.close()
+        self.compact_messages(0)
+
+    # messages is an append-only log, compaction moves the watermark past everything but the newest
+    # keep_count messages and range deletes what it passed, retained rows are never rewritten
+    def compact_messages(self, keep_count: int) -> None:
+        def write(conn):
+            watermark = self.__messages_watermark(conn)
+            row = conn.execute("SELECT id FROM messages WHERE id > ? ORDER BY id DESC LIMIT 1 OFFSET ?", (watermark, keep_count)).fetchone()
+            if row is None:
+                return
+            conn.execute("INSERT INTO messages_watermark (id, compacted_up_to) VALUES (1, ?) ON CONFLICT(id) DO UPDATE SET compacted_up_to = excluded.compacted_up_to", (row[0],))
+            conn.execute("DELETE FROM messages WHERE id <= ?", (row[0],))
+        write_behind_queue.submit(self.db_path, write)
 
     def save_message(self, sender, content):
-        conn = sqlite3.connect(self.db_path)
-        conn.execute("INSERT INTO messages (sender, content) VALUES (?, ?)", (sender, content))
-        conn.commit()
-        conn.close()
+        write_behind_queue.submit(self.db_path, lambda conn: conn.execute("INSERT INTO messages (sender, content) VALUES (?, ?)", (sender, content)))
 
     def save_conversation_context(self, conversation_context):
-        conn = sqlite3.connect(self.db_path)
-        conn.execute("DELETE FROM conversation_context")
-        conn.execute("INSERT INTO conversation_context (context) VALUES (?)", (conversation_context,))
-        conn.commit()
-        conn.close()
-
-    def save_long_term_memory(self, long_term_memory, unix_timestamp, serialized_embedding):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO long_term_memory_text (timestamp, memory_text, embedding_serialized_csv_text) VALUES (?, ?, ?)", (unix_timestamp, long_term_memory, serialized_embedding))
-        memory_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return memory_id
-
-    def save_long_term_memory_index(self, faiss_index):
-        conn = sqlite3.connect(self.db_path)
-        conn.execute("DELETE FROM long_term_memory_index")
-        conn.execute("INSERT INTO long_term_memory_index (serialized_faiss_index) VALUES (?)", (faiss.serialize_index(faiss_index),))
-        conn.commit()
-        conn.close()
-
-    def load_long_term_memory_index(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.execute("SELECT serialized_faiss_index FROM long_term_memory_index")
-        serialized_index = cursor.fetchone()
-        conn.close()
-        if serialized_index:
-            serialized_index_np = np.frombuffer(serialized_index[0], dtype=np.uint8)
-            return faiss.deserialize_index(serialized_index_np)
+        def write(conn):
+            conn.execute("DELETE FROM conversation_context")
+            conn.execute("INSERT INTO conversation_context (context) VALUES (?)", (conversation_context,))
+        write_behind_queue.submit(self.db_path, write)
+
+    async def asave_long_term_memory(self, long_term_memory, unix_timestamp, serialized_embedding):
+        def write(conn):
+            return conn.execute("INSERT INTO long_term_memory_text (timestamp, memory_text, embedding) VALUES (?, ?, ?)", (unix_timestamp, long_term_memory, serialized_embedding)).lastrowid
+        # The caller needs the new row id, so this one waits for its commit
+        return await asyncio.wrap_future(write_behind_queue.submit(self.db_path, write))
+
+    # The index is persisted as a file snapshot covering memories up to last_memory_id, plus the log of memories
+    # saved after it (their embeddings in long_term_memory_text), which aload_embeddings replays. Snapshot files are
+    # only written and read off the event loop, the index being served is never serialized.
+
+    # Moves a freshly built index file (written by the thread that built it) over the snapshot on the writer thread,
+    # after every fold queued before it
+    def install_long_term_memory_index_file(self, built_path: str, last_memory_id: int) -> Future:
+        def write(conn):
+            os.replace(built_path, self.index_path)
+            conn.execute("DELETE FROM long_term_memory_index")
+            conn.execute("INSERT INTO long_term_memory_index (index_path, last_memory_id) VALUES (?, ?)", (self.index_path, last_memory_id))
+            return last_memory_id
+        return write_behind_queue.submit(self.db_path, write)
+
+    # Folds the memories after the snapshot into a new file snapshot on the writer thread, a mapped file is only
+    # read, the new one replaces it once written
+    def fold_long_term_memory_index_file(self, last_memory_id: int, dimension: int) -> Future:
+        def write(conn):
+            snapshot = conn.execute("SELECT serialized_faiss_index, last_memory_id, index_path FROM long_term_memory_index").fetchone()
+            if snapshot is None:
+                # A new channel's first snapshot, channels start out on the flat tier
+                faiss_index, snapshot_memory_id = index_backend.create(index_backend.FLAT, dimension), 0
+            elif snapshot[2] is None:
+                faiss_index, snapshot_memory_id = faiss.deserialize_index(np.frombuffer(snapshot[0], dtype=np.uint8)), snapshot[1]
+            else:
+                faiss_index, snapshot_memory_id = faiss.read_index(snapshot[2]), snapshot[1]
+            rows = conn.execute("SELECT id, embedding FROM long_term_memory_text WHERE id > ? AND id <= ? ORDER BY id ASC", (snapshot_memory_id, last_memory_id)).fetchall()
+            if rows:
+                embeddings = np.frombuffer(b''.join(row[1] for row in rows), dtype=self.EMBEDDING_DTYPE).reshape(len(rows), dimension)
+                faiss_index.add_with_ids(embeddings, np.array([row[0] for row in rows], dtype='int64'))
+            index_backend.write(faiss_index, self.index_path)
+            conn.execute("DELETE FROM long_term_memory_index")
+            conn.execute("INSERT INTO long_term_memory_index (index_path, last_memory_id) VALUES (?, ?)", (self.index_path, last_memory_id))
+            return last_memory_id
+        return write_behind_queue.submit(self.db_path, write)
+
+    # llm_usage is the append-only token ledger, llm_usage_hourly its roll up per hour, call site and model, both are
+    # written in the same transaction. The returned future resolves to the new llm_usage id.
+    def save_llm_usage(self, timestamp: int, call_site: str, model: str, prompt_tokens: int, completion_tokens: int, cost: float) -> Future:
+        hour = timestamp - timestamp % 3600
+        def write(conn):
+            usage_id = conn.execute("INSERT INTO llm_usage (timestamp, call_site, model, prompt_tokens, completion_tokens, cost) VALUES (?, ?, ?, ?, ?, ?)",
+                                    (timestamp, call_site, model, prompt_tokens, completion_tokens, cost)).lastrowid
+            conn.execute('''INSERT INTO llm_usage_hourly (hour, call_site, model, calls, prompt_tokens, completion_tokens, cost) VALUES (?, ?, ?, 1, ?, ?, ?)
+                            ON CONFLICT(hour, call_site, model) DO UPDATE SET calls = calls + 1, prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                            completion_tokens = completion_tokens + excluded.completion_tokens, cost = cost + excluded.cost''',
+                         (hour, call_site, model, prompt_tokens, completion_tokens, cost))
+            return usage_id
+        return write_behind_queue.submit(self.db_path, write)
+
+    # Returns (hour, cost) for every hour from since_hour on, and the last llm_usage id those totals include
+    def load_llm_usage_by_hour(self, since_hour: int) -> Tuple[List[Tuple[int, float]], int]:
+        self.flush()
+        return self.__read_llm_usage_by_hour(since_hour)
+
+    async def aload_llm_usage_by_hour(self, since_hour: int) -> Tuple[List[Tuple[int, float]], int]:
+        await self.aflush()
+        return self.__read_llm_usage_by_hour(since_hour)
+
+    # Returns (call site, model, calls, prompt tokens, completion tokens, cost) from since_hour on, most expensive first
+    async def aload_llm_usage_by_call_site(self, since_hour: int) -> List[Tuple[str, str, int, int, int, float]]:
+        await self.aflush()
+        return self.conn.execute('''SELECT call_site, model, SUM(calls), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost) FROM llm_usage_hourly
+                                    WHERE hour >= ? GROUP BY call_site, model ORDER BY SUM(cost) DESC''', (since_hour,)).fetchall()
+
+    # flush() blocks until the writer thread has committed everything queued, async callers await aflush() or the
+    # aload_* variants instead
+    def flush(self) -> None:
+        write_behind_queue.flush()
+
+    async def aflush(self) -> None:
+        await write_behind_queue.aflush()
+
+    # Returns the snapshot and the last memory id it covers, or (None, 0). The snapshot is read on a worker thread.
+    async def aload_long_term_memory_index(self):
+        await self.aflush()
+        snapshot = self.conn.execute("SELECT serialized_faiss_index, last_memory_id, index_path FROM long_term_memory_index").fetchone()
+        if snapshot and snapshot[2]:
+            return await asyncio.to_thread(index_backend.read, snapshot[2]), snapshot[1]
+        elif snapshot:
+            return await asyncio.to_thread(faiss.deserialize_index, np.frombuffer(snapshot[0], dtype=np.uint8)), snapshot[1]
         else:
-            return None
-
-    def load_memory(self, id):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.execute("SELECT id, memory_text, timestamp, embedding_serialized_csv_text FROM long_term_memory_text WHERE id=?", (id,))
-        memory = cursor.fetchone()
-        conn.close()
-        return Memory(memory[0], memory[1], memory[2], memory[3]) if memory else None
-
-    # Load ordered embeddings ascending by id
-    def load_embeddings(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.execute("SELECT embedding_serialized_csv_text FROM long_term_memory_text ORDER BY id ASC")
-        embeddings = cursor.fetchall()
-        conn.close()
-        return [list(map(float, embedding[0].split(','))) for embedding in embeddings]
-
-    def load_messages(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.execute("SELECT sender, content FROM messages")
-        messages = cursor.fetchall()
-        conn.close()
-        return messages
-
-    def load_conversation_context(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.execute("SELECT context FROM conversation_context")
-        context = cursor.fetchone()
-        conn.close()
+            return None, 0
+
+    # Loads several memories in one query, returned in the order of ids (missing ids are skipped)
+    def load_memories(self, ids: List[int]) -> List[Memory]:
+        if not ids:
+            return []
+        placeholders = ','.join('?' * len(ids))
+        rows = self.conn.execute(f"SELECT id, memory_text, timestamp, embedding FROM long_term_memory_text WHERE id IN ({placeholders})", ids).fetchall()
+        memories = {row[0]: Memory(row[0], row[1], row[2], row[3]) for row in rows}
+        return [memories[id] for id in ids if id in memories]
+
+    # Load ordered embeddings ascending by id, as their ids and one contiguous (memories x dimension) float32 matrix
+    async def aload_embeddings(self, dimension: int, after_memory_id: int = 0) -> Tuple[List[int], np.ndarray]:
+        await self.aflush()
+        return self.__read_embeddings(self.conn, dimension, after_memory_id)
+
+    # aload_embeddings for worker threads (e.g. an index rebuild), which read through a connection of their own
+    def load_embeddings_in_thread(self, dimension: int, after_memory_id: int = 0) -> Tuple[List[int], np.ndarray]:
+        self.flush()
+        conn = connection_manager.open(self.db_path)
+        try:
+            return self.__read_embeddings(conn, dimension, after_memory_id)
+        finally:
+            conn.close()
+
+    async def aload_messages(self):
+        await self.aflush()
+        return self.conn.execute("SELECT sender, content FROM messages WHERE id > ? ORDER BY id ASC", (self.__messages_watermark(self.conn),)).fetchall()
+
+    async def aload_conversation_context(self):
+        await self.aflush()
+        context = self.conn.execute("SELECT context FROM conversation_context").fetchone()
         return context[0] if context else ''
 
+    # Every message in conversation_history was saved when it was added, so the stored log only needs compacting
     def sync_conversation_context(self, conversation):
-        self.clear_messages()
-        for message in conversation.messages:
-            self.save_message(message.sender, message.content)
-        self.save_conversation_context(conversation.conversation_context)
-        self.save_long_term_memory(conversation.long_term_memory)
+        self.compact_messages(len(conversation.conversation_history))
+        self.save_conversation_context(conversation.active_memory)
 
     async def summarize_conversation(self, conversation, trigger_token_limit=400, conversation_window_tokens=100):
         needed_summary=False
         await conversation.lock.acquire()
         try:
+            if conversation.get_conversation_token_count() <= trigger_token_limit:
+                return needed_summary
             needed_summary=True
+            # Messages added while the summarizer runs aren't in the summary, so they are never trimmed
+            summarized_count = len(conversation.conversation_history)
             await conversation.run_summarizer()
-            new_messages = []
-            total_tokens = 0
-            for message in reversed(conversation.conversation_history):
-                potential_total_tokens = total_tokens + message.get_number_of_tokens()
-                if potential_total_tokens > trigger_token_limit:
-                    break
-                new_messages.insert(0, message)
-                total_tokens = potential_total_tokens
-                if total_tokens > conversation_window_tokens:
-                    break
-            conversation.conversation_history = new_messages
-            self.save_conversation_context(conversation.active_memory)
-            self.clear_messages()
-            for message in conversation.conversation_history:
-                self.save_message(message.sender, message.content)
+            conversation.trim_history(trigger_token_limit, conversation_window_tokens, summarized_count)
+            self.sync_conversation_context(conversation)
         finally:
             conversation.lock.release()
         return needed_summary
 
+    def __read_llm_usage_by_hour(self, since_hour: int) -> Tuple[List[Tuple[int, float]], int]:
+        # One read transaction, the writer thread may commit between two statements otherwise
+        self.conn.execute("BEGIN")
+        try:
+            rows = self.conn.execute("SELECT hour, SUM(cost) FROM llm_usage_hourly WHERE hour >= ? GROUP BY hour", (since_hour,)).fetchall()
+            last_usage_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM llm_usage").fetchone()[0]
+        finally:
+            self.conn.commit()
+        return rows, last_usage_id
+
+    def __read_embeddings(self, conn: sqlite3.Connection, dimension: int, after_memory_id: int) -> Tuple[List[int], np.ndarray]:
+        rows = conn.execute("SELECT id, embedding FROM long_term_memory_text WHERE id > ? ORDER BY id ASC", (after_memory_id,)).fetchall()
+        embeddings = np.frombuffer(b''.join(row[1] for row in rows), dtype=self.EMBEDDING_DTYPE).reshape(len(rows), dimension)
+        return [row[0] for row in rows], embeddings
+
+    def __messages_watermark(self, conn: sqlite3.Connection) -> int:
+        row = conn.execute("SELECT compacted_up_to FROM messages_watermark WHERE id = 1").fetchone()
+        return row[0] if row else 0
+
     def __get_db_path(self, channel_id: int) -> str:
         return os.path.join("conversations", f"{channel_id}.db")
 
-    def __create_db_if_not_exists(self) -> None:
-        conn = sqlite3.connect(self.db_path)
+    def __create_db_if_not_exists(self, conn: sqlite3.Connection) -> None:
         conn.execute('''CREATE TABLE IF NOT EXISTS messages
                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
                         sender TEXT NOT NULL,
                         content TEXT NOT NULL);''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS messages_watermark
+                        (id INTEGER PRIMARY KEY CHECK (id = 1),
+                        compacted_up_to INTEGER NOT NULL);''')
         conn.execute('''CREATE TABLE IF NOT EXISTS conversation_context
                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
                         context TEXT NOT NULL);''')
@@ -135,12 +232,77 @@ class Repository:
             id INTEGER PRIMARY KEY,
             timestamp INTEGER,
             memory_text TEXT,
-            embedding_serialized_csv_text TEXT
+            embedding BLOB
         )''')
 
         conn.execute('''CREATE TABLE IF NOT EXISTS long_term_memory_index (
             id INTEGER PRIMARY KEY,
-            serialized_faiss_index BLOB
+            serialized_faiss_index BLOB,
+            last_memory_id INTEGER NOT NULL DEFAULT 0,
+            index_path TEXT
+        )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS llm_usage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp INTEGER NOT NULL,
+            call_site TEXT NOT NULL,
+            model TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cost REAL NOT NULL
         )''')
-        conn.commit()
-        conn.close()
+        conn.execute('''CREATE TABLE IF NOT EXISTS llm_usage_hourly (
+            hour INTEGER NOT NULL,
+            call_site TEXT NOT NULL,
+            model TEXT NOT NULL,
+            calls INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cost REAL NOT NULL,
+            PRIMARY KEY (hour, call_site, model)
+        )''')
+        self.__migrate(conn)
+
+    def __migrate(self, conn: sqlite3.Connection) -> None:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            self.__migrate_csv_embeddings(conn)
+        if version < 2:
+            self.__migrate_index_snapshot(conn)
+        if version < 3:
+            self.__migrate_index_path(conn)
+        if version < self.SCHEMA_VERSION:
+            conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    # Version 1: embeddings move from comma separated decimal text to float32 BLOBs
+    def __migrate_csv_embeddings(self, conn: sqlite3.Connection) -> None:
+        columns = [column[1] for column in conn.execute("PRAGMA table_info(long_term_memory_text)")]
+        if 'embedding_serialized_csv_text' not in columns:
+            return
+        if 'embedding' not in columns:
+            conn.execute("ALTER TABLE long_term_memory_text ADD COLUMN embedding BLOB")
+        migrated = 0
+        while True:
+            rows = conn.execute("SELECT id, embedding_serialized_csv_text FROM long_term_memory_text WHERE embedding_serialized_csv_text IS NOT NULL LIMIT ?", (self.MIGRATION_BATCH_SIZE,)).fetchall()
+            if not rows:
+                break
+            conn.executemany(
+                "UPDATE long_term_memory_text SET embedding = ?, embedding_serialized_csv_text = NULL WHERE id = ?",
+                [(np.array(csv_text.split(','), dtype=self.EMBEDDING_DTYPE).tobytes(), id) for id, csv_text in rows]
+            )
+            migrated += len(rows)
+        if migrated:
+            print(f"Migrated {migrated} embeddings to float32 in {self.db_path}")
+
+    # Version 2: the stored index becomes a snapshot, old ones were rewritten on every add so they cover every memory
+    def __migrate_index_snapshot(self, conn: sqlite3.Connection) -> None:
+        columns = [column[1] for column in conn.execute("PRAGMA table_info(long_term_memory_index)")]
+        if 'last_memory_id' in columns:
+            return
+        conn.execute("ALTER TABLE long_term_memory_index ADD COLUMN last_memory_id INTEGER NOT NULL DEFAULT 0")
+        conn.execute("UPDATE long_term_memory_index SET last_memory_id = (SELECT COALESCE(MAX(id), 0) FROM long_term_memory_text)")
+
+    # Version 3: large index tiers live in a memory-mapped file referenced by index_path
+    def __migrate_index_path(self, conn: sqlite3.Connection) -> None:
+        columns = [column[1] for column in conn.execute("PRAGMA table_info(long_term_memory_index)")]
+        if 'index_path' not in columns:
+            conn.execute("ALTER TABLE long_term_memory_index ADD COLUMN index_path TEXT")
@@ -0,0 +1,83 @@
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from connection_manager import connection_manager
+from repository import Repository
+from write_behind import write_behind_queue
+
+# Measures messages/sec for the per-message work queue_on_message does against sqlite:
+# construct a Repository for the channel, then save the message.
+
+
+class ConnectPerCallRepository:
+    # The previous Repository behaviour: schema DDL on construction and a fresh connection per statement
+    def __init__(self, channel_id: int) -> None:
+        self.db_path = os.path.join("conversations", f"{channel_id}.db")
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''CREATE TABLE IF NOT EXISTS messages
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        sender TEXT NOT NULL,
+                        content TEXT NOT NULL);''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS conversation_context
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        context TEXT NOT NULL);''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS long_term_memory_text (
+            id INTEGER PRIMARY KEY,
+            timestamp INTEGER,
+            memory_text TEXT,
+            embedding_serialized_csv_text TEXT
+        )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS long_term_memory_index (
+            id INTEGER PRIMARY KEY,
+            serialized_faiss_index BLOB
+        )''')
+        conn.commit()
+        conn.close()
+
+    def save_message(self, sender, content):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("INSERT INTO messages (sender, content) VALUES (?, ?)", (sender, content))
+        conn.commit()
+        conn.close()
+
+
+def run(repository_class, channels: int, messages: int) -> float:
+    start = time.perf_counter()
+    for i in range(messages):
+        repository = repository_class(i % channels)
+        repository.save_message("user#" + str(i % 17), "benchmark message number " + str(i))
+    # Count write-behind time too, nothing is durable until the queue has drained
+    write_behind_queue.flush()
+    return messages / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Repository message persistence")
+    parser.add_argument("--channels", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        try:
+            os.makedirs("conversations")
+            before = run(ConnectPerCallRepository, args.channels, args.messages)
+            for db_file in os.listdir("conversations"):
+                os.remove(os.path.join("conversations", db_file))
+            after = run(Repository, args.channels, args.messages)
+            write_behind_queue.close()
+            connection_manager.close_all()
+        finally:
+            os.chdir(original_dir)
+
+    print(f"{args.messages} messages across {args.channels} channels")
+    print(f"connect per call: {before:10.1f} messages/sec")
+    print(f"Repository:       {after:10.1f} messages/sec ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
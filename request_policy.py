@@ -0,0 +1,211 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set, Tuple, TypeVar
+
+import openai
+
+from llm_scheduler import llm_scheduler
+
+T = TypeVar("T")
+
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    # An attempt ran past its policy's deadline, unlike a timeout raised by the call itself (e.g. a Discord request)
+    pass
+
+
+# Errors worth another attempt: the deadline and errors from the OpenAI transport. Anything else (a bad request, a bad
+# key, a failed Discord send in a streamed reply) would fail the same way again, or replay work that already happened.
+RETRYABLE_ERRORS = (
+    DeadlineExceeded,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+# Per call site defaults as (timeout seconds, attempts, hedge), overridable with REQUEST_POLICY_<NAME>_TIMEOUT_SECONDS,
+# REQUEST_POLICY_<NAME>_ATTEMPTS and REQUEST_POLICY_<NAME>_HEDGE. Streamed replies are never hedged, two streams
+# would edit the same Discord messages.
+POLICY_DEFAULTS: Dict[str, Tuple[float, int, bool]] = {
+    "reply": (60.0, 2, False),
+    "memory_retriever": (15.0, 3, True),
+    "web_browse": (30.0, 2, False),
+    "embedding_query": (10.0, 3, True),
+    "summarizer": (60.0, 3, False),
+    "long_term_memory": (60.0, 3, False),
+    "scold": (30.0, 2, False),
+}
+
+
+class RequestPolicy:
+    # Runs one outbound call with a deadline per attempt and jittered exponential backoff between attempts. A hedged
+    # policy also starts a duplicate of an attempt that is slower than the call site's recent p95 latency and takes
+    # whichever finishes first. Every attempt, hedges included, takes its own LLM scheduler slot, the deadline only
+    # starts once it has one. The call site records the usage of the attempt whose result it gets, every other attempt
+    # that was sent (it failed, ran past the deadline or lost a hedge) may still be billed and is passed to
+    # charge_abandoned.
+    BACKOFF_SECONDS = float(os.environ.get("REQUEST_POLICY_BACKOFF_SECONDS", 0.5))
+    MAX_BACKOFF_SECONDS = 8.0
+    # Until a call site has LATENCY_SAMPLES_FOR_HEDGING latencies it hedges after DEFAULT_HEDGE_DELAY_SECONDS
+    LATENCY_SAMPLES = 200
+    LATENCY_SAMPLES_FOR_HEDGING = 20
+    DEFAULT_HEDGE_DELAY_SECONDS = float(os.environ.get("REQUEST_POLICY_DEFAULT_HEDGE_DELAY_SECONDS", 3.0))
+    MIN_HEDGE_DELAY_SECONDS = 0.05
+
+    def __init__(self, name: str, timeout_seconds: float, attempts: int = 3, hedge: bool = False) -> None:
+        self.name = name
+        self.timeout_seconds = timeout_seconds
+        self.attempts = max(1, attempts)
+        self.hedge = hedge
+        self.latencies: Deque[float] = deque(maxlen=self.LATENCY_SAMPLES)
+        self.calls = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failures = 0
+        self.abandoned = 0
+
+    async def run(self, call: Callable[[], Awaitable[T]], priority: int, estimated_tokens: Optional[int] = None, charge_abandoned: Optional[Callable[[], None]] = None) -> T:
+        # call is invoked once per attempt, so it must start a new request every time
+        self.calls += 1
+        for attempt in range(self.attempts):
+            if attempt:
+                self.retries += 1
+                await asyncio.sleep(self.backoff_seconds(attempt))
+            try:
+                if self.hedge:
+                    return await self.__hedged_attempt(call, priority, estimated_tokens, charge_abandoned)
+                return await self.__attempt(call, priority, estimated_tokens, charge_abandoned)
+            except RETRYABLE_ERRORS as e:
+                if attempt + 1 == self.attempts:
+                    self.failures += 1
+                    raise
+                print(f"Retrying {self.name} after attempt {attempt + 1} failed: {type(e).__name__} {e}")
+            except Exception:
+                self.failures += 1
+                raise
+        raise AssertionError("unreachable")
+
+    def backoff_seconds(self, attempt: int) -> float:
+        # Full jitter, so calls that failed together don't retry together
+        return random.uniform(0, min(self.MAX_BACKOFF_SECONDS, self.BACKOFF_SECONDS * 2 ** (attempt - 1)))
+
+    def hedge_delay_seconds(self) -> float:
+        if len(self.latencies) < self.LATENCY_SAMPLES_FOR_HEDGING:
+            return self.DEFAULT_HEDGE_DELAY_SECONDS
+        ordered = sorted(self.latencies)
+        return max(self.MIN_HEDGE_DELAY_SECONDS, ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))])
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "failures": self.failures,
+            "abandoned": self.abandoned,
+            "hedge_delay_ms": self.hedge_delay_seconds() * 1000 if self.hedge else 0.0,
+        }
+
+    async def __attempt(self, call: Callable[[], Awaitable[T]], priority: int, estimated_tokens: Optional[int], charge_abandoned: Optional[Callable[[], None]],
+                        slot_acquired: Optional[asyncio.Future] = None) -> T:
+        # slot_acquired gets the time the attempt got its scheduler slot
+        async with llm_scheduler.slot(priority, estimated_tokens):
+            start = time.monotonic()
+            if slot_acquired is not None and not slot_acquired.done():
+                slot_acquired.set_result(start)
+            try:
+                result = await asyncio.wait_for(call(), self.timeout_seconds)
+            except asyncio.TimeoutError as e:
+                self.__abandon(charge_abandoned)
+                if time.monotonic() - start < self.timeout_seconds:
+                    # Raised by the call itself, not the deadline
+                    raise
+                self.timeouts += 1
+                print(f"{self.name} timed out after {self.timeout_seconds:.1f}s")
+                raise DeadlineExceeded(f"{self.name} timed out after {self.timeout_seconds:.1f}s") from e
+            except BaseException:
+                # Cancelled hedge losers included
+                self.__abandon(charge_abandoned)
+                raise
+            if not self.hedge:
+                self.latencies.append(time.monotonic() - start)
+            return result
+
+    async def __hedged_attempt(self, call: Callable[[], Awaitable[T]], priority: int, estimated_tokens: Optional[int], charge_abandoned: Optional[Callable[[], None]]) -> T:
+        # The hedge delay, and the latency, run from when the primary gets its scheduler slot: a request still queued
+        # behind others isn't slow, and hedging it would only add load when capacity is short. Latency is measured
+        # from the primary, the cancelled loser of a hedge never reports its own and leaving it out would make the
+        # p95 ever lower.
+        slot_acquired: asyncio.Future = asyncio.get_running_loop().create_future()
+        primary = asyncio.ensure_future(self.__attempt(call, priority, estimated_tokens, charge_abandoned, slot_acquired))
+        tasks: Set[asyncio.Future] = {primary}
+        try:
+            await asyncio.wait([primary, slot_acquired], return_when=asyncio.FIRST_COMPLETED)
+            if not primary.done():
+                start = slot_acquired.result()
+                await asyncio.wait(tasks, timeout=max(0.0, self.hedge_delay_seconds() - (time.monotonic() - start)))
+            if primary.done():
+                result = primary.result()
+                self.latencies.append(time.monotonic() - slot_acquired.result())
+                return result
+            self.hedges += 1
+            hedge = asyncio.ensure_future(self.__attempt(call, priority, estimated_tokens, charge_abandoned))
+            tasks.add(hedge)
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        self.latencies.append(time.monotonic() - start)
+                        return task.result()
+                    error = task.exception()
+            assert error is not None
+            raise error
+        finally:
+            # The losing request is abandoned, its slot goes back to the scheduler
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def __abandon(self, charge_abandoned: Optional[Callable[[], None]]) -> None:
+        self.abandoned += 1
+        if charge_abandoned is not None:
+            charge_abandoned()
+
+
+class RequestPolicies:
+    def __init__(self) -> None:
+        self.policies: Dict[str, RequestPolicy] = {}
+
+    def __call__(self, name: str) -> RequestPolicy:
+        policy = self.policies.get(name)
+        if policy is None:
+            timeout_seconds, attempts, hedge = POLICY_DEFAULTS.get(name, (60.0, 2, False))
+            prefix = "REQUEST_POLICY_" + name.upper() + "_"
+            policy = RequestPolicy(
+                name,
+                float(os.environ.get(prefix + "TIMEOUT_SECONDS", timeout_seconds)),
+                int(os.environ.get(prefix + "ATTEMPTS", attempts)),
+                os.environ.get(prefix + "HEDGE", "1" if hedge else "0") == "1",
+            )
+            self.policies[name] = policy
+        return policy
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {name: policy.stats() for name, policy in self.policies.items()}
+
+
+request_policy = RequestPolicies()
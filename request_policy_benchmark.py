@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+import os
+import time
+
+# Tail latency and failures of chat completion calls against a local stub of the OpenAI API that makes a fraction of
+# requests slow and fails some others, called directly, with a deadline and retries, and with hedging as well.
+
+
+async def run_calls(stub, calls: int, concurrency: int, policy):
+    from client_registry import client_registry
+    from llm_scheduler import RETRIEVAL
+
+    chat_model = client_registry.chat_model(temperature=0.0)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def call(i: int):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                if policy is None:
+                    await chat_model.apredict("benchmark " + str(i))
+                else:
+                    await policy.run(lambda: chat_model.apredict("benchmark " + str(i)), RETRIEVAL, 100)
+            except Exception:
+                failures += 1
+            latencies.append(time.perf_counter() - start)
+
+    await client_registry.open_session()
+    requests_before = stub.requests
+    await asyncio.gather(*[call(i) for i in range(calls)])
+    await client_registry.close_session()
+    return latencies, failures, stub.requests - requests_before
+
+
+async def benchmark(args) -> None:
+    import openai
+    from client_registry_benchmark import percentiles
+    from openai_stub_server import OpenAIStubServer
+    from request_policy import RequestPolicy
+
+    stub = OpenAIStubServer(args.latency_ms / 1000, slow_fraction=args.slow_fraction, slow_latency_seconds=args.slow_latency_ms / 1000,
+                            error_rate=args.error_rate, seed=0)
+    await stub.start()
+    openai.api_base = stub.api_base
+    os.environ["OPENAI_API_BASE"] = stub.api_base
+
+    print(f"{args.calls} calls at concurrency {args.concurrency}, {args.latency_ms:.0f} ms server latency, "
+          f"{args.slow_fraction:.0%} slowed to {args.slow_latency_ms:.0f} ms, {args.error_rate:.0%} failing")
+    timeout_seconds = args.timeout_ms / 1000
+    policies = [
+        ("single attempt", None),
+        ("deadline + retries", RequestPolicy("deadline", timeout_seconds, attempts=3)),
+        ("hedged", RequestPolicy("hedged", timeout_seconds, attempts=3, hedge=True)),
+    ]
+    for name, policy in policies:
+        if policy is not None:
+            # Hedge from a measured p95 rather than the production default
+            policy.BACKOFF_SECONDS = 0.05
+            await run_calls(stub, policy.LATENCY_SAMPLES_FOR_HEDGING, args.concurrency, policy)
+        latencies, failures, requests = await run_calls(stub, args.calls, args.concurrency, policy)
+        print(f"{name:20} {percentiles(latencies)}, max {max(latencies) * 1000:7.2f} ms, {failures} failed, {requests} requests")
+        if policy is not None:
+            print(f"{'':20} {policy.stats()}")
+    await stub.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark request deadlines, retries and hedging against a local stub server")
+    parser.add_argument("--calls", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--slow-fraction", type=float, default=0.05)
+    parser.add_argument("--slow-latency-ms", type=float, default=2000)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--timeout-ms", type=float, default=1000)
+    args = parser.parse_args()
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    asyncio.run(benchmark(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import asyncio
+import itertools
+import os
+import time
+import traceback
+from typing import Dict, List, Optional, Tuple
+
+from conversation import Conversation
+from document_index import DocumentIndex
+from memory import Memory
+from memory_retriever import MemoryRetriever
+from web_searcher import WebSearcher
+
+
+class RetrievalExecutor:
+    # Runs every tool the MemoryRetriever asked for at once, so a reply waits for the slowest tool instead of all of
+    # them in turn. A tool that fails or runs out of time contributes nothing instead of failing the reply.
+    LONG_TERM_MEMORY_TIMEOUT_SECONDS = float(os.environ.get("RETRIEVAL_LONG_TERM_MEMORY_TIMEOUT_SECONDS", 10))
+    WEB_SEARCH_TIMEOUT_SECONDS = float(os.environ.get("RETRIEVAL_WEB_SEARCH_TIMEOUT_SECONDS", 30))
+    LONG_TERM_MEMORY_TOKEN_THRESHOLD = 500
+
+    def __init__(self, conversation: Conversation) -> None:
+        self.conversation = conversation
+
+    async def run(self, requested_memory: List[Tuple[str, str]]) -> Tuple[str, Optional[List[Memory]], List[str]]:
+        # Returns the active memory, the merged long term memories (None if none were requested) and the web
+        # results, the PromptAssembler fits them into the prompt
+        tool_calls = self.__unique_tool_calls(requested_memory)
+        results = await asyncio.gather(*[self.__run_tool(command, parameter) for command, parameter in tool_calls])
+        results_by_command: Dict[str, list] = {}
+        for (command, parameter), result in zip(tool_calls, results):
+            results_by_command.setdefault(command, []).append(result)
+
+        active_memory = ''
+        if MemoryRetriever.SUMMARIZED_MEMORY in results_by_command:
+            active_memory = self.conversation.active_memory
+        long_term_memories = None
+        if MemoryRetriever.LONG_TERM_MEMORY in results_by_command:
+            long_term_memories = self.__merge_memories(results_by_command[MemoryRetriever.LONG_TERM_MEMORY])
+        browse_results = [result for result in results_by_command.get(MemoryRetriever.WEB_SEARCH, []) if result]
+        return active_memory, long_term_memories, browse_results
+
+    def __unique_tool_calls(self, requested_memory: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        tool_calls: List[Tuple[str, str]] = []
+        for command, parameter in requested_memory:
+            tool_call = (command, parameter.strip())
+            if command in [MemoryRetriever.SUMMARIZED_MEMORY, MemoryRetriever.LONG_TERM_MEMORY, MemoryRetriever.WEB_SEARCH] and tool_call not in tool_calls:
+                tool_calls.append(tool_call)
+        return tool_calls
+
+    async def __run_tool(self, command: str, parameter: str):
+        start = time.monotonic()
+        try:
+            if command == MemoryRetriever.LONG_TERM_MEMORY:
+                print("Long term memory: " + parameter)
+                return await asyncio.wait_for(self.conversation.memory_index.asearch_index(parameter, token_threshold=self.LONG_TERM_MEMORY_TOKEN_THRESHOLD), self.LONG_TERM_MEMORY_TIMEOUT_SECONDS)
+            if command == MemoryRetriever.WEB_SEARCH:
+                print("Web search: " + parameter)
+                return await asyncio.wait_for(WebSearcher().run(parameter), self.WEB_SEARCH_TIMEOUT_SECONDS)
+            print("Summarized memory")
+            return None
+        except asyncio.TimeoutError:
+            print(f"{command}[{parameter}] timed out after {time.monotonic() - start:.2f}s")
+        except Exception as e:
+            print(f"Ignoring error from {command}[{parameter}]: " + str(e))
+            traceback.print_exc()
+        return [] if command == MemoryRetriever.LONG_TERM_MEMORY else ''
+
+    def __merge_memories(self, memory_lists):
+        # Takes the best hit of every query before the second best of any, so each query is represented
+        # within the single long term memory budget
+        merged = []
+        seen_ids = set()
+        for memory in itertools.chain.from_iterable(itertools.zip_longest(*memory_lists)):
+            if memory is not None and memory.id not in seen_ids:
+                seen_ids.add(memory.id)
+                merged.append(memory)
+        return DocumentIndex.within_token_budget(merged, self.LONG_TERM_MEMORY_TOKEN_THRESHOLD)
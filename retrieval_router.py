@@ -0,0 +1,127 @@
+import asyncio
+import os
+import random
+import re
+import traceback
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from llm_scheduler import SHADOW
+from memory_retriever import MemoryRetriever
+
+ToolCalls = List[Tuple[str, str]]
+
+
+class RoutingRule:
+    def __init__(self, name: str, pattern: str, confidence: float, tools: Callable[[str], ToolCalls], max_words: Optional[int] = None) -> None:
+        self.name = name
+        self.pattern = re.compile(pattern, re.IGNORECASE)
+        self.confidence = confidence
+        self.tools = tools
+        self.max_words = max_words
+
+    def matches(self, text: str) -> bool:
+        if self.max_words is not None and len(text.split()) > self.max_words:
+            return False
+        return self.pattern.search(text) is not None
+
+
+class RetrievalRouter:
+    # Picks the retrieval tools for the messages being answered with keyword rules, and only asks the MemoryRetriever LLM when
+    # no rule is confident enough. A sample of confident routes is also sent to the LLM in the background to measure
+    # how often the two agree, per rule, which is what CONFIDENCE_THRESHOLD should be tuned against.
+    CONFIDENCE_THRESHOLD = float(os.environ.get("RETRIEVAL_ROUTER_CONFIDENCE_THRESHOLD", 0.8))
+    SHADOW_SAMPLE_RATE = float(os.environ.get("RETRIEVAL_ROUTER_SHADOW_SAMPLE_RATE", 0.1))
+    RULES = [
+        RoutingRule("greeting", r"^\W*(hi|hello|hey|yo|sup|gm|good (morning|night|evening)|thanks|thank you|thx|ty|lol|lmao|haha|nice|cool|ok|okay|bye)\b", 0.9,
+                    lambda text: [(MemoryRetriever.SUMMARIZED_MEMORY, "")], max_words=6),
+        # Only a code fence or asking to write or fix code in the same sentence, "java" or "function" alone are just as
+        # often small talk. Shadowing measured no agreement with the retriever on the bare keywords, so this stays under
+        # the default threshold until it does.
+        RoutingRule("code", r"```|\b(write|fix|debug|refactor|implement|convert|translate|port)\b[^.?!\n]*(\b(code|function|method|class|script|regex|query|program)\b|\bin (python|javascript|typescript|rust|go|golang|java|c\+\+|c#|bash|sql)(?!\w))", 0.75,
+                    lambda text: [("CodeGen", "")]),
+        RoutingRule("recall", r"\b(remember|recall|we (talked|discussed|said)|you said|i (told|said)|last (time|week|month)|yesterday|earlier)\b", 0.8,
+                    lambda text: [(MemoryRetriever.LONG_TERM_MEMORY, text), (MemoryRetriever.SUMMARIZED_MEMORY, "")]),
+        RoutingRule("follow_up", r"^\W*(why|how|what about|and|so|really|are you sure|what do you mean|explain|tell me more|more)\b", 0.8,
+                    lambda text: [(MemoryRetriever.SUMMARIZED_MEMORY, "")], max_words=8),
+        # The LLM writes better search queries, so this stays under the default threshold until agreement says otherwise
+        RoutingRule("current_events", r"\b(latest|news|today|tonight|this (week|year)|current(ly)?|price|weather|score|who won|released?|20[2-9]\d)\b", 0.7,
+                    lambda text: [(MemoryRetriever.WEB_SEARCH, text)]),
+    ]
+    MENTION = re.compile(r"<@!?[^>]+>")
+
+    def __init__(self) -> None:
+        self.routed = 0
+        self.fallbacks = 0
+        self.conflicts = 0
+        # rule name -> [comparisons, agreements]
+        self.agreement: Dict[str, List[int]] = {}
+        self.shadow_tasks: Set[asyncio.Task] = set()
+
+    async def arun(self, conversation, discord_name: str, answered: Optional[list] = None) -> ToolCalls:
+        # answered are the coalesced mentions a reply answers, the last message in the conversation by default
+        if answered is None:
+            answered = conversation.conversation_history[-1:]
+        text = "\n".join(self.MENTION.sub('', message.content).strip() for message in answered)
+        formatted_conversation = conversation.get_formatted_conversation(through=answered[-1] if answered else None)
+        rule = self.match(text)
+        if rule is not None and rule.confidence >= self.CONFIDENCE_THRESHOLD:
+            self.routed += 1
+            tool_calls = rule.tools(text)
+            print(f"Routed by {rule.name}: {tool_calls}")
+            if random.random() < self.SHADOW_SAMPLE_RATE:
+                shadow_task = asyncio.create_task(self.__compare_with_retriever(rule, tool_calls, formatted_conversation, discord_name))
+                self.shadow_tasks.add(shadow_task)
+                shadow_task.add_done_callback(self.shadow_tasks.discard)
+            return tool_calls
+        self.fallbacks += 1
+        retriever_tool_calls = await MemoryRetriever().arun(formatted_conversation, discord_name)
+        if rule is not None:
+            # Unconfident rules are compared on every fallback for free
+            self.__record_agreement(rule, rule.tools(text), retriever_tool_calls)
+        return retriever_tool_calls
+
+    def match(self, message: str) -> Optional[RoutingRule]:
+        # Every rule is tried. Rules picking different tools (e.g. code to recall from yesterday) are a conflict the
+        # retriever settles, otherwise the most confident one wins.
+        text = self.MENTION.sub('', message).strip()
+        matched = [rule for rule in self.RULES if rule.matches(text)]
+        if not matched:
+            return None
+        if len({frozenset(command for command, parameter in rule.tools(text)) for rule in matched}) > 1:
+            self.conflicts += 1
+            return None
+        return max(matched, key=lambda rule: rule.confidence)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.routed + self.fallbacks
+        stats: Dict[str, float] = {
+            "routed": self.routed,
+            "fallbacks": self.fallbacks,
+            "conflicts": self.conflicts,
+            "hit_rate": self.routed / total if total else 0.0,
+        }
+        for name, (comparisons, agreements) in self.agreement.items():
+            stats[name + "_comparisons"] = comparisons
+            stats[name + "_agreement"] = agreements / comparisons
+        return stats
+
+    async def __compare_with_retriever(self, rule: RoutingRule, tool_calls: ToolCalls, formatted_conversation: str, discord_name: str) -> None:
+        try:
+            self.__record_agreement(rule, tool_calls, await MemoryRetriever().arun(formatted_conversation, discord_name, SHADOW))
+        except Exception as e:
+            print("Ignoring error comparing routed tools with the retriever: " + str(e))
+            traceback.print_exc()
+
+    def __record_agreement(self, rule: RoutingRule, tool_calls: ToolCalls, retriever_tool_calls: ToolCalls) -> None:
+        # Only the set of tools is compared, query wording and Answer[] don't count
+        routed_tools = {command for command, parameter in tool_calls if command != "Answer"}
+        retriever_tools = {command for command, parameter in retriever_tool_calls if command != "Answer"}
+        counts = self.agreement.setdefault(rule.name, [0, 0])
+        counts[0] += 1
+        if routed_tools == retriever_tools:
+            counts[1] += 1
+        else:
+            print(f"Router rule {rule.name} chose {sorted(routed_tools)}, retriever chose {sorted(retriever_tools)}")
+
+
+retrieval_router = RetrievalRouter()
@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import itertools
+import time
+from types import SimpleNamespace
+
+from reply_streamer import ReplyStreamer, stream_reply
+from utils import clean_up_response
+
+# Time to first visible text for a blocking reply against a streamed one, with a fake LLM that produces a
+# completion shaped like RESPONSE_TEMPLATE one token at a time and a fake channel that records sends and edits.
+
+DISCORD_NAME = 'EhrlichGPT'
+
+
+class FakeStreamingLLM:
+    def __init__(self, completion: str, seconds_per_token: float, first_token_seconds: float) -> None:
+        self.tokens = [completion[i:i + 4] for i in range(0, len(completion), 4)]
+        self.seconds_per_token = seconds_per_token
+        self.first_token_seconds = first_token_seconds
+
+    async def astream(self, messages):
+        await asyncio.sleep(self.first_token_seconds)
+        for token in self.tokens:
+            await asyncio.sleep(self.seconds_per_token)
+            yield SimpleNamespace(content=token)
+
+    async def apredict(self) -> str:
+        return ''.join([chunk.content async for chunk in self.astream([])])
+
+
+class FakeMessage:
+    ids = itertools.count(1)
+
+    def __init__(self, channel, content: str) -> None:
+        self.id = next(FakeMessage.ids)
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content: str) -> None:
+        self.channel.edits += 1
+        self.content = content
+
+    async def delete(self) -> None:
+        self.channel.messages.remove(self)
+
+
+class FakeChannel:
+    def __init__(self) -> None:
+        self.messages = []
+        self.edits = 0
+        self.first_send = None
+
+    async def send(self, content: str) -> FakeMessage:
+        assert 0 < len(content) <= ReplyStreamer.MAX_MESSAGE_LENGTH
+        if self.first_send is None:
+            self.first_send = time.monotonic()
+        message = FakeMessage(self, content)
+        self.messages.append(message)
+        return message
+
+
+def fake_completion(response_length: int) -> str:
+    sentence = "This is a fairly ordinary sentence from a streamed reply.\n"
+    response = (sentence * (response_length // len(sentence) + 1))[:response_length]
+    return "Investigation results: sam#1234 asks for a long answer\nResponse: " + DISCORD_NAME + ": " + response
+
+
+async def blocking_reply(llm: FakeStreamingLLM, channel: FakeChannel) -> float:
+    start = time.monotonic()
+    response = clean_up_response(DISCORD_NAME, await llm.apredict())
+    await channel.send(response[:2000])
+    return channel.first_send - start
+
+
+async def streamed_reply(llm: FakeStreamingLLM, channel: FakeChannel) -> float:
+    start = time.monotonic()
+    await stream_reply(llm, [], channel, DISCORD_NAME)
+    return channel.first_send - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark time to first visible text of streamed replies")
+    parser.add_argument("--response-length", type=int, default=3000)
+    parser.add_argument("--tokens-per-second", type=float, default=400)
+    parser.add_argument("--first-token-ms", type=float, default=500)
+    parser.add_argument("--edit-interval", type=float, default=0.5)
+    args = parser.parse_args()
+    ReplyStreamer.EDIT_INTERVAL_SECONDS = args.edit_interval
+
+    completion = fake_completion(args.response_length)
+    expected = clean_up_response(DISCORD_NAME, completion)
+
+    blocking_channel = FakeChannel()
+    blocking_seconds = asyncio.run(blocking_reply(FakeStreamingLLM(completion, 1 / args.tokens_per_second, args.first_token_ms / 1000), blocking_channel))
+    streamed_channel = FakeChannel()
+    streamed_seconds = asyncio.run(streamed_reply(FakeStreamingLLM(completion, 1 / args.tokens_per_second, args.first_token_ms / 1000), streamed_channel))
+
+    delivered = '\n'.join(message.content for message in streamed_channel.messages)
+    print(f"{len(expected)} character response")
+    print(f"blocking: first text after {blocking_seconds:6.2f} s, {len(blocking_channel.messages[0].content)} characters delivered")
+    print(f"streamed: first text after {streamed_seconds:6.2f} s, {len(streamed_channel.messages)} messages, {streamed_channel.edits} edits, complete: {delivered == expected}")
+
+
+if __name__ == "__main__":
+    main()
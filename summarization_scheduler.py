@@ -0,0 +1,88 @@
+import asyncio
+import os
+import traceback
+from typing import Dict, Set
+
+from repository import Repository
+
+
+class SummarizationScheduler:
+    # Summarizes a channel in the background once its transcript passes the token watermark, requests that arrive
+    # while one is already waiting out the debounce are folded into it. A channel is only ever summarized by one task
+    # at a time, later ones wait for it and then summarize what's left.
+    DEBOUNCE_SECONDS = float(os.environ.get("SUMMARIZATION_DEBOUNCE_SECONDS", 2.0))
+
+    def __init__(self) -> None:
+        self.pending: Dict[int, asyncio.Task] = {}
+        # The loop only keeps weak references to tasks, these keep debounced summaries alive until they finish
+        self.tasks: Set[asyncio.Task] = set()
+        self.running: Dict[int, asyncio.Lock] = {}
+        self.trigger_token_limits: Dict[int, int] = {}
+        self.summaries_run = 0
+        self.summaries_skipped = 0
+        self.summaries_debounced = 0
+        self.tokens_saved = 0
+
+    def schedule(self, conversation, trigger_token_limit: int) -> bool:
+        pending_tokens = conversation.get_conversation_token_count()
+        if pending_tokens <= trigger_token_limit:
+            # The transcript that would have been sent to the summarizer
+            self.summaries_skipped += 1
+            self.tokens_saved += pending_tokens
+            return False
+        channel_id = conversation.conversation_id
+        self.trigger_token_limits[channel_id] = min(trigger_token_limit, self.trigger_token_limits.get(channel_id, trigger_token_limit))
+        if channel_id in self.pending:
+            self.summaries_debounced += 1
+            self.tokens_saved += pending_tokens
+            return True
+        task = asyncio.create_task(self.__run_debounced(conversation))
+        self.pending[channel_id] = task
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+    async def summarize_now(self, conversation, trigger_token_limit: int) -> bool:
+        # For callers that need the trimmed history right away, replaces any summary still waiting on its debounce
+        channel_id = conversation.conversation_id
+        pending_task = self.pending.pop(channel_id, None)
+        if pending_task is not None:
+            pending_task.cancel()
+            trigger_token_limit = min(trigger_token_limit, self.trigger_token_limits.pop(channel_id, trigger_token_limit))
+        return await self.__summarize(conversation, trigger_token_limit)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self.pending),
+            "running": sum(1 for lock in self.running.values() if lock.locked()),
+            "summaries_run": self.summaries_run,
+            "summaries_skipped": self.summaries_skipped,
+            "summaries_debounced": self.summaries_debounced,
+            "tokens_saved": self.tokens_saved,
+        }
+
+    async def __run_debounced(self, conversation) -> None:
+        channel_id = conversation.conversation_id
+        await asyncio.sleep(self.DEBOUNCE_SECONDS)
+        # Past the debounce the task is no longer pending, so summarize_now can't cancel it mid summary, it waits for
+        # it instead
+        self.pending.pop(channel_id, None)
+        trigger_token_limit = self.trigger_token_limits.pop(channel_id)
+        try:
+            await self.__summarize(conversation, trigger_token_limit)
+        except Exception as e:
+            print("Ignoring error summarizing " + str(channel_id) + ": " + str(e))
+            traceback.print_exc()
+
+    async def __summarize(self, conversation, trigger_token_limit: int) -> bool:
+        channel_id = conversation.conversation_id
+        async with self.running.setdefault(channel_id, asyncio.Lock()):
+            needed_summary = await Repository(channel_id).summarize_conversation(conversation, trigger_token_limit=trigger_token_limit)
+        if needed_summary:
+            self.summaries_run += 1
+        else:
+            self.summaries_skipped += 1
+        return needed_summary
+
+
+summarization_scheduler = SummarizationScheduler()
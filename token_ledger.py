@@ -0,0 +1,177 @@
+import asyncio
+import os
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+from repository import Repository
+from tokenizer import count_tokens
+from tracing import current_channel
+
+# USD per million (prompt, completion) tokens, unknown models are priced like gpt-4o to stay on the safe side
+PRICES_PER_MILLION_TOKENS = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "text-embedding-ada-002": (0.10, 0.0),
+    "text-moderation-latest": (0.0, 0.0),
+}
+DEFAULT_PRICE = PRICES_PER_MILLION_TOKENS["gpt-4o"]
+
+# Budget levels, each one also degrades everything the levels before it do
+FULL = 0
+NO_GPT_4 = 1
+NO_WEB_SEARCH = 2
+OVER_BUDGET = 3
+LEVEL_NAMES = ["full", "no_gpt_4", "no_web_search", "over_budget"]
+
+
+def parse_channel_budgets(value: str) -> Dict[int, float]:
+    # "channel_id:usd,channel_id:usd"
+    budgets = {}
+    for entry in value.split(','):
+        if entry.strip():
+            channel_id, usd = entry.split(':')
+            budgets[int(channel_id)] = float(usd)
+    return budgets
+
+
+class TokenLedger:
+    # Every LLM, embedding and moderation call is recorded with its channel, call site and model in the channel's
+    # append-only llm_usage table, rolled up per hour in llm_usage_hourly. The last WINDOW_HOURS of spend, kept in
+    # memory per hour, decide how a channel's replies are degraded: no gpt-4o past half its daily budget, no web
+    # search past 80% and no LLM replies past all of it.
+    DAILY_BUDGET_USD = float(os.environ.get("CHANNEL_DAILY_BUDGET_USD", 2.0))
+    CHANNEL_BUDGETS_USD = parse_channel_budgets(os.environ.get("CHANNEL_BUDGETS_USD", ""))
+    LEVEL_THRESHOLDS = [(OVER_BUDGET, 1.0), (NO_WEB_SEARCH, 0.8), (NO_GPT_4, 0.5)]
+    WINDOW_HOURS = 24
+
+    def __init__(self) -> None:
+        # channel id -> hour (unix seconds) -> USD spent, loaded from llm_usage_hourly the first time a channel is seen
+        self.hourly_costs: Dict[int, Dict[int, float]] = {}
+        self.loads: Dict[int, "asyncio.Task[None]"] = {}
+        # channel id -> (llm_usage id future, hour, USD) recorded while the channel is being loaded
+        self.recorded_during_load: Dict[int, List[Tuple[Future, int, float]]] = {}
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.untagged_calls = 0
+        self.replies_by_level = [0] * len(LEVEL_NAMES)
+
+    def record(self, call_site: str, model: str, prompt_tokens: int, completion_tokens: int, channel_id: Optional[int] = None) -> None:
+        # channel_id defaults to the channel whose messages are being handled
+        if channel_id is None:
+            channel = current_channel()
+            channel_id = int(channel) if channel else None
+        cost = self.cost_of(model, prompt_tokens, completion_tokens)
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cost += cost
+        if channel_id is None:
+            self.untagged_calls += 1
+            return
+        timestamp = int(time.time())
+        hour = timestamp - timestamp % 3600
+        usage_id = Repository(channel_id).save_llm_usage(timestamp, call_site, model, prompt_tokens, completion_tokens, cost)
+        # A channel that isn't loaded yet reads this back from llm_usage_hourly with the rest
+        hourly_costs = self.hourly_costs.get(channel_id)
+        if hourly_costs is not None:
+            hourly_costs[hour] = hourly_costs.get(hour, 0.0) + cost
+        elif channel_id in self.recorded_during_load:
+            self.recorded_during_load[channel_id].append((usage_id, hour, cost))
+
+    def record_chain(self, call_site: str, chain, inputs: dict, completion: str, channel_id: Optional[int] = None) -> None:
+        model = chain.llm.model_name
+        prompt = chain.prompt.format_prompt(**inputs).to_string()
+        self.record(call_site, model, count_tokens(prompt, model), count_tokens(completion, model), channel_id)
+
+    def cost_of(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        prompt_price, completion_price = PRICES_PER_MILLION_TOKENS.get(model, DEFAULT_PRICE)
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+    def budget(self, channel_id: int) -> float:
+        return self.CHANNEL_BUDGETS_USD.get(channel_id, self.DAILY_BUDGET_USD)
+
+    async def aload(self, channel_id: int) -> None:
+        # Loads the channel's spend without blocking the event loop on the write-behind queue, spent() and
+        # budget_level() only read memory afterwards
+        load = self.loads.get(channel_id)
+        if load is None:
+            if channel_id in self.hourly_costs:
+                return
+            load = self.loads[channel_id] = asyncio.ensure_future(self.__load(channel_id))
+        await asyncio.shield(load)
+
+    def spent(self, channel_id: int) -> float:
+        hourly_costs = self.__hourly_costs(channel_id)
+        window_start = self.__window_start()
+        for hour in [hour for hour in hourly_costs if hour < window_start]:
+            del hourly_costs[hour]
+        return sum(hourly_costs.values())
+
+    def budget_level(self, channel_id: int) -> int:
+        budget = self.budget(channel_id)
+        fraction = self.spent(channel_id) / budget if budget > 0 else float('inf')
+        for level, threshold in self.LEVEL_THRESHOLDS:
+            if fraction >= threshold:
+                return level
+        return FULL
+
+    async def areport(self, channel_id: int) -> str:
+        await self.aload(channel_id)
+        level = self.budget_level(channel_id)
+        lines = [f"Spent ${self.spent(channel_id):.4f} of ${self.budget(channel_id):.2f} in the last {self.WINDOW_HOURS}h, replies are {LEVEL_NAMES[level]}"]
+        for call_site, model, calls, prompt_tokens, completion_tokens, cost in await Repository(channel_id).aload_llm_usage_by_call_site(self.__window_start()):
+            lines.append(f"{call_site:28} {model:24} {calls:6d} calls {prompt_tokens:9d} prompt {completion_tokens:8d} completion ${cost:.4f}")
+        return "\n".join(lines)
+
+    def stats(self) -> Dict[str, float]:
+        stats: Dict[str, float] = {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost_usd": self.cost,
+            "untagged_calls": self.untagged_calls,
+        }
+        for level, name in enumerate(LEVEL_NAMES):
+            stats["replies_" + name] = self.replies_by_level[level]
+        return stats
+
+    def __window_start(self) -> int:
+        now = int(time.time())
+        return now - now % 3600 - (self.WINDOW_HOURS - 1) * 3600
+
+    def __hourly_costs(self, channel_id: int) -> Dict[int, float]:
+        # Callers off the event loop (scripts) load it here, the bot awaits aload() first
+        hourly_costs = self.hourly_costs.get(channel_id)
+        if hourly_costs is None:
+            rows, _ = Repository(channel_id).load_llm_usage_by_hour(self.__window_start())
+            hourly_costs = self.hourly_costs[channel_id] = dict(rows)
+        return hourly_costs
+
+    async def __load(self, channel_id: int) -> None:
+        # Usage recorded while this loads may or may not be committed by the time the totals are read, it is added on
+        # top only if its llm_usage row is newer than the read
+        recorded = self.recorded_during_load[channel_id] = []
+        try:
+            rows, last_usage_id = await Repository(channel_id).aload_llm_usage_by_hour(self.__window_start())
+            hourly_costs = dict(rows)
+            merged = 0
+            while merged < len(recorded):
+                usage_id, hour, cost = recorded[merged]
+                merged += 1
+                try:
+                    newer = await asyncio.wrap_future(usage_id) > last_usage_id
+                except Exception:
+                    # Never saved, only the in memory total has it
+                    newer = True
+                if newer:
+                    hourly_costs[hour] = hourly_costs.get(hour, 0.0) + cost
+            self.hourly_costs[channel_id] = hourly_costs
+        finally:
+            del self.recorded_during_load[channel_id]
+            del self.loads[channel_id]
+
+
+token_ledger = TokenLedger()
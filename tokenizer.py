@@ -0,0 +1,53 @@
+import functools
+from typing import List
+
+import tiktoken
+
+# Every token count in the bot goes through here, encodings are loaded once per model and cached
+DEFAULT_MODEL = "gpt-4o-mini"
+FALLBACK_ENCODING = "cl100k_base"
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str = DEFAULT_MODEL) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Models newer than the installed tiktoken
+        return tiktoken.get_encoding(FALLBACK_ENCODING)
+
+
+def encode(text: str, model: str = DEFAULT_MODEL) -> List[int]:
+    # Chat text can contain things like <|endoftext|>, count them as plain text instead of raising
+    return get_encoding(model).encode(text, disallowed_special=())
+
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    if not text:
+        return 0
+    return len(encode(text, model))
+
+
+def count_tokens_batch(texts: List[str], model: str = DEFAULT_MODEL) -> List[int]:
+    if not texts:
+        return []
+    return [len(tokens) for tokens in get_encoding(model).encode_batch(texts, disallowed_special=())]
+
+
+def truncate_text(text: str, n_tokens: int, direction: int = 1, model: str = DEFAULT_MODEL) -> str:
+    if n_tokens < 1:
+        raise ValueError("n_tokens must be greater than 0")
+
+    tokens = encode(text, model)
+    if len(tokens) <= n_tokens:
+        return text
+
+    # Keep the first (or last) N tokens, decoded once as a slice
+    if direction > 0:
+        return get_encoding(model).decode(tokens[:n_tokens])
+    return get_encoding(model).decode(tokens[-n_tokens:])
+
+
+def tokenize_text(text: str, model: str = DEFAULT_MODEL) -> List[str]:
+    # Only for callers that need the token strings themselves (e.g. chunking), use count_tokens to count
+    return [token.decode('utf-8', errors='replace') for token in get_encoding(model).decode_tokens_bytes(encode(text, model))]
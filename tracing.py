@@ -0,0 +1,198 @@
+import bisect
+import contextvars
+import json
+import os
+import random
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+METRIC_PREFIX = "ehrlichgpt"
+
+HistogramKey = Tuple[str, str, str]
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self) -> None:
+        # One count per bucket plus the overflow, cumulated only when exported
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class Trace:
+    __slots__ = ("channel", "start", "spans", "finished")
+
+    def __init__(self, channel: str) -> None:
+        self.channel = channel
+        self.start = time.perf_counter()
+        # (stage, model, offset from the trace start, duration) in the order spans finished
+        self.spans: List[Tuple[str, str, float, float]] = []
+        self.finished = False
+
+
+class Span:
+    __slots__ = ("tracer", "stage", "model", "channel", "start")
+
+    def __init__(self, tracer: "Tracer", stage: str, model: str, channel: Optional[str]) -> None:
+        self.tracer = tracer
+        self.stage = stage
+        self.model = model
+        self.channel = channel
+        self.start = 0.0
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> bool:
+        self.tracer.observe(self.stage, time.perf_counter() - self.start, self.model, self.channel, self.start)
+        return False
+
+
+class TraceScope:
+    __slots__ = ("tracer", "trace", "token")
+
+    def __init__(self, tracer: "Tracer", channel: str) -> None:
+        self.tracer = tracer
+        self.trace = Trace(channel)
+        self.token: Optional[contextvars.Token] = None
+
+    def __enter__(self) -> Trace:
+        self.token = current_trace.set(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc, traceback) -> bool:
+        assert self.token is not None
+        current_trace.reset(self.token)
+        self.tracer.finish(self.trace)
+        return False
+
+
+# The trace of the reply being handled, tasks started while handling it inherit it
+current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("current_trace", default=None)
+
+
+def current_channel() -> Optional[str]:
+    trace = current_trace.get()
+    return trace.channel if trace is not None else None
+
+
+class Tracer:
+    # Times the stages of the reply pipeline into per (stage, channel, model) histograms. A trace groups the spans of
+    # one batch of messages from a channel, a sample of traces and every slow one are kept for /traces. Both, and the
+    # stats() of every registered subsystem, are served in Prometheus text format on /metrics.
+    TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.01))
+    SLOW_TRACE_SECONDS = float(os.environ.get("SLOW_TRACE_SECONDS", 10.0))
+    TRACE_BUFFER_SIZE = 100
+    METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+    METRICS_PORT = int(os.environ.get("METRICS_PORT", 9464))
+
+    def __init__(self) -> None:
+        self.histograms: Dict[HistogramKey, Histogram] = {}
+        self.traces: Deque[dict] = deque(maxlen=self.TRACE_BUFFER_SIZE)
+        self.stats_providers: Dict[str, Callable[[], dict]] = {}
+        self.runner: Optional[web.AppRunner] = None
+
+    def span(self, stage: str, model: str = '', channel: Optional[str] = None) -> Span:
+        # channel defaults to the current trace's, background work outside a trace should pass its own
+        return Span(self, stage, model, channel)
+
+    def trace(self, channel) -> TraceScope:
+        return TraceScope(self, str(channel))
+
+    def observe(self, stage: str, seconds: float, model: str = '', channel: Optional[str] = None, start: Optional[float] = None) -> None:
+        trace = current_trace.get()
+        if channel is None:
+            channel = trace.channel if trace is not None else ''
+        key = (stage, channel, model)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+        if trace is not None and not trace.finished:
+            trace.spans.append((stage, model, (start if start is not None else time.perf_counter() - seconds) - trace.start, seconds))
+
+    def finish(self, trace: Trace) -> None:
+        trace.finished = True
+        duration = time.perf_counter() - trace.start
+        self.observe("pipeline", duration, channel=trace.channel)
+        if duration >= self.SLOW_TRACE_SECONDS or random.random() < self.TRACE_SAMPLE_RATE:
+            self.traces.append({
+                "channel": trace.channel,
+                "started": time.time() - duration,
+                "duration_ms": round(duration * 1000, 3),
+                "spans": [{"stage": stage, "model": model, "offset_ms": round(offset * 1000, 3), "duration_ms": round(seconds * 1000, 3)}
+                          for stage, model, offset, seconds in trace.spans],
+            })
+
+    def register_stats(self, subsystem: str, provider: Callable[[], dict]) -> None:
+        self.stats_providers[subsystem] = provider
+
+    def render_metrics(self) -> str:
+        name = METRIC_PREFIX + "_stage_duration_seconds"
+        lines = [f"# HELP {name} Latency of reply pipeline stages", f"# TYPE {name} histogram"]
+        for (stage, channel, model), histogram in sorted(self.histograms.items()):
+            labels = f'stage="{stage}",channel="{channel}",model="{model}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+        name = METRIC_PREFIX + "_subsystem_stat"
+        lines += [f"# HELP {name} Counters and gauges reported by each subsystem's stats()", f"# TYPE {name} gauge"]
+        for subsystem, provider in sorted(self.stats_providers.items()):
+            for stat, value in sorted(self.__flatten(provider()).items()):
+                lines.append(f'{name}{{subsystem="{subsystem}",stat="{stat}"}} {float(value)}')
+        return "\n".join(lines) + "\n"
+
+    async def start_server(self) -> Optional[int]:
+        # Returns the port served on, or None when METRICS_PORT is 0
+        if self.METRICS_PORT == 0:
+            return None
+        app = web.Application()
+        app.router.add_get("/metrics", self.__metrics)
+        app.router.add_get("/traces", self.__traces)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.METRICS_HOST, self.METRICS_PORT)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        print(f"Serving metrics on http://{self.METRICS_HOST}:{port}/metrics")
+        return port
+
+    async def stop_server(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def __flatten(self, stats: dict, prefix: str = '') -> Dict[str, float]:
+        flat: Dict[str, float] = {}
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                flat.update(self.__flatten(value, prefix + str(key) + "_"))
+            elif isinstance(value, (int, float)):
+                flat[prefix + str(key)] = value
+        return flat
+
+    async def __metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render_metrics(), content_type="text/plain", charset="utf-8")
+
+    async def __traces(self, request: web.Request) -> web.Response:
+        return web.Response(text=json.dumps(list(self.traces), indent=1), content_type="application/json")
+
+
+tracer = Tracer()
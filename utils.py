@@ -1,39 +1,19 @@
 import random
 import discord
 
-import tiktoken
-from langchain.chains import LLMChain
-from langchain.chat_models import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from datetime import datetime
+from client_registry import client_registry
+from llm_scheduler import INTERACTIVE
+from request_policy import request_policy
+from token_ledger import token_ledger
+from typing import List
 
 
 def escape_prompt_content(content: str) -> str:
     return content.replace('{', '{{').replace('}', '}}')
 
 
-def truncate_text(text: str, n_tokens: int, direction: int=1) -> str:
-    if n_tokens < 1:
-        raise ValueError("n_tokens must be greater than 0")
-
-    # Split the text into tokens
-    tokens = tokenize_text(text)
-
-    # Keep the first N tokens and join them
-    if direction > 0:
-        truncated_tokens = tokens[:n_tokens]
-    else:
-        truncated_tokens = tokens[-n_tokens:]
-
-    return ''.join(truncated_tokens)
-
-
-def tokenize_text(text: str) -> list:
-    tokenizer = tiktoken.get_encoding('gpt2')
-    tokens = tokenizer.encode(text)
-
-    return [tokenizer.decode([token]) for token in tokens]
-
 def format_discord_mentions(message: discord.Message):
     formatted_content = message.content
 
@@ -44,6 +24,40 @@ def format_discord_mentions(message: discord.Message):
 
     return formatted_content
 
+def clean_up_response(discord_name, original_response):
+    print(f"Original response: {original_response}")
+    search_term = "Response:"
+    start_index = original_response.find(search_term)
+    response = ""
+    if start_index != -1:
+        response_start = start_index + len(search_term)
+        response = original_response[response_start:].strip()
+        response = response.strip('\"')
+    else:
+        response = original_response
+    if response.startswith(discord_name + ":"):
+        response = response[len(discord_name + ":"):]
+    elif response.startswith("AI:"):
+        response = response[len("AI:"):]
+    return response.strip()
+
+def split_message(text: str, max_length: int = 2000) -> List[str]:
+    # Splits on the last newline, else the last space, that keeps each part within Discord's message length limit
+    parts = []
+    while len(text) > max_length:
+        split_at = text.rfind('\n', 0, max_length + 1)
+        if split_at <= 0:
+            split_at = text.rfind(' ', 0, max_length + 1)
+        if split_at <= 0:
+            parts.append(text[:max_length])
+            text = text[max_length:]
+        else:
+            parts.append(text[:split_at])
+            text = text[split_at + 1:]
+    if text or not parts:
+        parts.append(text)
+    return parts
+
 def get_formatted_date():
     current_datetime = datetime.now()
     return current_datetime.strftime('%Y-%m-%d %H:%M:%S')
@@ -64,7 +78,7 @@ async def scold() -> str:
     feeling_1 = random.choice(feelings_list)
     feeling_2 = random.choice(feelings_list)
 
-    prompt = PromptTemplate(
+    chain = client_registry.chain("scold", lambda: PromptTemplate(
         input_variables=["feeling_1", "feeling_2"],
         template="""Help me write to a friend that has said something terrible to me. I can't even repeat it, it's so bad, so just imagine the worst thing you can think of.
 My goal is to respond with kindness, but tell them that I didn't appreciate how it made me feel.
@@ -72,10 +86,9 @@ Be sure to include the following ways it made me feel:
 {feeling_1}, {feeling_2}
 Try to keep it short.
 Dear friend,""",
-    )
-
-    llm = ChatOpenAI(temperature=0.9, model="gpt-4o-mini") # type: ignore
-    chain = LLMChain(llm=llm, prompt=prompt)
-    generated_paragraph = await chain.arun(feeling_1=feeling_1, feeling_2=feeling_2)
+    ), temperature=0.9)
+    inputs = dict(feeling_1=feeling_1, feeling_2=feeling_2)
+    generated_paragraph = await request_policy("scold").run(lambda: chain.arun(**inputs), INTERACTIVE, None, lambda: token_ledger.record_chain("scold", chain, inputs, ''))
+    token_ledger.record_chain("scold", chain, inputs, generated_paragraph)
 
     return generated_paragraph
@@ -1,9 +1,12 @@
 from typing import Optional, Tuple
 from langchain.llms.base import BaseLLM
-from langchain import LLMChain
 from langchain.prompts import PromptTemplate
-from langchain.chat_models import ChatOpenAI
 
+from client_registry import client_registry
+from llm_scheduler import RETRIEVAL
+from request_policy import request_policy
+from token_ledger import token_ledger
+from tracing import tracer
 from web_extractor import WebExtractor
 from bing_search import BingSearch
 
@@ -81,32 +84,37 @@ Answer:"""
     def __init__(self) -> None:
         self.web_extractor = WebExtractor()
         self.web_searcher = BingSearch()
-        self.llm = ChatOpenAI(temperature=0.0, model="gpt-4o-mini") # type: ignore
+        self.llm = client_registry.chat_model(temperature=0.0)
 
     async def run(self, search_query: str) -> str:
-        results = await self.web_searcher.results(search_query)
+        with tracer.span("bing_search"):
+            results = await self.web_searcher.results(search_query)
         if len(results) == 0:
             return ""
 
         snippets = ['WEB RESULT\n' + result.name + '\n' + result.snippet + '\n\n' for result in results]
 
         url_to_extract = results[0].url
-        chunks = await self.web_extractor.extract_text(url_to_extract)
+        with tracer.span("page_fetch"):
+            chunks = await self.web_extractor.extract_text(url_to_extract)
         if len(chunks) == 0:
             chunks = ["There was an error loading the web page"]
 
-        chain = LLMChain(llm=self.llm, prompt=PromptTemplate(
+        chain = client_registry.chain("web_browse", lambda: PromptTemplate(
                 template=self.BROWSE_TEMPLATE,
                 input_variables=["snippets", "search_query", "extracted_text", "browsed_url"]
-            )
+            ), temperature=0.0
         )
         print(snippets)
         print(chunks[0])
-        response = await chain.arun(
+        inputs = dict(
             search_query=search_query,
             snippets=snippets,
             extracted_text=chunks[0],
             browsed_url=url_to_extract
         )
+        with tracer.span("browse_llm", chain.llm.model_name):
+            response = await request_policy("web_browse").run(lambda: chain.arun(**inputs), RETRIEVAL, None, lambda: token_ledger.record_chain("WebSearcher", chain, inputs, ''))
+        token_ledger.record_chain("WebSearcher", chain, inputs, response)
         print(response)
         return response.strip()
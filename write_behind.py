@@ -0,0 +1,206 @@
+import asyncio
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from connection_manager import connection_manager
+
+WriteIntent = Callable[[sqlite3.Connection], Any]
+
+
+class WriteBehindQueue:
+    # Writes are applied in submission order by a single writer thread, each batch in one transaction per database
+    MAX_BATCH_SIZE = 256
+    STATS_LOG_INTERVAL_SECONDS = 300
+
+    def __init__(self) -> None:
+        self.queue: "queue.Queue[Optional[Tuple[Optional[str], Optional[WriteIntent], Future, float]]]" = queue.Queue()
+        self.connections: Dict[str, sqlite3.Connection] = {}
+        self.thread: Optional[threading.Thread] = None
+        self.start_lock = threading.Lock()
+        self.max_queue_depth = 0
+        self.batches_flushed = 0
+        self.writes_flushed = 0
+        self.write_errors = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+        self.max_write_delay = 0.0
+        self.last_stats_log = time.monotonic()
+
+    def submit(self, db_path: str, intent: WriteIntent) -> Future:
+        # Returns a future with the intent's return value, resolved once its transaction commits
+        self.__ensure_started()
+        future: Future = Future()
+        self.queue.put((db_path, intent, future, time.monotonic()))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return future
+
+    def barrier(self) -> Future:
+        # Resolves once every write submitted before it has been committed
+        self.__ensure_started()
+        future: Future = Future()
+        self.queue.put((None, None, future, time.monotonic()))
+        return future
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        if self.thread is None:
+            return
+        self.barrier().result(timeout)
+
+    async def aflush(self) -> None:
+        if self.thread is None:
+            return
+        await asyncio.wrap_future(self.barrier())
+
+    def close(self) -> None:
+        with self.start_lock:
+            thread = self.thread
+            if thread is None:
+                return
+            self.queue.put(None)
+            thread.join()
+            self.thread = None
+        print("Write-behind queue closed: " + str(self.stats()))
+
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "batches_flushed": self.batches_flushed,
+            "writes_flushed": self.writes_flushed,
+            "write_errors": self.write_errors,
+            "last_flush_latency_ms": self.last_flush_latency * 1000,
+            "avg_flush_latency_ms": (self.total_flush_latency / self.batches_flushed * 1000) if self.batches_flushed else 0.0,
+            "max_flush_latency_ms": self.max_flush_latency * 1000,
+            "max_write_delay_ms": self.max_write_delay * 1000,
+        }
+
+    def __ensure_started(self) -> None:
+        if self.thread is not None:
+            return
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__run, name="write-behind", daemon=True)
+                self.thread.start()
+
+    def __run(self) -> None:
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.MAX_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if any(item is None for item in batch):
+                running = False
+            items = [item for item in batch if item is not None]
+            try:
+                self.__apply(items)
+            except Exception as e:
+                # Whatever failed the batch fails every future it didn't resolve yet, barriers included, so no
+                # flush() waits on a batch that will never commit
+                print("Write-behind batch failed: " + str(e))
+                for _, _, future, _ in items:
+                    self.__set_exception(future, e)
+            self.__maybe_log_stats()
+        for connection in self.connections.values():
+            connection.close()
+        self.connections.clear()
+
+    def __apply(self, batch) -> None:
+        start = time.monotonic()
+        writes = 0
+        # Intents are grouped per database (keeping their order), a barrier commits everything queued before it
+        groups: Dict[str, List] = {}
+        for item in batch:
+            db_path, intent, future, submitted = item
+            self.max_write_delay = max(self.max_write_delay, start - submitted)
+            if db_path is None:
+                writes += self.__commit_groups(groups)
+                groups = {}
+                self.__set_result(future, None)
+            else:
+                groups.setdefault(db_path, []).append(item)
+        writes += self.__commit_groups(groups)
+        if writes == 0:
+            return
+        latency = time.monotonic() - start
+        self.batches_flushed += 1
+        self.writes_flushed += writes
+        self.last_flush_latency = latency
+        self.total_flush_latency += latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+
+    def __commit_groups(self, groups: Dict[str, List]) -> int:
+        for group in groups.values():
+            self.__commit(group)
+        return sum(len(group) for group in groups.values())
+
+    def __commit(self, group) -> None:
+        if not group:
+            return
+        try:
+            connection = self.__connection(group[0][0])
+        except Exception as e:
+            self.write_errors += len(group)
+            print("Write-behind database failed to open: " + str(e))
+            for _, _, future, _ in group:
+                self.__set_exception(future, e)
+            return
+        results = []
+        try:
+            with connection:
+                for _, intent, _, _ in group:
+                    results.append(intent(connection))
+        except Exception:
+            # Replay one transaction per intent so a single bad write only fails its own future
+            for _, intent, future, _ in group:
+                try:
+                    with connection:
+                        result = intent(connection)
+                except Exception as e:
+                    self.write_errors += 1
+                    print("Write-behind intent failed: " + str(e))
+                    self.__set_exception(future, e)
+                else:
+                    self.__set_result(future, result)
+            return
+        for (_, _, future, _), result in zip(group, results):
+            self.__set_result(future, result)
+
+    # A future whose waiter was cancelled (e.g. through asyncio.wrap_future) is cancelled too and can't be resolved
+    def __set_result(self, future: Future, result: Any) -> None:
+        try:
+            future.set_result(result)
+        except InvalidStateError:
+            pass
+
+    def __set_exception(self, future: Future, exception: BaseException) -> None:
+        try:
+            future.set_exception(exception)
+        except InvalidStateError:
+            pass
+
+    def __connection(self, db_path: str) -> sqlite3.Connection:
+        connection = self.connections.get(db_path)
+        if connection is None:
+            connection = connection_manager.open(db_path)
+            self.connections[db_path] = connection
+        return connection
+
+    def __maybe_log_stats(self) -> None:
+        now = time.monotonic()
+        if now - self.last_stats_log >= self.STATS_LOG_INTERVAL_SECONDS:
+            self.last_stats_log = now
+            print("Write-behind queue: " + str(self.stats()))
+
+
+write_behind_queue = WriteBehindQueue()